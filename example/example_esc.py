@@ -1,7 +1,5 @@
-import itertools
 import pprint
 import shutil
-from copy import deepcopy
 from dataclasses import dataclass
 from datetime import datetime as dt
 from pathlib import Path
@@ -9,24 +7,23 @@ from pathlib import Path
 import hydra
 import librosa
 import mlflow
-import numpy as np
 import pandas as pd
-import torch
 from hydra import utils
-from joblib import Parallel, delayed
 
 from ml.src.dataset import ManifestWaveDataSet
-from ml.tasks.base_experiment import typical_train, typical_experiment
+from ml.src.manifest import vectorized
+from ml.tasks.base_experiment import typical_experiment
+from ml.tasks.search import search, set_hyperparameter
 from ml.utils.config import ExptConfig, before_hydra
 from ml.utils.utils import dump_dict
 
 
 @dataclass
 class ExampleEscConfig(ExptConfig):
-    n_parallel: int = 1
     mlflow: bool = False
 
 
+@vectorized
 def label_func(row):
     return row[2]
 
@@ -62,34 +59,6 @@ def create_manifest(cfg, expt_dir):
     return cfg, groups
 
 
-class LoadDataSet(ManifestWaveDataSet):
-    def __init__(self, manifest_path, data_conf, phase='train', load_func=None, transform=None, label_func=None):
-        super(LoadDataSet, self).__init__(manifest_path, data_conf, phase, load_func, transform, label_func)
-
-    def __getitem__(self, idx):
-        try:
-            x = torch.load(self.path_df.iloc[idx, 0].replace('.wav', '.pt'))
-        except FileNotFoundError as e:
-            print(e)
-            return super().__getitem__(idx)
-        # print(x.size())
-        label = self.labels[idx]
-
-        return x, label
-
-
-def set_hyperparameter(expt_conf, param, param_value):
-    if len(param.split('.')) == 1:
-        expt_conf[param] = param_value
-    else:
-        tmp = expt_conf
-        for attr in param.split('.')[:-1]:
-            tmp = getattr(tmp, str(attr))
-        setattr(tmp, param.split('.')[-1], param_value)
-
-    return expt_conf
-
-
 def main(cfg, expt_dir, hyperparameters):
     if cfg.expt_id == 'timestamp':
         cfg.expt_id = dt.today().strftime('%Y-%m-%d_%H:%M')
@@ -107,45 +76,17 @@ def main(cfg, expt_dir, hyperparameters):
 
     process_func = ['logmel', 'normalize']
 
-    patterns = list(itertools.product(*hyperparameters.values()))
-    val_results = pd.DataFrame(np.zeros((len(patterns), len(hyperparameters) + len(metrics_names['val']))),
-                               columns=list(hyperparameters.keys()) + metrics_names['val'])
-
     pp = pprint.PrettyPrinter(indent=4)
     pp.pprint(hyperparameters)
 
-    def experiment(pattern, cfg):
-        for i, param in enumerate(hyperparameters.keys()):
-            cfg = set_hyperparameter(cfg, param, pattern[i])
-
-        cfg.train.model.model_path = str(expt_dir / f"{'_'.join([str(p).replace('/', '-') for p in pattern])}.pth")
-        cfg.train.log_id = f"{'_'.join([str(p).replace('/', '-') for p in pattern])}"
-
-        with mlflow.start_run():
-            result_series, val_pred, _ = typical_train(cfg, load_func, label_func, process_func, dataset_cls,
-                                                       groups)
-
-            mlflow.log_params({hyperparameter: value for hyperparameter, value in zip(hyperparameters.keys(), pattern)})
-
-        return result_series, val_pred
-
-    # For debugging
-    if cfg.n_parallel == 1:
-        result_pred_list = [experiment(pattern, deepcopy(cfg)) for pattern in patterns]
-    else:
-        cfg.n_jobs = 0
-        result_pred_list = Parallel(n_jobs=cfg.n_parallel, verbose=0)(
-            [delayed(experiment)(pattern, deepcopy(cfg)) for pattern in patterns])
-
-    val_results.iloc[:, :len(hyperparameters)] = patterns
-    result_list = np.array([result for result, pred in result_pred_list])
-    val_results.iloc[:, len(hyperparameters):] = result_list
+    val_results, result_pred_list = search(cfg, hyperparameters, load_func, label_func, process_func, dataset_cls,
+                                           groups, expt_dir=expt_dir)
     pp.pprint(val_results)
     pp.pprint(val_results.iloc[:, len(hyperparameters):].describe())
 
     val_results.to_csv(expt_dir / 'val_results.csv', index=False)
     print(f"Devel results saved into {expt_dir / 'val_results.csv'}")
-    for (_, _), pattern in zip(result_pred_list, patterns):
+    for pattern in val_results.iloc[:, :len(hyperparameters)].values:
         pattern_name = f"{'_'.join([str(p).replace('/', '-') for p in pattern])}"
         dump_dict(expt_dir / f'{pattern_name}.txt', cfg)
 
@@ -153,7 +94,7 @@ def main(cfg, expt_dir, hyperparameters):
     if cfg.test:
         best_trial_idx = val_results['uar'].argmax()
 
-        best_pattern = patterns[best_trial_idx]
+        best_pattern = val_results.iloc[best_trial_idx, :len(hyperparameters)].tolist()
         for i, param in enumerate(hyperparameters.keys()):
             cfg = set_hyperparameter(cfg, param, best_pattern[i])
 
@@ -1,8 +1,6 @@
-import itertools
 import logging
 import pprint
 import shutil
-from copy import deepcopy
 from dataclasses import dataclass
 from datetime import datetime as dt
 from pathlib import Path
@@ -13,14 +11,15 @@ import numpy as np
 import pandas as pd
 import torch
 from hydra import utils
-from joblib import Parallel, delayed
 from omegaconf import OmegaConf
 
 from ml.models.nn_models.cnn import CNNConfig
 from ml.models.nn_models.cnn_rnn import CNNRNNConfig
 from ml.models.nn_models.rnn import RNNConfig
 from ml.src.dataset import ManifestDataSet
-from ml.tasks.base_experiment import typical_train, typical_experiment
+from ml.src.manifest import vectorized
+from ml.tasks.base_experiment import typical_experiment
+from ml.tasks.search import search, set_hyperparameter
 from ml.utils.config import ExptConfig, before_hydra
 from ml.utils.utils import dump_dict
 
@@ -29,10 +28,10 @@ LABELS = ['Anger', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutral']
 
 @dataclass
 class ExampleFaceConfig(ExptConfig):
-    n_parallel: int = 1
     mlflow: bool = False
 
 
+@vectorized
 def label_func(row):
     return row[0]
 
@@ -62,18 +61,6 @@ def create_manifest(expt_conf, expt_dir):
     return expt_conf
 
 
-def set_hyperparameter(expt_conf, param, param_value):
-    if len(param.split('.')) == 1:
-        expt_conf[param] = param_value
-    else:
-        tmp = expt_conf
-        for attr in param.split('.')[:-1]:
-            tmp = getattr(tmp, str(attr))
-        setattr(tmp, param.split('.')[-1], param_value)
-
-    return expt_conf
-
-
 def main(cfg, expt_dir, hyperparameters):
     if cfg.expt_id == 'timestamp':
         cfg.expt_id = dt.today().strftime('%Y-%m-%d_%H:%M')
@@ -90,45 +77,18 @@ def main(cfg, expt_dir, hyperparameters):
     cfg = create_manifest(cfg, expt_dir)
     process_func = None
 
-    patterns = list(itertools.product(*hyperparameters.values()))
-    val_results = pd.DataFrame(np.zeros((len(patterns), len(hyperparameters) + len(metrics_names['val']))),
-                               columns=list(hyperparameters.keys()) + metrics_names['val'])
-
     pp = pprint.PrettyPrinter(indent=4)
     pp.pprint(hyperparameters)
     groups = None
 
-    def experiment(pattern, cfg):
-        for i, param in enumerate(hyperparameters.keys()):
-            cfg = set_hyperparameter(cfg, param, pattern[i])
-
-        cfg.train.model.model_path = str(expt_dir / f"{'_'.join([str(p).replace('/', '-') for p in pattern])}.pth")
-        cfg.train.log_id = f"{'_'.join([str(p).replace('/', '-') for p in pattern])}"
-
-        with mlflow.start_run():
-            result_series, val_pred, _ = typical_train(cfg, load_func, label_func, process_func, dataset_cls, groups)
-
-            mlflow.log_params({hyperparameter: value for hyperparameter, value in zip(hyperparameters.keys(), pattern)})
-
-        return result_series, val_pred
-
-    # For debugging
-    if cfg.n_parallel == 1:
-        result_pred_list = [experiment(pattern, deepcopy(cfg)) for pattern in patterns]
-    else:
-        cfg.n_jobs = 0
-        result_pred_list = Parallel(n_jobs=cfg.n_parallel, verbose=0)(
-            [delayed(experiment)(pattern, deepcopy(cfg)) for pattern in patterns])
-
-    val_results.iloc[:, :len(hyperparameters)] = patterns
-    result_list = np.array([result for result, pred in result_pred_list])
-    val_results.iloc[:, len(hyperparameters):] = result_list
+    val_results, result_pred_list = search(cfg, hyperparameters, load_func, label_func, process_func, dataset_cls,
+                                           groups, expt_dir=expt_dir)
     pp.pprint(val_results)
     pp.pprint(val_results.iloc[:, len(hyperparameters):].describe())
 
     val_results.to_csv(expt_dir / 'val_results.csv', index=False)
     print(f"Devel results saved into {expt_dir / 'val_results.csv'}")
-    for (_, _), pattern in zip(result_pred_list, patterns):
+    for pattern in val_results.iloc[:, :len(hyperparameters)].values:
         pattern_name = f"{'_'.join([str(p).replace('/', '-') for p in pattern])}"
         dump_dict(expt_dir / f'{pattern_name}.txt', cfg)
 
@@ -136,7 +96,7 @@ def main(cfg, expt_dir, hyperparameters):
     if cfg.test:
         best_trial_idx = val_results['uar'].argmax()
 
-        best_pattern = patterns[best_trial_idx]
+        best_pattern = val_results.iloc[best_trial_idx, :len(hyperparameters)].tolist()
         for i, param in enumerate(hyperparameters.keys()):
             cfg = set_hyperparameter(cfg, param, best_pattern[i])
 
@@ -1,10 +1,9 @@
 import logging
 
-from apex import amp
-
 logger = logging.getLogger(__name__)
 
 from ml.models.model_managers.base_model_manager import BaseModelManager
+from ml.models.model_managers.mixed_precision import MixedPrecision
 from ml.models.nn_models.nn_utils import get_param_size
 import numpy as np
 
@@ -29,8 +28,9 @@ class ACGANModelManager(BaseModelManager):
                                             lr=cfg['gan_lr'], betas=(self.cfg['b1'], self.cfg['b2']))
         self.fitted = False
         self.amp = cfg.get('amp', False)
-        if self.amp:
-            self.model, self.optimizer = amp.initialize(self.model, self.optimizer)
+        self.mixed_precision = MixedPrecision(self.amp, self.device, use_apex=cfg.get('apex', False))
+        (self.generator, self.discriminator), (self.optimizer_G, self.optimizer_D) = self.mixed_precision.initialize(
+            [self.generator, self.discriminator], [self.optimizer_G, self.optimizer_D])
         if torch.cuda.device_count() > 1:
             self.generator = torch.nn.DataParallel(self.generator)
             self.discriminator = torch.nn.DataParallel(self.discriminator)
@@ -65,26 +65,31 @@ class ACGANModelManager(BaseModelManager):
         gen_labels = torch.LongTensor(np.random.randint(0, self.cfg['n_classes'], batch_size)).to(self.device)
 
         # Generate a batch of images
-        gen_imgs = self.generator(z, gen_labels)
+        with self.mixed_precision.autocast():
+            gen_imgs = self.generator(z, gen_labels)
+            validity, pred_label = self.discriminator(gen_imgs)
 
-        # Loss measures generator's ability to fool the discriminator
-        validity, pred_label = self.discriminator(gen_imgs)
+        # Loss measures generator's ability to fool the discriminator. BCELoss is computed in float32 out of autocast
+        validity, pred_label = validity.float(), pred_label.float()
         g_loss = 0.5 * (self.adversarial_loss(validity, valid) + self.auxiliary_loss(pred_label, gen_labels))
         g_loss *= self.cfg['gen_weight']
-        g_loss.backward()
-        self.optimizer_G.step()
+        self.mixed_precision.backward(g_loss, self.optimizer_G)
+        self.mixed_precision.step(self.optimizer_G, self.generator.parameters())
 
         return g_loss, gen_imgs, gen_labels
 
     def train_discriminator(self, valid, fake, real_imgs, labels, gen_imgs, gen_labels):
         self.optimizer_D.zero_grad()
 
+        with self.mixed_precision.autocast():
+            real_pred, real_aux = self.discriminator(real_imgs)
+            fake_pred, fake_aux = self.discriminator(gen_imgs.detach())
+        real_pred, real_aux, fake_pred, fake_aux = [x.float() for x in (real_pred, real_aux, fake_pred, fake_aux)]
+
         # Loss for real images
-        real_pred, real_aux = self.discriminator(real_imgs)
         d_real_loss = (self.adversarial_loss(real_pred, valid) + self.auxiliary_loss(real_aux, labels)) / 2
 
         # Loss for fake images
-        fake_pred, fake_aux = self.discriminator(gen_imgs.detach())
         d_fake_loss = (self.adversarial_loss(fake_pred, fake) + self.auxiliary_loss(fake_aux, gen_labels)) / 2
 
         # Total discriminator loss
@@ -95,8 +100,8 @@ class ACGANModelManager(BaseModelManager):
         gt = np.concatenate([labels.data.cpu().numpy(), gen_labels.data.cpu().numpy()], axis=0)
         d_acc = np.mean(np.argmax(pred, axis=1) == gt)
 
-        d_loss.backward()
-        self.optimizer_D.step()
+        self.mixed_precision.backward(d_loss, self.optimizer_D)
+        self.mixed_precision.step(self.optimizer_D, self.discriminator.parameters())
 
         return d_real_loss, d_fake_loss, d_acc
 
@@ -0,0 +1,63 @@
+import logging
+from contextlib import nullcontext
+
+import torch
+
+try:
+    from apex import amp as apex_amp
+except ImportError:
+    apex_amp = None
+
+logger = logging.getLogger(__name__)
+
+
+class MixedPrecision:
+    """
+    Mixed precision training by torch.autocast, in bfloat16 on CPU and in float16 on GPU, where losses are scaled
+    by GradScaler so that small gradients do not underflow. With use_apex, apex amp is used instead.
+    Does nothing if not enabled.
+    """
+    def __init__(self, enabled, device, use_apex=False):
+        self.enabled = enabled
+        self.device_type = torch.device(device).type
+        self.dtype = torch.float16 if self.device_type == 'cuda' else torch.bfloat16
+        self.use_apex = enabled and use_apex
+        if self.use_apex and apex_amp is None:
+            raise ImportError('apex is not installed. Set apex false to use torch.autocast')
+        self.scaler = torch.amp.GradScaler('cuda', enabled=enabled and self.device_type == 'cuda' and not use_apex)
+
+    def initialize(self, model, optimizer):
+        if self.use_apex:
+            return apex_amp.initialize(model, optimizer)
+        return model, optimizer
+
+    def autocast(self):
+        """Context of forward passes and losses"""
+        if not self.enabled or self.use_apex:
+            return nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def backward(self, loss, optimizer):
+        if self.use_apex:
+            with apex_amp.scale_loss(loss, optimizer) as scaled_loss:
+                scaled_loss.backward()
+        else:
+            self.scaler.scale(loss).backward()
+
+    def step(self, optimizer, parameters, grad_clip=None):
+        """
+        Clips gradients of parameters with grad_clip, arguments of clip_grad_norm_, after unscaling them,
+        and updates parameters. Steps with inf or nan gradients are skipped on float16, and the scale is lowered.
+        """
+        if grad_clip:
+            if self.use_apex:
+                parameters = apex_amp.master_params(optimizer)
+            else:
+                self.scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(parameters, *list(grad_clip))
+
+        if self.use_apex:
+            optimizer.step()
+        else:
+            self.scaler.step(optimizer)
+            self.scaler.update()
@@ -7,8 +7,6 @@ import torch.nn.functional as F
 from ml.models.model_managers.nn_model_manager import NNModelManager, StackedNNModel, get_param_size
 from sklearn.exceptions import NotFittedError
 
-# from apex import amp
-
 logger = logging.getLogger(__name__)
 
 
@@ -46,14 +44,15 @@ class MultitaskNNModelManager(NNModelManager):
 
         return model
 
-    def _fit_classify(self, inputs, labels, phase) -> Tuple[np.array, np.ndarray]:
+    def _fit_classify(self, inputs, labels, phase, lengths=None) -> Tuple[np.array, np.ndarray]:
         if self.mixup_alpha:
             raise NotImplementedError
 
-        with torch.set_grad_enabled(phase == 'train'):
+        with torch.set_grad_enabled(phase == 'train'), self._sync_context(phase):
             self.model.train() if phase == 'train' else self.model.eval()
 
-            outputs = self.model(inputs)
+            with self.mixed_precision.autocast():
+                outputs = [output.float() for output in self.model(inputs)]
 
             y_onehot_list = []
             for i in range(self.n_tasks):
@@ -64,14 +63,8 @@ class MultitaskNNModelManager(NNModelManager):
             losses = self.criterion(outputs, y_onehot_list)
 
             if phase == 'train':
-                self.optimizer.zero_grad()
-                if self.amp:
-                    raise NotImplementedError
-                    # with amp.scale_loss(loss, self.optimizer) as loss:
-                    #     loss.backward()
-                else:
-                    [losses[i_task].backward(retain_graph=True) for i_task in range(self.n_tasks)]
-                self.optimizer.step()
+                # One backward of the sum gives the same gradients as backward of each task loss
+                self._backward(sum(losses))
 
             if self.cfg.return_prob:
                 raise NotImplementedError
@@ -84,7 +77,7 @@ class MultitaskNNModelManager(NNModelManager):
         preds = np.array([preds[i].cpu().numpy() for i in range(self.n_tasks)])
         return losses, preds
 
-    def _fit_regress(self, inputs, labels, phase) -> Tuple[float, np.ndarray]:
+    def _fit_regress(self, inputs, labels, phase, lengths=None) -> Tuple[float, np.ndarray]:
         raise NotImplementedError
 
     def predict(self, inputs) -> np.array:  # NNModelManagerは自身がfittedを管理している
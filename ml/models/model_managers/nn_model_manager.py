@@ -1,10 +1,12 @@
 import logging
+from contextlib import nullcontext
 from typing import Tuple
 
 import numpy as np
 import torch
-from apex import amp
+import torch.distributed as dist
 from ml.models.model_managers.base_model_manager import BaseModelManager
+from ml.models.model_managers.mixed_precision import MixedPrecision
 from ml.models.nn_models.attention import AttentionClassifier
 from ml.models.nn_models.cnn import construct_cnn
 from ml.models.nn_models.cnn_rnn import construct_cnn_rnn, CNNRNNConfig
@@ -16,6 +18,7 @@ from ml.models.nn_models.nn_utils import get_param_size
 from ml.models.nn_models.panns_cnn14 import construct_panns
 from ml.models.nn_models.pretrained_models import construct_pretrained, supported_pretrained_models
 from ml.models.nn_models.rnn import construct_rnn, RNNConfig
+from ml.src.distributed import barrier, get_world_size, is_distributed, is_main_process
 from ml.utils.nn_config import SGDConfig, AdamConfig
 from omegaconf import OmegaConf
 from sklearn.exceptions import NotFittedError
@@ -37,7 +40,7 @@ class StackedNNModel(torch.nn.Module):
         if multitask:
             self.predictor = MultitaskPredictor(self.feature_extractors[-1].predictor.in_features,
                                                 cfg.n_labels_in_each_task, self.device)
-        elif cfg.attention:
+        elif cfg.attention and not cfg.pooling.value:   # Pooled features are classified by the extractor's predictor
             self.predictor = AttentionClassifier(len(class_labels), hidden_size, d_attn=cfg.d_attn, n_heads=cfg.n_heads).to(self.device)
         else:
             self.predictor = self.feature_extractors[-1].predictor.to(self.device)
@@ -62,9 +65,9 @@ class StackedNNModel(torch.nn.Module):
         else:
             raise NotImplementedError('model_type should be either rnn or cnn, nn would be implemented in the future.')
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         for feature_extractor in self.feature_extractors:
-            x = feature_extractor.extract_feature(x)
+            x = feature_extractor.extract_feature(x, lengths)
 
         return self.predictor(x)
 
@@ -82,10 +85,16 @@ class NNModelManager(BaseModelManager):
             self.criterion = self.criterion.to(self.device)
         self.optimizer = self._set_optimizer()
         self.fitted = False
+        self.grad_accum_steps = cfg.get('grad_accum_steps', 1)
+        self.n_accumulated = 0
         self.amp = cfg.amp
-        if self.amp:
-            self.model, self.optimizer = amp.initialize(self.model, self.optimizer)
-        if torch.cuda.device_count() > 1 and OmegaConf.get_type(cfg) not in [RNNConfig, CNNRNNConfig]:
+        self.mixed_precision = MixedPrecision(cfg.amp, self.device, use_apex=cfg.get('apex', False))
+        self.model, self.optimizer = self.mixed_precision.initialize(self.model, self.optimizer)
+        if is_distributed():
+            # Launched by torchrun. Each process trains on its own GPU, or on CPU with gloo
+            device_ids = [torch.cuda.current_device()] if self.device.type == 'cuda' else None
+            self.model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=device_ids)
+        elif torch.cuda.device_count() > 1 and OmegaConf.get_type(cfg) not in [RNNConfig, CNNRNNConfig]:
             self.model = torch.nn.parallel.DataParallel(self.model)
 
     def _instantiate_model(self, class_labels):
@@ -113,89 +122,118 @@ class NNModelManager(BaseModelManager):
             return torch.optim.SGD(self.model.parameters(), lr=self.cfg.optim.lr, momentum=self.cfg.optim.momentum,
                                    weight_decay=self.cfg.optim.weight_decay, nesterov=True)
 
-    def _mixup_data(self, inputs, labels, phase):
+    def _mixup_data(self, inputs, labels, phase, lengths=None):
         # To be sure lamb is under 1.0 if phase == 'train' and equals 1.0 if phase != 'train'
         suffix = 0.00001
         if phase == 'train':
             lamb = np.random.beta(self.mixup_alpha, self.mixup_alpha)
             index = torch.randperm(inputs.size(0)).to(self.device)
             inputs = lamb * inputs + (1 - lamb) * inputs[index, :]
+            if lengths is not None:
+                lengths = torch.max(lengths, lengths[index.cpu()])
 
             labels_orig, labels_shuffled = labels, labels[index]
             labels = torch.cat((labels_orig, labels_shuffled), dim=0)
         else:
             lamb = 1.0 + suffix
 
-        return inputs, labels, lamb - suffix
+        return inputs, labels, lamb - suffix, lengths
+
+    def _forward(self, inputs, lengths=None):
+        if lengths is None:
+            return self.model(inputs)
+        return self.model(inputs, lengths)
+
+    def _sync_context(self, phase):
+        # Gradients of distributed processes are reduced only in the backward completing the accumulation
+        if phase == 'train' and isinstance(self.model, torch.nn.parallel.DistributedDataParallel) \
+                and self.n_accumulated + 1 < self.grad_accum_steps:
+            return self.model.no_sync()
+        return nullcontext()
+
+    def _backward(self, loss):
+        # Losses are averaged over accumulated batches, while metrics take the loss of each batch as is
+        if self.grad_accum_steps > 1:
+            loss = loss / self.grad_accum_steps
+        # The graph is freed by backward, as nothing refers to it after the step
+        self.mixed_precision.backward(loss, self.optimizer)
+        self.n_accumulated += 1
+        if self.n_accumulated == self.grad_accum_steps:
+            self.step_optimizer()
+
+    def step_optimizer(self):
+        """
+        Updates parameters by gradients accumulated since the last update, e.g. of the last batches of an epoch
+        fewer than grad_accum_steps, and clears them. Does nothing if none are accumulated.
+        """
+        if self.n_accumulated == 0:
+            return
+
+        if self.n_accumulated < self.grad_accum_steps:
+            for param in self.model.parameters():
+                if param.grad is None:
+                    continue
+                if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+                    # Accumulated in no_sync
+                    dist.all_reduce(param.grad)
+                    param.grad.div_(get_world_size())
+                param.grad.mul_(self.grad_accum_steps / self.n_accumulated)
+
+        self.mixed_precision.step(self.optimizer, self.model.parameters(), self.cfg.grad_clip)
+        self.optimizer.zero_grad()
+        self.n_accumulated = 0
 
-    def _fit_classify(self, inputs, labels, phase) -> Tuple[float, np.ndarray]:
+    def _fit_classify(self, inputs, labels, phase, lengths=None) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.mixup_alpha:
-            inputs, labels, lamb = self._mixup_data(inputs, labels, phase)
+            inputs, labels, lamb, lengths = self._mixup_data(inputs, labels, phase, lengths)
             self.criterion = self._mixup_criterion(lamb)
 
-        with torch.set_grad_enabled(phase == 'train'):
+        with torch.set_grad_enabled(phase == 'train'), self._sync_context(phase):
             self.model.train() if phase == 'train' else self.model.eval()
 
-            outputs = self.model(inputs)
+            with self.mixed_precision.autocast():
+                # Outputs in float32 for losses and predictions
+                outputs = self._forward(inputs, lengths).float()
 
-            if labels.dim() == 1:   # Not softlabel
-                labels = torch.eye(len(self.class_labels))[labels].to(self.device)
+                if labels.dim() == 1:   # Not softlabel
+                    labels = torch.nn.functional.one_hot(labels.to(self.device).long(), len(self.class_labels)).float()
 
-            loss = self.criterion(outputs, labels)
+                loss = self.criterion(outputs, labels)
 
             if phase == 'train':
-                self.optimizer.zero_grad()
-                if self.amp:
-                    with amp.scale_loss(loss, self.optimizer) as loss:
-                        loss.backward()
-                else:
-                    loss.backward(retain_graph=True)
-
-                if self.cfg.grad_clip:
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), *list(self.cfg.grad_clip))
-
-                self.optimizer.step()
+                self._backward(loss)
 
             if self.cfg.return_prob:
                 preds = outputs.detach()
             else:
-                _, preds = torch.max(outputs, 1)
+                _, preds = torch.max(outputs.detach(), 1)
 
-        return loss.item(), preds.cpu().numpy()
+        return loss.detach(), preds
 
-    def _fit_regress(self, inputs, labels, phase) -> Tuple[float, np.ndarray]:
+    def _fit_regress(self, inputs, labels, phase, lengths=None) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.mixup_alpha:
-            inputs, labels, lamb = self._mixup_data(inputs, labels, phase)
+            inputs, labels, lamb, lengths = self._mixup_data(inputs, labels, phase, lengths)
             self.criterion = self._mixup_criterion(lamb)
 
-        with torch.set_grad_enabled(phase == 'train'):
+        with torch.set_grad_enabled(phase == 'train'), self._sync_context(phase):
             self.model.train() if phase == 'train' else self.model.eval()
 
-            preds = self.model(inputs)
+            with self.mixed_precision.autocast():
+                preds = self._forward(inputs, lengths).float()
 
-            if hasattr(self, 'predictor'):
-                extracted_features = preds
-                preds = self.predictor.predict(extracted_features)
+                if hasattr(self, 'predictor'):
+                    extracted_features = preds
+                    preds = self.predictor.predict(extracted_features)
 
-            loss = self.criterion(preds, labels.float())
+                loss = self.criterion(preds, labels.float())
 
             if phase == 'train':
-                self.optimizer.zero_grad()
-                if self.amp:
-                    with amp.scale_loss(loss, self.optimizer) as loss:
-                        loss.backward()
-                else:
-                    loss.backward(retain_graph=True)
-
-                if self.cfg.grad_clip:
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), *list(self.cfg.grad_clip))
-
-                self.optimizer.step()
+                self._backward(loss)
 
                 if hasattr(self, 'predictor'):
                     self.predictor.fit(extracted_features, labels, phase=phase)
 
-        return loss.item(), preds.cpu().detach().numpy()
+        return loss.detach(), torch.as_tensor(preds).detach()
 
     def anneal_lr(self, learning_anneal):
         param_groups = self.optimizer.param_groups
@@ -205,16 +243,22 @@ class NNModelManager(BaseModelManager):
     def get_lr(self):
         return self.optimizer.param_groups[-1]['lr']
 
-    def fit(self, inputs, labels, phase) -> Tuple[float, np.ndarray]:
+    def fit(self, inputs, labels, phase, lengths=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the loss and predictions of the batch as detached tensors on device, not to wait for the device.
+        lengths: Lengths along the time dimension of padded inputs, given by bucketing dataloaders
+        """
         self.fitted = True
-        self.optimizer.zero_grad()
         if self.cfg.task_type.value == 'classify':
-            return self._fit_classify(inputs, labels, phase)
+            return self._fit_classify(inputs, labels, phase, lengths)
         else:
-            return self._fit_regress(inputs, labels, phase)
+            return self._fit_regress(inputs, labels, phase, lengths)
 
     def save_model(self):
-        torch.save(self.model.state_dict(), self.cfg.model_path)
+        # Only rank 0 writes in distributed training, and the others wait to be able to load it
+        if is_main_process():
+            torch.save(self.model.state_dict(), self.cfg.model_path)
+        barrier()
 
     def load_model(self, model=None):
         if model:
@@ -231,13 +275,13 @@ class NNModelManager(BaseModelManager):
 
         self.fitted = True
 
-    def predict(self, inputs):  # NNModelManagerは自身がfittedを管理している
+    def predict(self, inputs, lengths=None):  # NNModelManagerは自身がfittedを管理している
         if not self.fitted:
             raise NotFittedError(f'This NNModelManager instance is not fitted yet.')
 
-        with torch.set_grad_enabled(False):
+        with torch.set_grad_enabled(False), self.mixed_precision.autocast():
             self.model.eval()
-            preds = self.model(inputs)
+            preds = self._forward(inputs, lengths).float()
 
             if self.cfg.task_type.value == 'classify':
                 if hasattr(self, 'predictor'):
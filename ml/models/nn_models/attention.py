@@ -28,14 +28,16 @@ class Attention(nn.Module):
         )
         self.softmax = nn.Softmax(dim=1)
         
-    def calc_attention(self, x):
+    def calc_attention(self, x, mask=None):
         x = self.attn(x)
+        if mask is not None:    # (b, s), False on padded steps
+            x = x.masked_fill(~mask.unsqueeze(2), float('-inf'))
         x = self.softmax(x).transpose(1, 2)  # (b, s, n_heads) -> (b, n_heads, s)
         return x
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         x = x.transpose(1, 2)  # (b, h, s) -> (b, s, h)
-        attns = self.calc_attention(x)  # (b, s, h) -> (b, n_heads, s)
+        attns = self.calc_attention(x, mask)  # (b, s, h) -> (b, n_heads, s)
         feats = torch.bmm(attns, x).view(x.size(0), -1)
 
         return feats, attns
@@ -6,7 +6,7 @@ import math
 
 import random
 import torch.nn as nn
-from ml.models.nn_models.nn_utils import Predictor
+from ml.models.nn_models.nn_utils import Predictor, checkpoint_blocks
 
 from dataclasses import dataclass, field
 from typing import List
@@ -53,14 +53,33 @@ class CNN(nn.Module):
         return x
 
 
+class CheckpointedSequential(nn.Sequential):
+    """
+    nn.Sequential split into checkpoint_segments segments at block_starts, whose activations are recomputed in
+    backward instead of kept. Has the same state_dict as nn.Sequential of the layers.
+    """
+    def __init__(self, *layers, checkpoint_segments=0, block_starts=None):
+        super(CheckpointedSequential, self).__init__(*layers)
+        self.checkpoint_segments = checkpoint_segments
+        # Segments start at blocks so that in-place layers, e.g. ReLU, do not overwrite inputs kept by checkpoints
+        self.block_starts = list(block_starts or range(len(layers)))
+
+    def forward(self, x):
+        bounds = self.block_starts + [len(self)]
+        layers = list(self)
+        blocks = [nn.Sequential(*layers[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+        return checkpoint_blocks(blocks, x, self.checkpoint_segments, self)
+
+
 class CNNMaker:
-    def __init__(self, in_channels, image_size, cfg, n_classes, n_dim, use_as_extractor=False):
+    def __init__(self, in_channels, image_size, cfg, n_classes, n_dim, use_as_extractor=False, checkpoint_segments=0):
         self.in_channels = in_channels
         self.image_size = list(image_size)
         self.cfg = cfg
         self.n_classes = n_classes
         self.n_dim = n_dim
         self.use_as_extractor = use_as_extractor
+        self.checkpoint_segments = checkpoint_segments
 
     def construct_cnn(self):
         layers = self.make_layers()
@@ -80,9 +99,10 @@ class CNNMaker:
             3: dict(zip(cnn_classes, [nn.Conv3d, nn.MaxPool3d, nn.BatchNorm3d]))
         }
 
-        layers = []
+        layers, block_starts = [], []
         n_channels = self.in_channels
         for i, (channel, kernel_size, stride, padding) in enumerate(self.cfg):
+            block_starts.append(len(layers))
             if channel == 'M':
                 layers += [cnn_set[self.n_dim]['max_pool_cls'](kernel_size, stride, padding)]
             else:
@@ -90,7 +110,7 @@ class CNNMaker:
                 layers += [conv, cnn_set[self.n_dim]['batch_norm_cls'](channel), nn.ReLU(inplace=True)]
                 n_channels = channel
 
-        return nn.Sequential(*layers)
+        return CheckpointedSequential(*layers, checkpoint_segments=self.checkpoint_segments, block_starts=block_starts)
 
     def calc_feature_size(self):
         """
@@ -131,5 +151,6 @@ def construct_cnn(cfg, use_as_extractor=False):
             list(cfg.padding_sizes[layer]),
         ))
     cnn_maker = CNNMaker(in_channels=cfg.in_channels, image_size=cfg.image_size, cfg=layer_info, n_dim=n_dim,
-                         n_classes=len(cfg.class_names), use_as_extractor=use_as_extractor)
+                         n_classes=len(cfg.class_names), use_as_extractor=use_as_extractor,
+                         checkpoint_segments=cfg.get('checkpoint_segments', 0))
     return cnn_maker.construct_cnn()
@@ -16,10 +16,11 @@ class CNNRNNConfig(CNNConfig, RNNConfig):
 
 class CNNRNN(RNNClassifier):
     def __init__(self, conv, input_size, out_time_feature, rnn_type=nn.LSTM,
-                 rnn_hidden_size=768, n_layers=5, bidirectional=True, n_classes=2):
+                 rnn_hidden_size=768, n_layers=5, bidirectional=True, n_classes=2, pooling='', d_attn=64, n_heads=1):
         super(CNNRNN, self).__init__(input_size=input_size, out_time_feature=out_time_feature,
                                      rnn_type=rnn_type, rnn_hidden_size=rnn_hidden_size, n_layers=n_layers,
-                                     bidirectional=bidirectional, n_classes=n_classes)
+                                     bidirectional=bidirectional, n_classes=n_classes, pooling=pooling,
+                                     d_attn=d_attn, n_heads=n_heads)
 
         self.hidden_size = rnn_hidden_size
         self.hidden_layers = n_layers
@@ -29,22 +30,27 @@ class CNNRNN(RNNClassifier):
         self.conv = conv
         print(f'Number of parameters\tconv: {get_param_size(self.conv)}\trnn: {get_param_size(super())}')
 
-    def extract_feature(self, x):
+    def extract_feature(self, x, lengths=None):
+        in_time = x.size(2)
         x = self.conv(x.to(torch.float))  # batch x channel x time x freq
 
+        if lengths is not None:
+            # Lengths along time are scaled by the downsampling of conv
+            lengths = torch.clamp((lengths * x.size(2) + in_time - 1) // in_time, min=1)
+
         if len(x.size()) == 4:  # batch x channel x time_feature x freq_feature
             # Collapse feature dimension   batch x feature x time
             x = x.transpose(2, 3)
             sizes = x.size()
             x = x.reshape(sizes[0], sizes[1] * sizes[2], sizes[3])
 
-        return super().extract_feature(x)
+        return super().extract_feature(x, lengths)
 
     def predict(self, x):
         return self.predictor(x)
 
-    def forward(self, x):
-        x = self.extract_feature(x)
+    def forward(self, x, lengths=None):
+        x = self.extract_feature(x, lengths)
         x = self.predict(x)
 
         return x
@@ -55,4 +61,5 @@ def construct_cnn_rnn(cfg, construct_cnn_func, n_classes):
     input_size = conv_out_ftrs['n_channels'] * conv_out_ftrs['width']
     return CNNRNN(conv, input_size, out_time_feature=conv_out_ftrs['height'],
                   rnn_type=supported_rnns[cfg.rnn_type.value], rnn_hidden_size=cfg.rnn_hidden_size,
-                  n_layers=cfg.rnn_n_layers, bidirectional=cfg.bidirectional, n_classes=n_classes)
+                  n_layers=cfg.rnn_n_layers, bidirectional=cfg.bidirectional, n_classes=n_classes,
+                  pooling=cfg.pooling.value, d_attn=cfg.d_attn, n_heads=cfg.n_heads)
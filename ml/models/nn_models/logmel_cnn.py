@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from ml.models.nn_models.nn_utils import initialize_weights, init_bn
+from ml.models.nn_models.nn_utils import checkpoint_blocks, initialize_weights, init_bn
 
 
 class ConvBlock(nn.Module):
@@ -52,8 +52,10 @@ class ConvBlock(nn.Module):
 
 class Cnn14(nn.Module):
     def __init__(self, in_channels, sample_rate, window_size, hop_size, mel_bins, fmin,
-                 fmax, classes_num, signal_augmentor=None, spect_augmentor=None):
+                 fmax, classes_num, signal_augmentor=None, spect_augmentor=None, checkpoint_segments=0):
+        """checkpoint_segments: Number of segments of conv blocks whose activations are recomputed in backward"""
         super(Cnn14, self).__init__()
+        self.checkpoint_segments = checkpoint_segments
 
         self.conv_block1 = ConvBlock(in_channels=in_channels, out_channels=64)
         self.conv_block2 = ConvBlock(in_channels=64, out_channels=128)
@@ -71,6 +73,12 @@ class Cnn14(nn.Module):
         initialize_weights(self.fc1)
         initialize_weights(self.fc_audioset)
 
+    def _conv_block(self, i):
+        def block(x):
+            x = getattr(self, f'conv_block{i}')(x, pool_size=(2, 2), pool_type='avg')
+            return F.dropout(x, p=0.2, training=self.training)
+        return block
+
     def forward(self, input, extract=False):
         """
         Input: (batch_size, n_channels, data_length)"""
@@ -81,16 +89,7 @@ class Cnn14(nn.Module):
 
         x = input
 
-        x = self.conv_block1(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block2(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block3(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block4(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block5(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
+        x = checkpoint_blocks([self._conv_block(i) for i in range(1, 6)], x, self.checkpoint_segments, self)
         # x = self.conv_block6(x, pool_size=(1, 1), pool_type='avg')
         # x = F.dropout(x, p=0.2, training=self.training)
 
@@ -122,7 +121,8 @@ def construct_logmel_cnn(cfg):
     device = torch.device('cuda') if cfg['cuda'] and torch.cuda.is_available() else torch.device('cpu')
 
     model = Cnn14(in_channels=in_channels, sample_rate=sample_rate, window_size=window_size, hop_size=hop_size,
-                  mel_bins=mel_bins, fmin=fmin, fmax=fmax, classes_num=classes_num).to(device)
+                  mel_bins=mel_bins, fmin=fmin, fmax=fmax, classes_num=classes_num,
+                  checkpoint_segments=cfg.get('checkpoint_segments', 0)).to(device)
 
     if checkpoint_path:
         model.fc_audioset = nn.Linear(2048, 527, bias=True)
@@ -1,4 +1,11 @@
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
+import numpy as np
+import torch
 from torch import nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
 
 
 def get_param_size(model):
@@ -11,6 +18,40 @@ def get_param_size(model):
     return params
 
 
+@contextmanager
+def _frozen_running_stats(module):
+    # Recomputation in backward would update running statistics of batch norms twice with the same batch
+    buffers = [(buffer, buffer.clone())
+               for bn in module.modules() if isinstance(bn, _BatchNorm) for buffer in bn.buffers()]
+    try:
+        yield
+    finally:
+        # Recomputation stops by an exception once tensors needed in backward are recomputed
+        for buffer, saved in buffers:
+            buffer.copy_(saved)
+
+
+def _run_blocks(blocks, x):
+    for block in blocks:
+        x = block(x)
+    return x
+
+
+def checkpoint_blocks(blocks, x, n_segments, module) -> torch.Tensor:
+    """
+    Applies blocks, functions of x, in order. If n_segments and module is training with grad, blocks are split into
+    n_segments segments, and only inputs of each segment are kept for backward, where the rest is recomputed.
+    module: Module running blocks, whose batch norm statistics are not updated by the recomputation
+    """
+    if not (n_segments and module.training and torch.is_grad_enabled()):
+        return _run_blocks(blocks, x)
+
+    for segment in np.array_split(np.arange(len(blocks)), min(n_segments, len(blocks))):
+        x = checkpoint(partial(_run_blocks, [blocks[i] for i in segment]), x, use_reentrant=False,
+                       context_fn=lambda: (nullcontext(), _frozen_running_stats(module)))
+    return x
+
+
 def initialize_weights(model):
     if type(model) in [nn.Linear]:
         nn.init.xavier_uniform_(model.weight)
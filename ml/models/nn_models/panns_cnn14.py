@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ml.models.nn_models.nn_utils import checkpoint_blocks
 from ml.models.nn_models.stft import Spectrogram, LogmelFilterBank
 from ml.utils.nn_config import NNModelConfig
 
@@ -75,8 +76,10 @@ class ConvBlock(nn.Module):
 
 
 class Cnn14(nn.Module):
-    def __init__(self, mel_bins, classes_num, checkpoint_path):
+    def __init__(self, mel_bins, classes_num, checkpoint_path, checkpoint_segments=0):
+        """checkpoint_segments: Number of segments of conv blocks whose activations are recomputed in backward"""
         super(Cnn14, self).__init__()
+        self.checkpoint_segments = checkpoint_segments
 
         window = 'hann'
         center = True
@@ -132,23 +135,19 @@ class Cnn14(nn.Module):
         init_layer(self.fc1)
         init_layer(self.fc_audioset)
 
+    def _conv_block(self, i):
+        def block(x):
+            pool_size = (1, 1) if i == 6 else (2, 2)
+            x = getattr(self, f'conv_block{i}')(x, pool_size=pool_size, pool_type='avg')
+            return F.dropout(x, p=0.2, training=self.training)
+        return block
+
     def feature_extract(self, x):
         x = x.transpose(1, 2)
         x = self.bn0(x)
         x = x.transpose(1, 2)
 
-        x = self.conv_block1(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block2(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block3(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block4(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block5(x, pool_size=(2, 2), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block6(x, pool_size=(1, 1), pool_type='avg')
-        x = F.dropout(x, p=0.2, training=self.training)
+        x = checkpoint_blocks([self._conv_block(i) for i in range(1, 7)], x, self.checkpoint_segments, self)
         x = torch.mean(x, dim=3)
 
         (x1, _) = torch.max(x, dim=2)
@@ -174,6 +173,7 @@ class Cnn14(nn.Module):
 def construct_panns(cfg):
     device = torch.device('cuda') if cfg['cuda'] and torch.cuda.is_available() else torch.device('cpu')
 
-    model = Cnn14(mel_bins=cfg.n_mels, classes_num=len(cfg.class_names), checkpoint_path=cfg.checkpoint_path).to(device)
+    model = Cnn14(mel_bins=cfg.n_mels, classes_num=len(cfg.class_names), checkpoint_path=cfg.checkpoint_path,
+                  checkpoint_segments=cfg.get('checkpoint_segments', 0)).to(device)
 
     return model
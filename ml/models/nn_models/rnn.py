@@ -4,6 +4,7 @@ from collections import OrderedDict
 
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from ml.models.nn_models.nn_utils import initialize_weights
 
@@ -15,9 +16,10 @@ supported_rnns = {
 
 
 from dataclasses import dataclass
-from ml.utils.enums import RNNType
+from ml.utils.enums import RNNType, PoolingType
 from ml.utils.nn_config import NNModelConfig
 from ml.models.nn_models.nn_utils import Predictor
+from ml.models.nn_models.attention import Attention
 
 
 @dataclass
@@ -32,6 +34,7 @@ class RNNConfig(NNModelConfig):    # RNN model arguments
     # TODO change to bn
     batch_norm_size: int = 0   # Batch normalization or not
     seq_len: int = 0  # Length of sequence
+    pooling: PoolingType = PoolingType.none     # Pool outputs over valid time steps instead of flattening them
 
 
 def construct_rnn(cfg, output_size):
@@ -54,12 +57,45 @@ def construct_rnn(cfg, output_size):
     return RNNClassifier(cfg.input_size, out_time_feature=cfg.seq_len,
                          rnn_type=supported_rnns[cfg.rnn_type.value], n_classes=output_size,
                          rnn_hidden_size=cfg.rnn_hidden_size, n_layers=cfg.rnn_n_layers,
-                         bidirectional=cfg.bidirectional, dropout=cfg.dropout)
+                         bidirectional=cfg.bidirectional, dropout=cfg.dropout, pooling=cfg.pooling.value,
+                         d_attn=cfg.d_attn, n_heads=cfg.n_heads)
+
+
+class MaskedPooling(nn.Module):
+    """Pools batch x feature x seq over the valid steps of each sample into batch x out_features"""
+    def __init__(self, pooling, h_dim, d_attn=64, n_heads=1):
+        super(MaskedPooling, self).__init__()
+        self.pooling = pooling
+        self.out_features = h_dim * n_heads if pooling == 'attention' else h_dim
+        if pooling == 'attention':
+            self.attn = Attention(h_dim, d_attn, n_heads)
+
+    def forward(self, x, lengths=None):
+        mask = None
+        if lengths is not None:
+            mask = torch.arange(x.size(2), device=x.device)[None, :] < lengths.to(x.device)[:, None]
+
+        if self.pooling == 'mean':
+            if mask is None:
+                return x.mean(dim=2)
+            return (x * mask.unsqueeze(1)).sum(dim=2) / mask.sum(dim=1, keepdim=True).to(x.dtype)
+        elif self.pooling == 'max':
+            if mask is None:
+                return x.max(dim=2)[0]
+            return x.masked_fill(~mask.unsqueeze(1), float('-inf')).max(dim=2)[0]
+        elif self.pooling == 'attention':
+            x, _ = self.attn(x, mask)
+            return x
+        raise NotImplementedError(f'{self.pooling} pooling is not supported')
 
 
 class RNNClassifier(nn.Module):
     def __init__(self, input_size, out_time_feature, n_classes, rnn_type=nn.LSTM, rnn_hidden_size=768, n_layers=5,
-                 bidirectional=True, dropout=0.3):
+                 bidirectional=True, dropout=0.3, pooling='', d_attn=64, n_heads=1):
+        """
+        pooling: '' to flatten outputs of all out_time_feature steps, or mean, max or attention to pool outputs
+                 over valid steps, which accepts sequences of any length
+        """
         super(RNNClassifier, self).__init__()
 
         self.rnn = initialize_weights(
@@ -67,21 +103,37 @@ class RNNClassifier(nn.Module):
                      dropout=dropout, num_layers=n_layers))
 
         rnn_hidden_size = rnn_hidden_size * 2 if bidirectional else rnn_hidden_size
-        self.predictor = Predictor(in_features=rnn_hidden_size * out_time_feature, n_classes=n_classes)
-
-    def extract_feature(self, x):
+        self.out_time_feature = out_time_feature
+        if pooling:
+            self.pooling = MaskedPooling(pooling, rnn_hidden_size, d_attn, n_heads)
+            self.predictor = Predictor(in_features=self.pooling.out_features, n_classes=n_classes)
+        else:
+            self.pooling = None
+            self.predictor = Predictor(in_features=rnn_hidden_size * out_time_feature, n_classes=n_classes)
+
+    def extract_feature(self, x, lengths=None):
         x = x.transpose(0, 2).transpose(1, 2)  # batch x feature x seq -> # seq x batch x feature
-        x, _ = self.rnn(x)
+        if lengths is None:
+            x, _ = self.rnn(x)
+        else:
+            # Padded steps are skipped. Flattened outputs are zero-padded up to out_time_feature
+            total_length = None if self.pooling else max(self.out_time_feature, int(lengths.max()))
+            x = pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+            x, _ = self.rnn(x)
+            x, _ = pad_packed_sequence(x, total_length=total_length)
         x = x.transpose(0, 1).transpose(1, 2)  # seq x batch x feature -> batch x seq x feature -> batch x feature x seq
 
+        if self.pooling:
+            x = self.pooling(x, lengths)
+
         return x
 
     def predict(self, x):
         x = x.reshape(x.size(0), -1)
         return self.predictor(x)
 
-    def forward(self, x):
-        x = self.extract_feature(x)
+    def forward(self, x, lengths=None):
+        x = self.extract_feature(x, lengths)
         x = self.predict(x)
 
         return x
@@ -31,22 +31,13 @@ class AddaTrainManager(BaseTrainManager):
         return AddaModelManager(self.class_labels, self.cfg)
 
     def _predict(self, phase) -> Tuple[np.array, np.array]:
-        batch_size = self.cfg['batch_size']
-
         self.check_keys_from_dict([phase], self.dataloaders)
 
-        dtype_ = np.int if self.cfg['task_type'] == 'classify' else np.float
-        # ラベルが入れられなかった部分を除くため、小さな負の数を初期値として格納
-        pred_list = np.zeros((len(self.dataloaders[phase]) * batch_size, 1), dtype=dtype_) - 1000000
-        label_list = np.zeros((len(self.dataloaders[phase]) * batch_size, 1), dtype=dtype_) - 1000000
+        accumulator = self._init_accumulator(phase)
         for i, (inputs, labels) in tqdm(enumerate(self.dataloaders[phase]), total=len(self.dataloaders[phase])):
-
-            inputs, labels = inputs.to(self.device), labels.numpy().reshape(-1,)
-            preds = self.model.predict(inputs)
-            pred_list[i * batch_size:i * batch_size + preds.shape[0], 0] = preds.reshape(-1,)
-            label_list[i * batch_size:i * batch_size + labels.shape[0], 0] = labels
-
-        pred_list, label_list = pred_list[~(pred_list == -1000000)], label_list[~(label_list == -1000000)]
+            preds = self.model.predict(inputs.to(self.device))
+            accumulator.update(preds.reshape(-1,), labels)
+        pred_list, label_list = accumulator.compute()
 
         if self.cfg['tta']:
             pred_list = pred_list.reshape(self.cfg['tta'], -1).mean(axis=0)
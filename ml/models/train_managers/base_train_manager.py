@@ -13,6 +13,8 @@ import pandas as pd
 import torch
 from ml.models.model_managers.base_model_manager import BaseModelManager
 from ml.models.model_managers.base_model_manager import ExtendedModelConfig, ModelConfig
+from ml.src.accumulator import PredictionAccumulator
+from ml.src.distributed import get_local_rank, is_distributed, is_main_process
 from ml.utils.enums import TaskType
 from ml.utils.logger import TensorBoardLogger
 from ml.utils.utils import Metrics
@@ -44,9 +46,11 @@ class TrainConfig(TensorboardConfig):
     gpu_id: int = 0  # ID of GPU to use
 
     tta: int = 0  # Number of test time augmentation ensemble
+    log_interval: int = 100  # Steps between reads of the running loss from device and progress logs. 0 for epoch end
     snapshot: List[int] = field(
         default_factory=lambda: [])  # The number of epochs to save weights. Comma separated int is allowed
-    cache: bool = False  # Make cache after preprocessing or not
+    patience: int = 10  # Epochs without improvement of the validation metric to save models by, for early stopping
+    plateau_threshold: float = 0.0  # Stop if the validation metric stays within this rate for patience epochs
 
 
 @contextmanager
@@ -58,7 +62,11 @@ def simple_timer(label) -> None:
 
 
 class BaseTrainManager(metaclass=ABCMeta):
-    def __init__(self, class_labels, cfg, dataloaders, metrics):
+    def __init__(self, class_labels, cfg, dataloaders, metrics, epoch_callbacks=None):
+        """
+        epoch_callbacks: Callbacks called with (epoch, {metric name: value}) of validation after each epoch,
+            which can stop training. Plain functions are stopping ones returning True to stop
+        """
         self.class_labels = class_labels
         self.cfg = cfg
         self.cfg.model.class_names = self.cfg.class_names
@@ -69,6 +77,7 @@ class BaseTrainManager(metaclass=ABCMeta):
         self.model_manager = self._init_model_manager()
         self.logger = self._init_logger()
         self.metrics = metrics
+        self.epoch_callbacks = epoch_callbacks or []
         Path(self.cfg.model.model_path).parent.mkdir(exist_ok=True, parents=True)
 
     @abstractmethod
@@ -78,7 +87,8 @@ class BaseTrainManager(metaclass=ABCMeta):
     def _init_device(self) -> torch.device:
         if self.cfg.cuda:# and self.cfg.model_type.value in [name.value for name in list(NNType) + list(PretrainedType)]:
             device = torch.device('cuda')
-            torch.cuda.set_device(self.cfg['gpu_id'])
+            # Each distributed process uses the GPU of its local rank
+            torch.cuda.set_device(get_local_rank() if is_distributed() else self.cfg['gpu_id'])
         else:
             device = torch.device('cpu')
 
@@ -86,7 +96,7 @@ class BaseTrainManager(metaclass=ABCMeta):
 
     def _init_logger(self) -> TensorBoardLogger:
         print(self.cfg['tensorboard'])
-        if self.cfg['tensorboard']:
+        if self.cfg['tensorboard'] and is_main_process():
             return TensorBoardLogger(self.cfg['log_id'], self.cfg['log_dir'])
 
     def _record_log(self, phase, epoch, metrics, suffix='') -> None:
@@ -96,6 +106,11 @@ class BaseTrainManager(metaclass=ABCMeta):
             values[f'{phase}_{metric.name}_mean{suffix}'] = metric.average_meter.average
         self.logger.update(epoch, values)
 
+    def _init_accumulator(self, phase) -> PredictionAccumulator:
+        dataloader = self.dataloaders[phase]
+        n_samples = len(dataloader) * dataloader.batch_size if dataloader.batch_size else 0
+        return PredictionAccumulator(n_samples)
+
     def _predict(self, phase) -> Tuple[np.array, np.array]:
         raise NotImplementedError
 
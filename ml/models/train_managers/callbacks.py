@@ -0,0 +1,86 @@
+import logging
+from collections import deque
+from typing import Callable, Dict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class Callback:
+    """
+    Hook of the epoch loop of train managers, called with validation metric values of each epoch.
+    Returning True from on_epoch_end stops training, after which the train manager restores the best checkpoint.
+    """
+    def on_train_begin(self) -> None:
+        pass
+
+    def on_epoch_end(self, epoch: int, values: Dict[str, float]) -> bool:
+        return False
+
+
+class EarlyStopping(Callback):
+    """Stops if metric has not improved by more than min_delta for patience epochs, or has diverged to nan or inf"""
+    def __init__(self, metric_name='loss', direction='minimize', patience=10, min_delta=0.0):
+        self.metric_name = metric_name
+        self.sign = 1 if direction == 'maximize' else -1
+        self.patience = patience
+        self.min_delta = min_delta
+        self.on_train_begin()
+
+    def on_train_begin(self):
+        self.best = None
+        self.n_bad_epochs = 0
+
+    def on_epoch_end(self, epoch, values):
+        value = values[self.metric_name]
+        if not np.isfinite(value):
+            logger.info(f'Early stopping at epoch {epoch + 1}: {self.metric_name} diverged to {value}')
+            return True
+
+        if self.best is None or self.sign * (value - self.best) > self.min_delta:
+            self.best = value
+            self.n_bad_epochs = 0
+        else:
+            self.n_bad_epochs += 1
+
+        if self.n_bad_epochs >= self.patience:
+            logger.info(f'Early stopping at epoch {epoch + 1}: {self.metric_name} has not improved from '
+                        f'{self.best:.4f} for {self.patience} epochs')
+            return True
+        return False
+
+
+class PlateauStopping(Callback):
+    """Stops if metric has stayed within threshold relative to its value over the last patience epochs"""
+    def __init__(self, metric_name='loss', patience=5, threshold=1e-3):
+        self.metric_name = metric_name
+        self.patience = patience
+        self.threshold = threshold
+        self.on_train_begin()
+
+    def on_train_begin(self):
+        self.history = deque(maxlen=self.patience + 1)
+
+    def on_epoch_end(self, epoch, values):
+        self.history.append(values[self.metric_name])
+        if len(self.history) < self.history.maxlen:
+            return False
+
+        scale = max(abs(self.history[0]), np.finfo(np.float32).eps)
+        if (max(self.history) - min(self.history)) / scale <= self.threshold:
+            logger.info(f'Stopping at epoch {epoch + 1}: {self.metric_name} reached a plateau')
+            return True
+        return False
+
+
+class ExternalStopping(Callback):
+    """Stops if should_stop(epoch, values) returns True, e.g. on signals of an external scheduler or pruner"""
+    def __init__(self, should_stop: Callable[[int, Dict[str, float]], bool]):
+        self.should_stop = should_stop
+
+    def on_epoch_end(self, epoch, values):
+        if self.should_stop(epoch, values):
+            logger.info(f'Stopping at epoch {epoch + 1} by an external signal')
+            return True
+        return False
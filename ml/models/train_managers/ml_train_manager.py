@@ -13,8 +13,8 @@ logger = logging.getLogger(__name__)
 
 
 class MLTrainManager(BaseTrainManager):
-    def __init__(self, class_labels, cfg, dataloaders, metrics):
-        super().__init__(class_labels, cfg, dataloaders, metrics)
+    def __init__(self, class_labels, cfg, dataloaders, metrics, epoch_callbacks=None):
+        super().__init__(class_labels, cfg, dataloaders, metrics, epoch_callbacks)
 
     def _init_model_manager(self) -> MLModelManager:
         self.cfg.model.input_size = list(list(self.dataloaders.values())[0].get_input_size())
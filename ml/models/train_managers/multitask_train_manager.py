@@ -18,8 +18,8 @@ logger = logging.getLogger(__name__)
 
 
 class MultitaskTrainManager(NNTrainManager):
-    def __init__(self, class_labels, cfg, dataloaders, metrics):
-        super(MultitaskTrainManager, self).__init__(class_labels, cfg, dataloaders, metrics)
+    def __init__(self, class_labels, cfg, dataloaders, metrics, epoch_callbacks=None):
+        super(MultitaskTrainManager, self).__init__(class_labels, cfg, dataloaders, metrics, epoch_callbacks)
         self.n_labels_in_each_task = cfg.model.n_labels_in_each_task
         self.n_tasks = len(self.n_labels_in_each_task)
         self.metrics_list = [deepcopy(self.metrics) for i in range(self.n_tasks)]
@@ -46,17 +46,11 @@ class MultitaskTrainManager(NNTrainManager):
         logger.debug(progress)
 
     def predict(self, phase) -> Tuple[np.array, np.array]:
-        pred_list, label_list = np.array([]), np.array([])
+        accumulator = self._init_accumulator(phase)
         for i, (inputs, labels) in tqdm(enumerate(self.dataloaders[phase]), total=len(self.dataloaders[phase])):
-            inputs, labels = inputs.to(self.device), labels.numpy().reshape(-1, )
-            preds = self.model_manager.predict(inputs)
-            if pred_list.size == 0:
-                pred_list = preds
-            elif pred_list.ndim == 1:
-                pred_list = np.hstack((pred_list, preds))
-            else:
-                pred_list = np.vstack((pred_list, preds))
-            label_list = np.hstack((label_list, labels))
+            preds = self.model_manager.predict(self._to_device(phase, inputs))
+            accumulator.update(preds, labels)
+        pred_list, label_list = accumulator.compute()
 
         if self.cfg.tta:
             pred_list, label_list = self._average_tta(pred_list, label_list)
@@ -77,12 +71,13 @@ class MultitaskTrainManager(NNTrainManager):
         if only_validate:
             phases = ['val']
 
+        self.callbacks = self._init_callbacks(self.metrics_list[0])
         for epoch in range(self.cfg.epochs):
             for phase in phases:
                 pred_list, label_list, loss_list = np.array([]), np.array([]), np.array([])
 
                 for i, (inputs, labels) in enumerate(self.dataloaders[phase]):
-                    losses, predicts = self.model_manager.fit(inputs.to(self.device), labels, phase)
+                    losses, predicts = self.model_manager.fit(self._to_device(phase, inputs), labels, phase)
                     labels = np.array([labels[i_task].cpu().numpy() for i_task in range(self.n_tasks)])
 
                     if pred_list.size == 0:
@@ -96,6 +91,10 @@ class MultitaskTrainManager(NNTrainManager):
 
                     self._verbose(epoch, phase, losses, i, elapsed=int(time.time() - start))
 
+                if phase == 'train':
+                    # Last batches of the epoch fewer than grad_accum_steps
+                    self.model_manager.step_optimizer()
+
                 # save metrics in one batch
                 loss = loss_list.sum(axis=1).mean()
                 for i_task in range(self.n_tasks):
@@ -114,6 +113,11 @@ class MultitaskTrainManager(NNTrainManager):
                     if not self.cfg.model.return_prob:
                         logger.debug(f'Best prediction of validation info:\n{pd.Series(best_val_pred).describe()}')
 
+            if self.stopped:
+                break
+
+        self._restore_best()
+
         if self.logger:
             self.logger.close()
 
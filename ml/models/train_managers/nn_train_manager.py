@@ -1,10 +1,11 @@
 import logging
 import time
 from contextlib import contextmanager
-from typing import Tuple
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
+import torch
 from ml.models.model_managers.nn_model_manager import NNModelManager
 from ml.models.nn_models.cnn import CNNConfig
 from ml.models.nn_models.cnn_rnn import CNNRNNConfig
@@ -13,8 +14,11 @@ from ml.models.nn_models.panns_cnn14 import PANNsConfig
 from ml.models.nn_models.pretrained_models import PretrainedConfig
 from ml.models.nn_models.rnn import RNNConfig
 from ml.models.train_managers.base_train_manager import BaseTrainManager
+from ml.models.train_managers.callbacks import Callback, EarlyStopping, ExternalStopping, PlateauStopping
+from ml.src.dataloader import DevicePrefetcher
 from ml.utils.utils import Metrics
 from omegaconf import OmegaConf
+from torch.utils.data import DistributedSampler
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
@@ -30,8 +34,11 @@ def simple_timer(label) -> None:
 
 
 class NNTrainManager(BaseTrainManager):
-    def __init__(self, class_labels, cfg, dataloaders, metrics):
-        super().__init__(class_labels, cfg, dataloaders, metrics)
+    def __init__(self, class_labels, cfg, dataloaders, metrics, epoch_callbacks=None):
+        super().__init__(class_labels, cfg, dataloaders, metrics, epoch_callbacks)
+        self.callbacks = []
+        self.stopped = False
+        self.best_saved = False
 
     def _init_model_manager(self) -> NNModelManager:
         self.cfg.model.input_size = list(list(self.dataloaders.values())[0].get_input_size())
@@ -48,6 +55,29 @@ class NNTrainManager(BaseTrainManager):
         else:
             raise NotImplementedError
 
+    def _batches(self, phase):
+        dataloader = self.dataloaders[phase]
+        if getattr(dataloader, 'device_prefetch', False):
+            return DevicePrefetcher(dataloader, self.device)
+        return dataloader
+
+    def _to_device(self, phase, inputs) -> torch.Tensor:
+        inputs = inputs.to(self.device)
+
+        batch_transform = getattr(self.dataloaders[phase], 'batch_transform', None)
+        if batch_transform:
+            with torch.no_grad():
+                inputs = batch_transform.to(self.device)(inputs.float())
+
+        return inputs
+
+    def _output_lengths(self, phase, lengths) -> list:
+        """Lengths yielded by bucketing dataloaders, along the time axis of inputs after the batch transform"""
+        batch_transform = getattr(self.dataloaders[phase], 'batch_transform', None)
+        if batch_transform and lengths:
+            return [batch_transform.output_length(lengths[0])]
+        return lengths
+
     def _verbose(self, epoch, phase, metrics, i, elapsed, data_len=None) -> None:
         if not data_len:
             data_len = len(self.dataloaders[phase])
@@ -56,15 +86,42 @@ class NNTrainManager(BaseTrainManager):
         progress += '\t'.join([f'{m.name} {m.average_meter.value:.4f}' for m in metrics[phase] if m.name == 'loss'])
         logger.debug(progress)
 
+    def _init_callbacks(self, metrics) -> List[Callback]:
+        """Stopping callbacks on the validation metric to save models by, as configured by cfg, and epoch_callbacks"""
+        callbacks = []
+        target = next((metric for metric in metrics.get('val', []) if metric.save_model), None)
+        if target:
+            if self.cfg.model.early_stopping:
+                callbacks.append(EarlyStopping(target.name, target.direction, self.cfg.patience))
+            if self.cfg.plateau_threshold:
+                callbacks.append(PlateauStopping(target.name, self.cfg.patience, self.cfg.plateau_threshold))
+        callbacks += [callback if isinstance(callback, Callback) else ExternalStopping(callback)
+                      for callback in self.epoch_callbacks]
+
+        for callback in callbacks:
+            callback.on_train_begin()
+        self.stopped = False
+        self.best_saved = False
+        return callbacks
+
+    def _restore_best(self) -> None:
+        # Training stopped early ends with the best model instead of the last one, like training to the end and test()
+        if self.stopped and self.best_saved:
+            logger.info(f'Restoring the best model from {self.cfg.model.model_path}')
+            self.model_manager.load_model()
+
     def _update_by_epoch(self, phase, metrics, learning_anneal, epoch) -> bool:
         best_val_flag = False
+        epoch_values = {}
 
         for metric in metrics[phase]:
+            epoch_values[metric.name] = metric.average_meter.average
             best_flag = metric.average_meter.update_best()
             if metric.save_model and best_flag and phase == 'val':
                 logger.info(f"Found better validated model, saving to {self.cfg.model.model_path}")
                 self.model_manager.save_model()
                 best_val_flag = True
+                self.best_saved = True
 
             # reset epoch average meter
             metric.average_meter.reset()
@@ -79,6 +136,11 @@ class NNTrainManager(BaseTrainManager):
         if phase == 'train':
             self.model_manager.anneal_lr(learning_anneal)
 
+        if phase == 'val':
+            # All callbacks see every epoch, even after one of them decides to stop
+            stop_flags = [callback.on_epoch_end(epoch, epoch_values) for callback in self.callbacks]
+            self.stopped = any(stop_flags)
+
         return best_val_flag
 
     def _epoch_verbose(self, epoch, epoch_metrics, phase):
@@ -93,17 +155,12 @@ class NNTrainManager(BaseTrainManager):
             logger.info(message)
 
     def _predict(self, phase) -> Tuple[np.array, np.array]:
-        pred_list, label_list = np.array([]), np.array([])
-        for i, (inputs, labels) in tqdm(enumerate(self.dataloaders[phase]), total=len(self.dataloaders[phase])):
-            inputs, labels = inputs.to(self.device), labels.numpy().reshape(-1,)
-            preds = self.model_manager.predict(inputs)
-            if pred_list.size == 0:
-                pred_list = preds
-            elif pred_list.ndim == 1:
-                pred_list = np.hstack((pred_list, preds))
-            else:
-                pred_list = np.vstack((pred_list, preds))
-            label_list = np.hstack((label_list, labels))
+        accumulator = self._init_accumulator(phase)
+        for i, (inputs, labels, *lengths) in tqdm(enumerate(self._batches(phase)),
+                                                  total=len(self.dataloaders[phase])):
+            preds = self.model_manager.predict(self._to_device(phase, inputs), *self._output_lengths(phase, lengths))
+            accumulator.update(preds, labels)
+        pred_list, label_list = accumulator.compute()
 
         if self.cfg.tta:
             pred_list, label_list = self._average_tta(pred_list, label_list)
@@ -148,30 +205,44 @@ class NNTrainManager(BaseTrainManager):
         if only_validate:
             phases = ['val']
 
+        self.callbacks = self._init_callbacks(self.metrics)
         for epoch in range(self.cfg.epochs):
             for phase in phases:
-                pred_list, label_list = np.array([]), np.array([])
-
-                for i, (inputs, labels) in enumerate(self.dataloaders[phase]):
-                    loss, predicts = self.model_manager.fit(inputs.to(self.device), labels.to(self.device), phase)
+                sampler = getattr(self.dataloaders[phase], 'sampler', None)
+                if isinstance(sampler, DistributedSampler):
+                    # Shuffled differently in each epoch, in the same order in all processes
+                    sampler.set_epoch(epoch)
+                accumulator = self._init_accumulator(phase)
+                # Losses are summed on device, and read to the loss metric only every log_interval steps
+                loss_sum, n_samples = torch.zeros((), device=self.device), 0
+
+                # Bucketing dataloaders also yield lengths of padded inputs
+                for i, (inputs, labels, *lengths) in enumerate(self._batches(phase)):
+                    loss, predicts = self.model_manager.fit(self._to_device(phase, inputs), labels.to(self.device),
+                                                            phase, *self._output_lengths(phase, lengths))
 
                     if labels.dim() == 2:     # If softlabel
                         labels = labels.argmax(dim=1)
 
-                    if pred_list.size == 0:
-                        pred_list = predicts
-                    elif pred_list.ndim == 1:
-                        pred_list = np.hstack((pred_list, predicts))
-                    else:
-                        pred_list = np.vstack((pred_list, predicts))
-                    label_list = np.hstack((label_list, labels))
-                    
-                    # save loss in one batch
-                    self.metrics[phase][0].update(loss, predicts, labels.numpy())
+                    accumulator.update(predicts, labels)
+                    loss_sum += loss
+                    n_samples += len(labels)
+
+                    if self.cfg.log_interval and (i + 1) % self.cfg.log_interval == 0:
+                        self.metrics[phase][0].update_loss(loss_sum.item(), n_samples)
+                        loss_sum.zero_()
+                        n_samples = 0
+                        self._verbose(epoch, phase, self.metrics, i, elapsed=int(time.time() - start))
 
-                    self._verbose(epoch, phase, self.metrics, i, elapsed=int(time.time() - start))
+                if n_samples:
+                    self.metrics[phase][0].update_loss(loss_sum.item(), n_samples)
+
+                if phase == 'train':
+                    # Last batches of the epoch fewer than grad_accum_steps
+                    self.model_manager.step_optimizer()
 
                 # save metrics in one batch
+                pred_list, label_list = accumulator.compute()
                 [metric.update(0.0, pred_list, label_list) for metric in self.metrics[phase][1:]]
 
                 self._epoch_verbose(epoch, self.metrics, phase)
@@ -186,6 +257,11 @@ class NNTrainManager(BaseTrainManager):
                     if not self.cfg.model.return_prob:
                         logger.debug(f'Best prediction of validation info:\n{pd.Series(best_val_pred).describe()}')
 
+            if self.stopped:
+                break
+
+        self._restore_best()
+
         if self.logger:
             self.logger.close()
 
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from ml.models.nn_models.nn_utils import init_bn
 from ml.models.nn_models.stft import Spectrogram, LogmelFilterBank
@@ -33,16 +34,35 @@ class LogMel:
 
         init_bn(self.bn0)
 
+    def _normalize(self, x):
+        """
+        Applies bn0 to (batch_size, n_channels, time_steps, mel_bins) in one call.
+        Samples are folded into the feature dimension so that batch statistics are computed per sample over
+        channels and time, as a separate bn0 call on each sample would do.
+        """
+        batch_size, n_channels, time_steps, mel_bins = x.size()
+        x = x.permute(0, 3, 1, 2).reshape(1, batch_size * mel_bins, n_channels, time_steps)
+        use_batch_stats = self.bn0.training or self.bn0.running_mean is None
+        x = F.batch_norm(x,
+                         None if use_batch_stats else self.bn0.running_mean.repeat(batch_size),
+                         None if use_batch_stats else self.bn0.running_var.repeat(batch_size),
+                         self.bn0.weight.repeat(batch_size), self.bn0.bias.repeat(batch_size),
+                         training=use_batch_stats, eps=self.bn0.eps)
+        return x.view(batch_size, mel_bins, n_channels, time_steps).permute(0, 2, 3, 1)
+
     def __call__(self, signals):
-        """Input: (n_channels, data_length)"""
-        logmeled = torch.Tensor([]).to(signals.device)
-        for idx_channel in range(signals.size(0)):
-            x = signals[idx_channel, :]   # (1, 1, data_length)
-            x = self.spectrogram_extractor(x)  # (1, 1, time_steps, freq_bins)
-            x = self.logmel_extractor(x)  # (1, 1, time_steps, mel_bins)
-            x = x.transpose(1, 3)
-            x = self.bn0(x)
-            x = x.transpose(1, 3)
-            logmeled = torch.cat([logmeled, x], dim=1)
-
-        return logmeled.detach().squeeze(dim=0)
+        """
+        Input: (n_channels, data_length) or (batch_size, n_channels, data_length)
+        Output: (n_channels, batch_size, time_steps, mel_bins), squeezed on the first dimension
+        """
+        if signals.dim() == 2:
+            signals = signals[None, :]
+        batch_size, n_channels, data_length = signals.size()
+
+        # All channels of all samples go through the conv STFT as one batch
+        x = signals.reshape(batch_size * n_channels, data_length)
+        x = self.spectrogram_extractor(x)  # (batch_size * n_channels, 1, time_steps, freq_bins)
+        x = self.logmel_extractor(x)  # (batch_size * n_channels, 1, time_steps, mel_bins)
+        x = self._normalize(x.view(batch_size, n_channels, x.size(2), x.size(3)))
+
+        return x.transpose(0, 1).detach().squeeze(dim=0)
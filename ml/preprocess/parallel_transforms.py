@@ -1,4 +1,4 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 from dataclasses import dataclass, field
 
 import torch
@@ -30,17 +30,63 @@ class ParallelTransform(torch.nn.Module):
     def __init__(self,
                  cfg_list: List[TransConfig],
                  phase: str,
-                 process_orders: List[List[str]]) -> None:
+                 process_orders: List[List[str]],
+                 batched: bool = False) -> None:
 
         super(ParallelTransform, self).__init__()
         self.cfg_list = cfg_list
-        self.transforms = [Transform(cfg, phase, process) for cfg, process in zip(cfg_list, process_orders)]
+        self.transforms = torch.nn.ModuleList([Transform(cfg, phase, process, batched=batched)
+                                               for cfg, process in zip(cfg_list, process_orders)])
         self.phase = phase
+        self.batched = batched
+        self.deterministic = all(transform.deterministic for transform in self.transforms)
+
+    def cache_key(self):
+        return ''.join(transform.cache_key() for transform in self.transforms)
+
+    def split(self) -> Tuple[Optional[torch.nn.Module], torch.nn.Module]:
+        """
+        Split every transform into its deterministic prefix and random suffix.
+        Random processes keep the shape, so prefix outputs have the same shape and are stacked into one tensor.
+        Returns (None, self) if any transform starts with a random process.
+        """
+        prefixes, suffixes = zip(*[transform.split() for transform in self.transforms])
+        if not all(prefix.components for prefix in prefixes):
+            return None, self
+
+        return ParallelPrefix(prefixes, self.batched), ParallelSuffix(suffixes, self.batched)
+
+    def output_length(self, lengths: Tensor) -> Tensor:
+        # Features are concatenated, so their time axes have the same length
+        return self.transforms[0].output_length(lengths)
 
     def forward(self, x: Tensor):
         features = []
         for transform in self.transforms:
             features.append(transform(x))
 
-        x = torch.cat(features, dim=0)
+        x = torch.cat(features, dim=1 if self.batched else 0)
         return x
+
+
+class ParallelPrefix(torch.nn.Module):
+    def __init__(self, prefixes: Sequence[Transform], batched: bool = False) -> None:
+        super(ParallelPrefix, self).__init__()
+        self.prefixes = torch.nn.ModuleList(prefixes)
+        self.dim = 1 if batched else 0
+
+    def cache_key(self):
+        return ''.join(prefix.cache_key() for prefix in self.prefixes)
+
+    def forward(self, x: Tensor):
+        return torch.stack([prefix(x) for prefix in self.prefixes], dim=self.dim)
+
+
+class ParallelSuffix(torch.nn.Module):
+    def __init__(self, suffixes: Sequence[Transform], batched: bool = False) -> None:
+        super(ParallelSuffix, self).__init__()
+        self.suffixes = torch.nn.ModuleList(suffixes)
+        self.dim = 1 if batched else 0
+
+    def forward(self, x: Tensor):
+        return torch.cat([suffix(x.select(self.dim, i)) for i, suffix in enumerate(self.suffixes)], dim=self.dim)
@@ -29,6 +29,8 @@ def preprocess_args(parser):
     prep_parser.add_argument('--channel-wise-mean', action='store_true')
     prep_parser.add_argument('--inter-channel-mean', action='store_true')
     prep_parser.add_argument('--remove-power-noise', dest='remove_power_noise', action='store_true')
+    prep_parser.add_argument('--power-freq', default=60.0, type=float, help='Frequency of power line noise')
+    prep_parser.add_argument('--zero-phase-filter', action='store_true', help='Filter forward and backward')
     prep_parser.add_argument('--mfcc', dest='mfcc', action='store_true', help='MFCC')
     prep_parser.add_argument('--fe-pretrained', default=None, choices=supported_pretrained_models,
                              help='Use NN as feature extractor')
@@ -57,6 +59,8 @@ class TransConfig:
     spec_augment: float = 0.0
     fe_pretrained: PretrainedType = PretrainedType.none
     remove_power_noise: bool = False
+    power_freq: float = 60.0    # Frequency of power line noise, 50 or 60Hz
+    zero_phase_filter: bool = False     # Filter forward and backward with sosfiltfilt
     channel_wise_mean: bool = False
     inter_channel_mean: bool = False
     muscle_noise: bool = False
@@ -88,14 +92,20 @@ class Preprocessor:
             cfg_copy['model_type'] = cfg['fe_pretrained']
             self.feature_extractor = PretrainedNN(cfg_copy, len(cfg['class_names']))
         self.resample_rate = 10
+        self.filter_bank = self._init_filter_bank(cfg)
 
-    def preprocess(self, wave):
+    def _init_filter_bank(self, cfg):
+        # Band pass and power noise filters are cascaded so that each wave is filtered in one pass
+        zero_phase = cfg.get('zero_phase_filter', False)
+        filter_bank = bandpass_filter_bank(self.sr, self.l_cutoff, self.h_cutoff, zero_phase)
+        if cfg['remove_power_noise']:
+            power_noise = power_noise_filter(self.sr, cfg.get('power_freq', 60.0), zero_phase=zero_phase)
+            filter_bank.sections.extend(power_noise.sections)
+        return filter_bank
 
-        if self.l_cutoff or self.h_cutoff:
-            wave = bandpass_filter(wave, self.l_cutoff, self.h_cutoff, self.sr)
+    def preprocess(self, wave):
 
-        if self.cfg['remove_power_noise']:
-            wave = remove_power_noise(wave, self.sr)
+        wave = self.filter_bank(wave)
 
         # wave = scipy.signal.decimate(wave, self.resample_rate)
         # self.sr = wave.shape[1] / 10
@@ -1,30 +1,60 @@
+from functools import lru_cache
+
 import librosa
 import numpy as np
 import torch
 from scipy import signal
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt, sosfiltfilt
+
+from ml.utils.enums import SpectrogramWindow
 
 windows = {'hamming': signal.hamming, 'hann': signal.hann, 'blackman': signal.blackman,
            'bartlett': signal.bartlett}
 
 
+def _as_tensor(wave):
+    """float32 inputs are processed in float32, others in float64 as librosa does"""
+    wave = torch.as_tensor(wave)
+    return wave if wave.dtype == torch.float32 else wave.to(torch.float64)
+
+
+@lru_cache(maxsize=16)
+def _window(window, win_length):
+    # Window functions return symmetric windows, while names are resolved to periodic ones as librosa.stft does
+    if callable(window):
+        return torch.from_numpy(window(win_length))
+    return torch.from_numpy(signal.get_window(window, win_length, fftbins=True))
+
+
+@lru_cache(maxsize=16)
+def _mel_basis(sr, n_fft, n_mels):
+    return torch.from_numpy(librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels))
+
+
+def _stft_magnitude(wave, n_fft, hop_length, window):
+    """(n_channels, data_length) -> (n_channels, freq_bins, time_steps), all channels in one call"""
+    window = window.to(device=wave.device, dtype=wave.dtype)
+    D = torch.stft(wave, n_fft, hop_length=hop_length, win_length=n_fft, window=window, center=True,
+                   pad_mode='reflect', return_complex=True)
+    return D.abs()
+
+
+def _power_to_db(spect, amin=1e-10, top_db=80.0):
+    """librosa.power_to_db with ref=np.max, where the reference is taken per channel"""
+    log_spect = 10.0 * torch.log10(spect.clamp(min=amin))
+    log_spect -= 10.0 * torch.log10(spect.flatten(1).max(dim=1)[0].clamp(min=amin))[:, None, None]
+    return torch.max(log_spect, log_spect.flatten(1).max(dim=1)[0][:, None, None] - top_db)
+
+
 def to_spect(wave, sr, window_size, window_stride, window):
     n_fft = int(sr * window_size)
-    win_length = n_fft
     hop_length = int(sr * window_stride)
-    spect_tensor = torch.Tensor()
 
-    # STFT
-    for i in range(wave.shape[0]):
-        y = wave[i].astype(float)
-        D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length,
-                         win_length=win_length, window=windows[window])
-        spect, phase = librosa.magphase(D)
-        spect = librosa.power_to_db(spect, ref=np.max)
-        spect = torch.from_numpy(spect).to(torch.float32)
-        spect_tensor = torch.cat((spect_tensor, spect.view(1, spect.size(0), -1)), 0)
+    window = windows[window.value if isinstance(window, SpectrogramWindow) else window]
+    spect = _stft_magnitude(_as_tensor(wave), n_fft, hop_length, _window(window, n_fft))
+    spect = _power_to_db(spect)
 
-    return spect_tensor.transpose(1, 2)
+    return spect.to(torch.float32).transpose(1, 2)
 
 
 def istft(spect, win_length, hop_length, window):
@@ -35,36 +65,29 @@ def istft(spect, win_length, hop_length, window):
 
 def logmel(wave, sr, window_size, window_stride, window, n_mels=300):
     n_fft = int(sr * window_size)
-    win_length = n_fft
     hop_length = int(sr * window_stride)
-    spect_tensor = torch.Tensor()
 
-    # STFT and mel filtering
-    for i in range(wave.shape[0]):
-        y = wave[i].astype(float)
-        logmel_spect = librosa.feature.melspectrogram(y, sr=sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels,
-                                                      win_length=win_length, window=window)
-        logmel_spect = librosa.power_to_db(logmel_spect, ref=np.max)
-        logmel_spect = torch.from_numpy(logmel_spect).to(torch.float32)
-        spect_tensor = torch.cat((spect_tensor, logmel_spect.view(1, logmel_spect.size(0), -1)), 0)
+    wave = _as_tensor(wave)
+    window = window.value if isinstance(window, SpectrogramWindow) else window
+    spect = _stft_magnitude(wave, n_fft, hop_length, _window(window, n_fft)) ** 2
+    logmel_spect = torch.matmul(_mel_basis(sr, n_fft, n_mels).to(device=wave.device, dtype=wave.dtype), spect)
+    logmel_spect = _power_to_db(logmel_spect)
 
-    return spect_tensor.transpose(1, 2)
+    return logmel_spect.to(torch.float32).transpose(1, 2)
 
 
 def cwt(wave, widths=np.arange(1, 31), sr=4000):
-    spect_tensor = torch.Tensor()
-
-    for i in range(wave.shape[0]):
-        y = wave[i].astype(float)
+    y = np.asarray(wave)
+    y = y if y.dtype == np.float32 else y.astype(float)
 
-        y = librosa.core.resample(y, orig_sr=sr, target_sr=400)
-        cwtmatr = signal.cwt(y, signal.ricker, widths)
-        # n_rows = cwtmatr.shape[0]
-        # cwtmatr = cwtmatr.reshape((-1, 200))
-        # cwtmatr = np.array([max(cwtmatr[i], key=abs) for i in range(cwtmatr.shape[0])]).reshape((n_rows, -1))
-        cwtmatr = torch.from_numpy(cwtmatr).to(torch.float32)
-        spect_tensor = torch.cat((spect_tensor, cwtmatr.view(1, cwtmatr.size(0), -1)), 0)
+    y = librosa.core.resample(y, orig_sr=sr, target_sr=400)  # Resamples all channels along the last axis
+    cwtmatr = np.empty((y.shape[0], len(widths), y.shape[1]), dtype=y.dtype)
+    for i, width in enumerate(widths):
+        # Same as signal.cwt(y[channel], signal.ricker, widths) applied to all channels per width
+        wavelet_data = signal.ricker(min(10 * width, y.shape[1]), width)[::-1].astype(y.dtype)
+        cwtmatr[:, i] = signal.fftconvolve(y, wavelet_data[None, :], mode='same', axes=-1)
 
+    spect_tensor = torch.from_numpy(cwtmatr).to(torch.float32)
     return spect_tensor.transpose(1, 2).reshape(1, -1, 4, spect_tensor.size(1)).mean(dim=2)
 
 
@@ -87,11 +110,8 @@ def standardize(y):
     return (y - y.mean()).div(y.std() + 0.001)
 
 
-def remove_power_noise(y, sr):
-    y = bandstop_filter(y, l_cutoff=117, h_cutoff=123, sr=sr)
-    y = bandstop_filter(y, l_cutoff=57, h_cutoff=63, sr=sr)
-    y = highpass_filter(y, l_cutoff=1, sr=sr)
-    return y
+def remove_power_noise(y, sr, freq=60.0):
+    return power_noise_filter(sr, freq)(y)
 
 
 def time_and_freq_mask(data, rate):
@@ -166,12 +186,63 @@ def add_white_noise(y, amp_rate, section_rate):
     return _add_noise_to_signal(orig_signal=y, noise_signal=white_noise, rate=section_rate)
 
 
+@lru_cache(maxsize=64)
+def design_sos(btype, cutoff, sr, order):
+    """Second-order sections of a Butterworth filter. cutoff is a (low, high) tuple for band filters"""
+    nyq = 0.5 * sr
+    return butter(order, np.asarray(cutoff) / nyq, btype=btype, output='sos')
+
+
+class FilterBank:
+    """
+    Cascade of Butterworth filters designed once and applied in a single sosfilt call.
+    Inputs are filtered along the last axis, so multichannel waves and batches of them are processed at once.
+
+    zero_phase: Filter forward and backward with sosfiltfilt instead of the causal sosfilt
+    """
+    def __init__(self, sr, zero_phase=False):
+        self.sr = sr
+        self.zero_phase = zero_phase
+        self.sections = []
+
+    def add(self, btype, cutoff, order):
+        cutoff = tuple(cutoff) if np.ndim(cutoff) else cutoff
+        self.sections.append(design_sos(btype, cutoff, self.sr, order))
+        return self
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __call__(self, y):
+        if not self.sections:
+            return y
+
+        sos = np.vstack(self.sections)
+        if self.zero_phase:
+            return sosfiltfilt(sos, y, axis=-1)
+        return sosfilt(sos, y, axis=-1)
+
+
+def power_noise_filter(sr, freq=60.0, n_harmonics=2, zero_phase=False):
+    """Notches at freq and its harmonics below the Nyquist frequency followed by a 1Hz high pass filter"""
+    filter_bank = FilterBank(sr, zero_phase)
+    for harmonic in range(1, n_harmonics + 1):
+        if freq * harmonic + 3 < 0.5 * sr:
+            filter_bank.add('bandstop', (freq * harmonic - 3, freq * harmonic + 3), order=6)
+    return filter_bank.add('highpass', 1, order=4)
+
+
+def bandpass_filter_bank(sr, l_cutoff, h_cutoff, zero_phase=False):
+    filter_bank = FilterBank(sr, zero_phase)
+    if h_cutoff:
+        filter_bank.add('lowpass', h_cutoff, order=4)
+    if l_cutoff:
+        filter_bank.add('highpass', l_cutoff, order=4)
+    return filter_bank
+
+
 def butter_filter(y, cutoff, fs, btype='lowpass', order=5):
-    nyq = 0.5 * fs
-    normal_cutoff = cutoff / nyq
-    b, a = butter(order, normal_cutoff, btype=btype, analog=False)
-    y = lfilter(b, a, y)
-    return y
+    return FilterBank(fs).add(btype, cutoff, order)(y)
 
 
 def lowpass_filter(y, h_cutoff, sr):
@@ -183,18 +254,8 @@ def highpass_filter(y, l_cutoff, sr):
 
 
 def bandpass_filter(y, l_cutoff, h_cutoff, sr):
-    if h_cutoff:
-        y = lowpass_filter(y, h_cutoff, sr)
-    if l_cutoff:
-        y = highpass_filter(y, l_cutoff, sr)
-    return y
+    return bandpass_filter_bank(sr, l_cutoff, h_cutoff)(y)
 
 
 def bandstop_filter(y, l_cutoff, h_cutoff, sr, order=6):
-    nyq = 0.5 * sr
-    low = l_cutoff / nyq
-    high = h_cutoff / nyq
-
-    b, a = butter(order, [low, high], btype='bandstop')
-    y = lfilter(b, a, y)
-    return y
+    return FilterBank(sr).add('bandstop', (l_cutoff, h_cutoff), order)(y)
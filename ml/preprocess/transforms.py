@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 import torch
 from torch import Tensor
@@ -22,52 +22,94 @@ class TransConfig:
     delta: int = 5  # Compute delta coefficients of a tensor, usually a spectrogram
 
 
-def _init_process(cfg, process):
+def _init_process(cfg, process, batched=False):
     if process == 'logmel':
         return MelSpectrogram(cfg.sample_rate, cfg.n_fft, cfg.win_length, cfg.hop_length, cfg.f_min, cfg.f_max, pad=0,
                               n_mels=cfg.n_mels)
     elif process == 'delta':
         return ComputeDeltas(cfg.delta)
     elif process == 'time_mask':
-        return TimeMasking(cfg.time_mask_len)
+        return TimeMasking(cfg.time_mask_len, iid_masks=batched)
     elif process == 'normalize':
-        return Normalize()
+        return Normalize(batched)
     else:
         raise NotImplementedError
 
 
 class Normalize(torch.nn.Module):
+    def __init__(self, batched: bool = False):
+        super(Normalize, self).__init__()
+        self.batched = batched
+
     def forward(self, x: Tensor):
+        if self.batched:    # Normalize each sample in the batch
+            dims = tuple(range(1, x.dim()))
+            return (x - x.mean(dim=dims, keepdim=True)) / x.std(dim=dims, keepdim=True)
         return (x - x.mean()) / x.std()
 
 
 class Transform(torch.nn.Module):
     # TODO GPU対応(Multiprocess対応, spawn)
     processes = {'logmel': MelSpectrogram, 'time_mask': TimeMasking, 'normalize': Normalize}
+    # Random processes. They are applied only on training and split off from the cacheable prefix
     only_train_processes = ['time_mask']
 
     def __init__(self,
                  cfg: Dict,
                  phase: str,
-                 process_order: List[str]) -> None:
+                 process_order: List[str],
+                 expand_dim: bool = True,
+                 batched: bool = False) -> None:
+        """
+        batched: Inputs are collated batches with the batch dimension first, instead of single samples
+        """
 
         super(Transform, self).__init__()
         self.phase = phase
         self.cfg = cfg
-        self.components = []
-        self._init_components(process_order)
+        self.process_order = [process for process in process_order
+                              if phase == 'train' or process not in self.only_train_processes]
+        self.expand_dim = expand_dim
+        self.batched = batched
+        self.components = torch.nn.ModuleList()
+        self._init_components(self.process_order)
+        self.deterministic = not set(self.process_order) & set(self.only_train_processes)
 
     def _init_components(self, process_order):
         for process in process_order:
-            if self.phase != 'train' and process in self.only_train_processes:
-                continue
-
             self.components.append(
-                _init_process(self.cfg, process)
+                _init_process(self.cfg, process, self.batched)
             )
 
+    def cache_key(self):
+        return f'{self.__class__.__name__}({self.cfg}, {self.process_order})'
+
+    def split(self) -> Tuple['Transform', 'Transform']:
+        """
+        Split into the longest deterministic prefix, whose outputs can be materialized once,
+        and the rest which has to run on every sample. The prefix has no components if the first process is random.
+        """
+        n_prefix = len(self.process_order)
+        for i, process in enumerate(self.process_order):
+            if process in self.only_train_processes:
+                n_prefix = i
+                break
+
+        prefix = Transform(self.cfg, self.phase, self.process_order[:n_prefix], expand_dim=False, batched=self.batched)
+        suffix = Transform(self.cfg, self.phase, self.process_order[n_prefix:], expand_dim=self.expand_dim,
+                           batched=self.batched)
+        return prefix, suffix
+
+    def output_length(self, lengths: Tensor) -> Tensor:
+        """Lengths along the time axis of outputs for inputs of lengths"""
+        for process in self.process_order:
+            if process == 'logmel':     # Frames of centered windows
+                lengths = lengths // self.cfg.hop_length + 1
+        return lengths
+
     def forward(self, x: Tensor):
         for component in self.components:
             x = component(x)
-        x = x.unsqueeze(dim=0)
+        if self.expand_dim:
+            x = x.unsqueeze(dim=1 if self.batched else 0)
         return x
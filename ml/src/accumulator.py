@@ -0,0 +1,67 @@
+from typing import Tuple, Union
+
+import numpy as np
+import torch
+
+Array = Union[np.ndarray, torch.Tensor]
+
+
+def _to_tensor(x: Array) -> torch.Tensor:
+    if isinstance(x, np.ndarray):
+        return torch.from_numpy(x)
+    return x.detach()
+
+
+class PredictionAccumulator:
+    """
+    Collects predictions and labels of each batch into buffers allocated once per epoch.
+    Buffers live on the device of the first batch and are copied to numpy only in compute().
+
+    n_samples: Expected number of samples, e.g. len(dataloader) * batch_size. Buffers grow by doubling if exceeded
+    chunk_size: Initial capacity when n_samples is unknown
+    """
+    def __init__(self, n_samples: int = 0, chunk_size: int = 4096):
+        self.n_samples = n_samples
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        # Buffers are dropped, not reused, so that arrays returned by compute() are never overwritten
+        self._preds = None
+        self._labels = None
+        self.n_filled = 0
+
+    def __len__(self):
+        return self.n_filled
+
+    @staticmethod
+    def _allocate(like: torch.Tensor, capacity: int) -> torch.Tensor:
+        return torch.empty((capacity, *like.shape[1:]), dtype=like.dtype, device=like.device)
+
+    def _grow(self, buffer: torch.Tensor, required: int) -> torch.Tensor:
+        grown = self._allocate(buffer, max(required, buffer.size(0) * 2))
+        grown[:self.n_filled] = buffer[:self.n_filled]
+        return grown
+
+    def update(self, preds: Array, labels: Array) -> None:
+        preds, labels = _to_tensor(preds), _to_tensor(labels).reshape(-1)
+        batch_size = preds.size(0)
+        required = self.n_filled + batch_size
+
+        if self._preds is None:
+            capacity = max(self.n_samples or self.chunk_size, batch_size)
+            self._preds = self._allocate(preds, capacity)
+            self._labels = self._allocate(labels, capacity)
+        elif required > self._preds.size(0):
+            self._preds = self._grow(self._preds, required)
+            self._labels = self._grow(self._labels, required)
+
+        self._preds[self.n_filled:required] = preds
+        self._labels[self.n_filled:required] = labels
+        self.n_filled = required
+
+    def compute(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._preds is None:
+            return np.array([]), np.array([])
+
+        return self._preds[:self.n_filled].cpu().numpy(), self._labels[:self.n_filled].cpu().numpy()
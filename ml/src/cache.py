@@ -0,0 +1,200 @@
+import functools
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import types
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+import torch
+
+from ml.utils.enums import CacheType
+
+logger = logging.getLogger(__name__)
+
+TENSOR_SUFFIX = '.pt.npy'
+ARRAY_SUFFIX = '.npy'
+
+
+class UnstableSignatureError(ValueError):
+    """Raised for objects which cannot be told apart from differently configured ones across runs"""
+
+
+def signature(obj: Any) -> str:
+    """
+    Stable description of a load function or transform used to namespace cache entries.
+    Objects can define cache_key() to describe themselves, closures are described by their captured values,
+    bound methods also by their instances, and functions, classes and modules by their qualified names.
+    Raises UnstableSignatureError for objects without cache_key() whose repr holds a memory address,
+    since it changes every run while their class alone does not tell their configurations apart.
+    """
+    if obj is None:
+        return ''
+    if hasattr(obj, 'cache_key'):
+        return obj.cache_key()
+    if isinstance(obj, (str, bytes, int, float, bool, complex)):
+        return repr(obj)
+    if isinstance(obj, (list, tuple)):
+        return f'({", ".join(signature(item) for item in obj)})'
+    if isinstance(obj, dict):
+        return f'{{{", ".join(f"{signature(k)}: {signature(v)}" for k, v in sorted(obj.items(), key=str))}}}'
+    if isinstance(obj, types.ModuleType):
+        return obj.__name__
+    if isinstance(obj, functools.partial):
+        return f'partial({signature(obj.func)}, {signature(obj.args)}, {signature(obj.keywords)})'
+    if isinstance(obj, types.MethodType):
+        return f'{signature(obj.__self__)}.{signature(obj.__func__)}'
+    if isinstance(obj, type):
+        return f'{obj.__module__}.{obj.__qualname__}'
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        cells = [cell.cell_contents for cell in (getattr(obj, '__closure__', None) or [])]
+        defaults = getattr(obj, '__defaults__', None)
+        return f'{obj.__module__}.{obj.__qualname__}{signature(cells)}{signature(defaults)}'
+
+    description = repr(obj)
+    if re.search(r' at 0x[0-9a-fA-F]+', description):
+        raise UnstableSignatureError(f'{type(obj).__qualname__} has no stable repr. '
+                                     f'Define cache_key() to describe its configuration in cache keys')
+    return description
+
+
+def _nbytes(value: Union[np.ndarray, torch.Tensor]) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    return value.nbytes
+
+
+class BaseCache:
+    """
+    namespace: Signature of the pipeline producing the entries, e.g. load_func and transform configs
+    max_bytes: Size cap of the cache
+    """
+    def __init__(self, namespace: str = '', max_bytes: int = 10 * 1024 ** 3):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+
+    def key(self, row) -> str:
+        row_str = '\t'.join(map(str, row))
+        return hashlib.sha1(f'{self.namespace}\n{row_str}'.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Union[np.ndarray, torch.Tensor]]:
+        raise NotImplementedError
+
+    def put(self, key: str, value: Union[np.ndarray, torch.Tensor]) -> None:
+        raise NotImplementedError
+
+
+class MemoryCache(BaseCache):
+    """
+    LRU cache of preprocessing outputs in RAM. Each DataLoader worker holds its own entries,
+    so this is effective with n_jobs=0 or persistent workers.
+    """
+    def __init__(self, namespace: str = '', max_bytes: int = 10 * 1024 ** 3):
+        super(MemoryCache, self).__init__(namespace, max_bytes)
+        self.entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[Union[np.ndarray, torch.Tensor]]:
+        value = self.entries.get(key)
+        if value is None:
+            return None
+
+        self.entries.move_to_end(key)
+        return value.clone() if isinstance(value, torch.Tensor) else value.copy()
+
+    def put(self, key: str, value: Union[np.ndarray, torch.Tensor]) -> None:
+        self.entries[key] = value
+        self.n_bytes += _nbytes(value)
+
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= _nbytes(evicted)
+
+
+class FeatureCache(BaseCache):
+    """
+    Content-addressed on-disk cache of deterministic preprocessing outputs.
+    One .npy file per sample, sharded into sub directories by key prefix. Entries are read with mmap and evicted
+    least-recently-used first when the total size exceeds max_bytes.
+
+    cache_dir: Root directory, shared by all datasets, folds and DataLoader workers
+    """
+    def __init__(self, cache_dir: Union[str, Path], namespace: str = '', max_bytes: int = 10 * 1024 ** 3):
+        super(FeatureCache, self).__init__(namespace, max_bytes)
+        self.cache_dir = Path(cache_dir).expanduser().resolve()
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.n_bytes = sum(path.stat().st_size for path in self._entries())
+
+    def _entries(self):
+        return self.cache_dir.glob(f'*/*{ARRAY_SUFFIX}')
+
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.cache_dir / key[:2] / f'{key}{suffix}'
+
+    def get(self, key: str) -> Optional[Union[np.ndarray, torch.Tensor]]:
+        for suffix in [TENSOR_SUFFIX, ARRAY_SUFFIX]:
+            path = self._path(key, suffix)
+            try:
+                # Copy-on-write mapping, since downstream transforms may modify inputs in place
+                value = np.load(path, mmap_mode='c')
+                os.utime(path)  # mtime is used as the LRU clock
+            except (FileNotFoundError, ValueError):
+                continue
+            return torch.from_numpy(value) if suffix == TENSOR_SUFFIX else value
+
+        return None
+
+    def put(self, key: str, value: Union[np.ndarray, torch.Tensor]) -> None:
+        is_tensor = isinstance(value, torch.Tensor)
+        array = value.detach().cpu().numpy() if is_tensor else np.asarray(value)
+        path = self._path(key, TENSOR_SUFFIX if is_tensor else ARRAY_SUFFIX)
+        path.parent.mkdir(exist_ok=True)
+
+        # Write to a temporary file and rename so that concurrent workers never read partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+        self.n_bytes += path.stat().st_size
+        if self.n_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_rate: float = 0.9) -> None:
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:   # Removed by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        self.n_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if self.n_bytes <= self.max_bytes * target_rate:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            self.n_bytes -= size
+
+        logger.debug(f'Feature cache evicted to {self.n_bytes / 1024 ** 2:.1f}MB')
+
+    def clear(self) -> None:
+        for path in self._entries():
+            path.unlink()
+        self.n_bytes = 0
+
+
+def make_cache(cfg, namespace: str) -> Optional[BaseCache]:
+    max_bytes = int(cfg.cache_size * 1024 ** 3)
+    if cfg.cache == CacheType.memory:
+        return MemoryCache(namespace, max_bytes)
+    elif cfg.cache == CacheType.disk:
+        return FeatureCache(cfg.cache_dir, namespace, max_bytes)
+    return None
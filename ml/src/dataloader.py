@@ -1,13 +1,19 @@
+import gc
+import logging
 from dataclasses import dataclass, field
+from functools import partial
 from typing import List
 
 import numpy as np
-import pandas as pd
 import torch
-from torch.utils.data import DataLoader
-from torch.utils.data.sampler import WeightedRandomSampler
+from torch.utils.data import DataLoader, DistributedSampler, IterableDataset
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.sampler import Sampler, WeightedRandomSampler
 
-from ml.utils.enums import TaskType
+from ml.src.distributed import get_rank, get_world_size, is_distributed
+from ml.utils.enums import TaskType, CacheType
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -18,41 +24,134 @@ class DataConfig:
     n_jobs: int = 4             # Number of workers used in data-loading
     sample_balance: List[float] = field(default_factory=lambda: [])  # Sampling label balance from dataset
     tta: int = 0  # Number of test time augmentation ensemble
+    cache: CacheType = CacheType.none   # Cache deterministic preprocessing outputs in memory or on disk
+    cache_dir: str = '../cache'     # Directory of the feature cache, shared among experiments
+    cache_size: float = 10.0    # Maximum size of the feature cache in GB
+    batch_transform: bool = False   # Apply transform to collated batches in the train manager, not per sample
+    stream_chunk_size: int = 10000  # Number of manifest rows read at once by streamed datasets
+    shuffle_buffer: int = 0     # Number of samples shuffled in the buffer of streamed datasets on training
+    bucketing: bool = False     # Batch samples of similar lengths and pad them only to the longest in each batch
+    length_column: int = -1     # Manifest column of sample lengths for bucketing. Measured and cached if -1
+    pad_dim: int = -1           # Dimension of samples padded in bucketing, i.e. the time dimension
+    device_prefetch: bool = False   # Pin batches and copy them to device one batch ahead of training
+    persistent_workers: bool = False    # Keep workers alive across epochs and cross validation folds
+    prefetch_factor: int = 2    # Number of batches loaded in advance by each worker
 
 
-def set_dataloader(dataset, phase, cfg, shuffle=False):
-    if phase != 'train':
-        dataloader = WrapperDataLoader(dataset, batch_size=cfg.batch_size, num_workers=cfg.n_jobs,
-                                       pin_memory=False, sampler=None, shuffle=False, drop_last=False)
+def _loader_kwargs(cfg, worker_init_fn=None):
+    kwargs = dict(num_workers=cfg.n_jobs, worker_init_fn=worker_init_fn)
+    if cfg.n_jobs > 0:
+        kwargs.update(persistent_workers=cfg.get('persistent_workers', False),
+                      prefetch_factor=cfg.get('prefetch_factor', 2))
+    device_prefetch = cfg.get('device_prefetch', False)
+    # Page-locked memory only helps copies to GPU
+    kwargs.update(device_prefetch=device_prefetch, pin_memory=device_prefetch and torch.cuda.is_available())
+    return kwargs
+
+
+def _balanced_sampling(dataset, cfg, indices=None):
+    """Sampling weights and number of samples in one epoch of the dataset, or of dataset[indices] if given"""
+    n_samples = len(dataset) if indices is None else len(indices)
+    if cfg.task_type.value != 'classify':
+        weights = torch.ones(n_samples, dtype=torch.double)
+    elif indices is None:
+        weights = make_weights_for_balanced_classes(dataset.get_labels(), cfg.sample_balance,
+                                                    getattr(dataset, 'get_class_index', lambda: None)())
     else:
-        if cfg.sample_balance:
-            if cfg.task_type.value == 'classify':
-                weights = make_weights_for_balanced_classes(dataset.get_labels(), cfg.sample_balance)
-            else:
-                weights = [torch.Tensor([1.0])] * len(dataset.get_labels())
-            sampler = WeightedRandomSampler(weights, int(len(dataset) * cfg.epoch_rate))
+        weights = make_weights_for_balanced_classes(np.asarray(dataset.get_labels())[indices], cfg.sample_balance)
+    return weights, int(n_samples * cfg.epoch_rate)
+
+
+def set_subset_indices(dataloader, phase, cfg, indices):
+    """
+    Swaps the subset sampled by a dataloader made with indices, e.g. for the next fold of cross validation.
+    The dataloader, and its workers if persistent, keep serving the same dataset.
+    """
+    if isinstance(dataloader.batch_sampler, BucketBatchSampler):
+        dataloader.batch_sampler.set_indices(indices)
+    elif phase == 'train' and cfg.sample_balance:
+        dataloader.sampler.set_indices(indices, *_balanced_sampling(dataloader.dataset, cfg, indices))
+    else:
+        dataloader.sampler.set_indices(indices)
+
+
+def set_dataloader(dataset, phase, cfg, shuffle=False, batch_transform=None, indices=None, worker_init_fn=None):
+    """
+    indices: Indices of dataset to load, which can be swapped later by set_subset_indices. All samples if None
+    worker_init_fn: Called with the worker id in each worker process on start
+
+    In distributed training, samples of train and val are split over processes by DistributedSampler, so that
+    val metrics are gathered by Metric.update. Test and infer load all samples in each process.
+    """
+    if cfg.get('bucketing', False) and hasattr(dataset, 'get_lengths'):
+        if batch_transform is not None and not hasattr(batch_transform, 'output_length'):
+            raise ValueError(f'Lengths of padded inputs cannot be converted by {type(batch_transform).__name__}. '
+                             f'Define output_length() of it or disable bucketing')
+        return set_bucket_dataloader(dataset, phase, cfg, batch_transform, indices, worker_init_fn)
+
+    # Streamed datasets split rows over processes by themselves, in the same number for each process
+    distributed = is_distributed() and phase in ['train', 'val'] and not isinstance(dataset, IterableDataset)
+    if distributed and (indices is not None or (phase == 'train' and cfg.sample_balance)):
+        logger.warning('Samples are not split over distributed processes with indices or sample_balance')
+        distributed = False
+
+    if distributed:
+        sampler = DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(),
+                                     shuffle=phase == 'train' and shuffle, drop_last=phase == 'train')
+        dataloader = WrapperDataLoader(dataset, batch_size=cfg.batch_size, sampler=sampler, drop_last=phase == 'train',
+                                       batch_transform=batch_transform, **_loader_kwargs(cfg, worker_init_fn))
+    elif indices is not None:
+        if isinstance(dataset, IterableDataset):
+            raise ValueError('Streamed datasets cannot be loaded by indices')
+        dataloader = WrapperDataLoader(dataset, batch_size=cfg.batch_size, drop_last=phase == 'train',
+                                       sampler=SubsetSampler(indices, shuffle=phase == 'train' and shuffle),
+                                       batch_transform=batch_transform, **_loader_kwargs(cfg, worker_init_fn))
+        set_subset_indices(dataloader, phase, cfg, indices)
+    elif phase != 'train':
+        dataloader = WrapperDataLoader(dataset, batch_size=cfg.batch_size, sampler=None, shuffle=False,
+                                       drop_last=False, batch_transform=batch_transform,
+                                       **_loader_kwargs(cfg, worker_init_fn))
+    else:
+        if cfg.sample_balance and isinstance(dataset, IterableDataset):
+            logger.warning('sample_balance is ignored for streamed datasets, which subsample by epoch_rate')
+            sampler = None
+        elif cfg.sample_balance:
+            sampler = WeightedRandomSampler(*_balanced_sampling(dataset, cfg))
         else:
             sampler = None
-        dataloader = WrapperDataLoader(dataset, batch_size=cfg.batch_size, num_workers=cfg.n_jobs,
-                                       pin_memory=False, sampler=sampler, drop_last=True, shuffle=shuffle)
+        dataloader = WrapperDataLoader(dataset, batch_size=cfg.batch_size, sampler=sampler, drop_last=True,
+                                       shuffle=shuffle, batch_transform=batch_transform,
+                                       **_loader_kwargs(cfg, worker_init_fn))
     return dataloader
 
 
-def set_ml_dataloader(dataset, phase, cfg, shuffle=False):
+def set_bucket_dataloader(dataset, phase, cfg, batch_transform=None, indices=None, worker_init_fn=None):
+    if cfg.sample_balance:
+        logger.warning('sample_balance is ignored with bucketing')
+    batch_sampler = BucketBatchSampler(dataset.get_lengths(), cfg.batch_size, drop_last=phase == 'train',
+                                       shuffle=phase == 'train', indices=indices)
+    return WrapperDataLoader(dataset, batch_sampler=batch_sampler, collate_fn=partial(pad_collate, dim=cfg.pad_dim),
+                             batch_transform=batch_transform, **_loader_kwargs(cfg, worker_init_fn))
+
+
+def set_ml_dataloader(dataset, phase, cfg, shuffle=False, indices=None, worker_init_fn=None):
     if phase in ['test', 'infer']:
         dataloader = WrapperDataLoader(dataset, batch_size=cfg.batch_size, num_workers=cfg.n_jobs,
-                                  pin_memory=True, sampler=None, shuffle=False, drop_last=False)
+                                  pin_memory=True, sampler=None if indices is None else SubsetSampler(indices),
+                                  shuffle=False, drop_last=False, worker_init_fn=worker_init_fn)
     else:
+        n_samples = len(dataset) if indices is None else len(indices)
         if sum(cfg.sample_balance) != 0.0:
-            if cfg.task_type.value == 'classify':
-                weights = make_weights_for_balanced_classes(dataset.get_labels(), cfg.sample_balance)
+            weights, n_samples = _balanced_sampling(dataset, cfg, indices)
+            if indices is None:
+                sampler = WeightedRandomSampler(weights, n_samples)
             else:
-                weights = [torch.Tensor([1.0])] * len(dataset.get_labels())
-            sampler = WeightedRandomSampler(weights, int(len(dataset) * cfg.epoch_rate))
+                sampler = SubsetSampler(indices, weights=weights, n_samples=n_samples)
         else:
-            sampler = None
-        dataloader = WrapperDataLoader(dataset, batch_size=len(dataset), num_workers=cfg.n_jobs,
-                                  pin_memory=True, sampler=sampler, shuffle=shuffle)
+            sampler = None if indices is None else SubsetSampler(indices, shuffle=shuffle)
+            shuffle = shuffle and indices is None
+        dataloader = WrapperDataLoader(dataset, batch_size=n_samples, num_workers=cfg.n_jobs,
+                                  pin_memory=True, sampler=sampler, shuffle=shuffle, worker_init_fn=worker_init_fn)
     return dataloader
 
 
@@ -61,31 +160,211 @@ def set_adda_dataloader(dataset, cfg):
                              pin_memory=True, drop_last=True, shuffle=True)
 
 
+class SubsetSampler(Sampler):
+    """
+    Samples indices of a subset of the dataset, which can be swapped between epochs by set_indices.
+    With weights, n_samples indices are drawn with replacement like WeightedRandomSampler.
+    """
+    def __init__(self, indices, shuffle=False, weights=None, n_samples=None):
+        self.shuffle = shuffle
+        self.set_indices(indices, weights, n_samples)
+
+    def set_indices(self, indices, weights=None, n_samples=None):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = weights
+        self.n_samples = len(self.indices) if n_samples is None else n_samples
+
+    def __iter__(self):
+        if self.weights is not None:
+            # Drawn from the numpy random state like shuffling, which spawning workers does not advance
+            p = np.asarray(self.weights, dtype=np.float64)
+            order = np.random.choice(len(self.indices), self.n_samples, p=p / p.sum())
+        elif self.shuffle:
+            order = np.random.permutation(len(self.indices))
+        else:
+            order = np.arange(len(self.indices))
+        return iter(self.indices[order].tolist())
+
+    def __len__(self):
+        return self.n_samples
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of samples with similar lengths. On shuffle, indices are shuffled, split into buckets of
+    bucket_size batches, sorted by length in each bucket and batched, and the batches are shuffled again.
+    Without shuffle, samples are batched in order so that predictions keep the order of the dataset.
+    """
+    def __init__(self, lengths, batch_size, drop_last=False, shuffle=True, bucket_size=100, indices=None):
+        self.all_lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.set_indices(np.arange(len(self.all_lengths)) if indices is None else indices)
+
+    def set_indices(self, indices):
+        """Batches only samples of indices"""
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.lengths = self.all_lengths[self.indices]
+
+    def _batches(self):
+        if not self.shuffle:
+            indices = np.arange(len(self.lengths))
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        indices = np.random.permutation(len(self.lengths))
+        n_bucket = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), n_bucket):
+            bucket = indices[start:start + n_bucket]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        return [batches[i] for i in np.random.permutation(len(batches))]
+
+    def __iter__(self):
+        for batch in self._batches():
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            yield self.indices[batch].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            # Buckets are batched separately, so each bucket may leave a short batch
+            n_bucket = self.batch_size * self.bucket_size
+            n_full, n_rest = divmod(len(self.lengths), n_bucket)
+            return n_full * self.bucket_size + n_rest // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def pad_collate(batch, dim=-1):
+    """
+    Pads inputs with zeros to the longest in the batch along dim and collates them.
+    Returns (inputs, labels, lengths), where lengths are the sizes of inputs along dim before padding.
+    """
+    inputs, labels = zip(*batch)
+    inputs = [torch.as_tensor(x) for x in inputs]
+    lengths = torch.tensor([x.size(dim) for x in inputs])
+    max_length = int(lengths.max())
+
+    padded = []
+    for x in inputs:
+        pad = [0, 0] * x.dim()
+        # F.pad takes pads from the last dimension
+        pad[2 * (x.dim() - 1 - dim % x.dim()) + 1] = max_length - x.size(dim)
+        padded.append(torch.nn.functional.pad(x, pad))
+
+    return torch.stack(padded), default_collate(labels), lengths
+
+
 class WrapperDataLoader(DataLoader):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, batch_transform=None, device_prefetch=False, **kwargs):
+        """
+        batch_transform: Transform applied by the train manager to whole batches yielded by this loader
+        device_prefetch: The train manager iterates this loader through DevicePrefetcher
+        """
         super(WrapperDataLoader, self).__init__(*args, **kwargs)
+        self.batch_transform = batch_transform
+        self.device_prefetch = device_prefetch
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            return super(WrapperDataLoader, self).__iter__()
+
+        # Objects existing when workers are forked are excluded from garbage collection in the workers.
+        # Otherwise collections write to every object header and workers copy the parent's heap page by page
+        gc.freeze()
+        try:
+            return super(WrapperDataLoader, self).__iter__()
+        finally:
+            gc.unfreeze()
+
+    def _transformed_size(self):
+        x = torch.as_tensor(self.dataset[0][0], dtype=torch.float)
+        with torch.no_grad():
+            return self.batch_transform(x.unsqueeze(dim=0))[0].size()
 
     def get_input_size(self):
+        if self.batch_transform:
+            return self._transformed_size()
         return self.dataset.get_feature_size()
 
     def get_image_size(self):
+        if self.batch_transform:
+            return self._transformed_size()[1:]
         return self.dataset.get_image_size()
 
     def get_n_channels(self):
+        if self.batch_transform:
+            return self._transformed_size()[0]
         return self.dataset.get_n_channels()
 
     def get_seq_len(self):
+        if self.batch_transform:
+            return self._transformed_size()[1]
         return self.dataset.get_seq_len()
 
 
-def make_weights_for_balanced_classes(labels, sample_balance):
-    labels = np.array(labels, dtype=int)
-    class_count = pd.Series(labels).value_counts().values
-    label_kind = list(set(labels))
-    weight_per_class = sum(class_count) / torch.Tensor(class_count)
-    if sample_balance == 'same':
-        weights = [torch.Tensor([1.0])] * len(labels)
-    else:
-        weights = [weight_per_class[label_kind.index(label)] * sample_balance[label_kind.index(label)] for label in labels]
+class DevicePrefetcher:
+    """
+    Iterates batches of a dataloader with inputs and labels already on device.
+    On GPU, copies of the next batch are issued with non_blocking on a side stream while the current batch is
+    used, which overlaps them with computation if the dataloader pins memory. On CPU, batches pass through as is.
+    Other items of batches, e.g. lengths of bucketing, stay on the host.
+    """
+    def __init__(self, dataloader, device, n_to_device=2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.n_to_device = n_to_device
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch):
+        with torch.cuda.stream(self.stream):
+            return [x.to(self.device, non_blocking=True) if i < self.n_to_device and torch.is_tensor(x) else x
+                    for i, x in enumerate(batch)]
+
+    def _wait(self, batch):
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        for x in batch[:self.n_to_device]:
+            if torch.is_tensor(x):
+                # Memory allocated on the side stream is not reused until the current stream is done with it
+                x.record_stream(torch.cuda.current_stream(self.device))
+        return batch
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.dataloader
+            return
+
+        batches = iter(self.dataloader)
+        try:
+            next_batch = self._to_device(next(batches))
+        except StopIteration:
+            return
+        for batch in batches:
+            current_batch = self._wait(next_batch)
+            next_batch = self._to_device(batch)
+            yield current_batch
+        yield self._wait(next_batch)
+
+
+def make_weights_for_balanced_classes(labels, sample_balance, class_index=None):
+    """
+    Sampling weight of each sample as one double tensor, inversely proportional to the count of its class and
+    scaled by sample_balance of the class. Classes are ordered as np.unique sorts them.
+
+    class_index: (classes, index of class of each sample) as returned by np.unique(labels, return_inverse=True)
+    """
+    if class_index is None:
+        class_index = np.unique(np.asarray(labels, dtype=int), return_inverse=True)
+    classes, inverse = class_index
+
+    if sample_balance in ['same', ['same']]:
+        return torch.ones(len(inverse), dtype=torch.double)
 
-    return weights
\ No newline at end of file
+    class_count = np.bincount(inverse, minlength=len(classes))
+    weight_per_class = len(inverse) / class_count * np.asarray(sample_balance, dtype=np.float64)[:len(classes)]
+    return torch.from_numpy(weight_per_class[inverse])
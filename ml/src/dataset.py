@@ -1,12 +1,40 @@
 import logging
 from abc import ABCMeta, abstractmethod
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from torch.utils.data import Dataset
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from ml.src.cache import UnstableSignatureError, make_cache, signature
+from ml.src.manifest import Manifest
+from ml.src.shards import load_index
+from ml.utils.enums import CacheType
 
 logger = logging.getLogger(__name__)
 
 
+def to_contiguous(values):
+    """
+    Numeric contiguous array of values. Object arrays hold a Python object per element, whose refcount updates
+    make forked DataLoader workers copy the whole array over time.
+    """
+    values = np.asarray(values)
+    if values.dtype == object:
+        try:
+            # Integers and integral strings stay int64, and others become float64
+            if values.ndim == 1:
+                values = pd.to_numeric(values)
+            else:
+                frame = pd.DataFrame(values.reshape(len(values), -1)).apply(pd.to_numeric)
+                values = frame.to_numpy().reshape(values.shape)
+        except (TypeError, ValueError):
+            logger.warning('Non-numeric values are kept as an object array, which workers copy on access')
+    return np.ascontiguousarray(values)
+
+
 class BaseDataSet(Dataset, metaclass=ABCMeta):
     def __init__(self):
         super(BaseDataSet, self).__init__()
@@ -19,12 +47,18 @@ class BaseDataSet(Dataset, metaclass=ABCMeta):
     def get_labels(self):
         pass
 
+    def get_class_index(self):
+        """Sorted classes and the class index of each sample, computed once for balanced sampling"""
+        if getattr(self, '_class_index', None) is None:
+            self._class_index = np.unique(np.asarray(self.get_labels(), dtype=int), return_inverse=True)
+        return self._class_index
+
 
 class SimpleCSVDataset(BaseDataSet):
     def __init__(self, df, y, phase):
         super(SimpleCSVDataset, self).__init__()
-        self.x = df.values
-        self.y = y.values
+        self.x = to_contiguous(df.values)
+        self.y = to_contiguous(y.values)
         self.phase = phase
 
     def __getitem__(self, idx):
@@ -69,8 +103,8 @@ class CSVDataSet(BaseDataSet):
         else:
             df = pd.read_csv(csv_path, header=cfg.get('header', 'infer'))
             if phase in ['train', 'val']:
-                self.y = df.iloc[:, -1]
-                self.x = df.iloc[:, :-1].values
+                self.y = to_contiguous(df.iloc[:, -1].values)
+                self.x = to_contiguous(df.iloc[:, :-1].values)
 
         self.transform = transform
 
@@ -106,53 +140,162 @@ class CSVDataSet(BaseDataSet):
         return 32
 
 
+class ShardedArrayDataSet(BaseDataSet):
+    def __init__(self, shard_dir, cfg=None, phase='train', load_func=None, transform=None, label_func=None):
+        """
+        Features and labels stored as memory-mapped shards by ml.src.shards.convert_csv.
+        Shards are opened lazily in each process and never pickled, so DataLoader workers share the page cache
+        instead of holding copies of the features. load_func and label_func are accepted for compatibility with
+        the other dataset classes and are not used.
+
+        """
+        super(ShardedArrayDataSet, self).__init__()
+        self.shard_dir = Path(shard_dir)
+        self.index = load_index(shard_dir)
+        self.phase = phase
+        self.transform = transform
+        self.offsets = np.cumsum([0] + [shard['n_rows'] for shard in self.index['shards']])
+        self.has_label = all('labels' in shard for shard in self.index['shards'])
+        self._shards = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def _open(self):
+        self._shards = [(np.load(self.shard_dir / shard['features'], mmap_mode='r'),
+                         np.load(self.shard_dir / shard['labels'], mmap_mode='r') if self.has_label else None)
+                        for shard in self.index['shards']]
+
+    def __getitem__(self, idx):
+        if self._shards is None:
+            self._open()
+        if idx < 0:
+            idx += len(self)
+
+        i_shard = np.searchsorted(self.offsets, idx, side='right') - 1
+        features, labels = self._shards[i_shard]
+        x = np.array(features[idx - self.offsets[i_shard]])
+        if self.transform:
+            x = self.transform(x)
+
+        if self.has_label:
+            return x, labels[idx - self.offsets[i_shard]].item()
+        return x
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get_feature_size(self):
+        if self.transform:
+            return self[0][0].shape[0] if self.has_label else self[0].shape[0]
+        return self.index['n_features']
+
+    def get_labels(self):
+        if not self.has_label:
+            return None
+        if self._shards is None:
+            self._open()
+        return np.concatenate([labels for _, labels in self._shards])
+
+    def get_n_channels(self):
+        return 1
+
+    def get_image_size(self):
+        return (self.index['n_features'],)
+
+
 class ManifestDataSet(BaseDataSet):
     # TODO 要テスト実装
     def __init__(self, manifest_path, cfg, phase='train', load_func=None, transform=None, label_func=None):
         """
         cfg: {
-            'load_func': Function to load data from manifest correctly,
+            'load_func': Function to load data from a manifest row, given as a tuple of column values,
             'labels': List of labels or None if it's made from path
-            'label_func': Function to extract labels from path or None if labels are given as 'labels'
+            'label_func': Function to extract labels from a row or None if labels are given as 'labels'.
+                          Functions decorated with ml.src.manifest.vectorized get all columns at once
+            'cache': Cache outputs of load_func and the deterministic prefix of transform in memory or on disk
         }
 
         """
         super(ManifestDataSet, self).__init__()
-        self.path_df = pd.read_csv(manifest_path, header=None)
+        # Kept in refcount-free arrays so that DataLoader workers do not copy the manifest page by page.
+        # A parsed Manifest can be given instead of the path, e.g. to share it among folds of cross validation
+        if isinstance(manifest_path, Manifest):
+            self.manifest = manifest_path
+        else:
+            self.manifest = Manifest.from_csv(manifest_path, header=None)
         if phase == 'test' and cfg.tta:
-            self.path_df = pd.concat([self.path_df] * cfg.tta)
+            self.manifest = self.manifest.take(np.tile(np.arange(len(self.manifest)), cfg.tta))
         self.load_func = load_func
         self.label_func = label_func
         if phase == 'infer':
-            self.labels = [-100] * len(self.path_df)
+            self.labels = np.full(len(self.manifest), -100, dtype=np.int64)
         else:
             self.labels = self._set_labels(cfg.labels if 'labels' in cfg.keys() else None)
         self.transform = transform
         self.phase = phase
+        self.cache = None
+        self.cached_transform, self.random_transform = None, transform
+        if cfg.get('cache', CacheType.none).value:
+            self._init_cache(cfg)
+
+    def _init_cache(self, cfg):
+        if hasattr(self.transform, 'split'):
+            self.cached_transform, self.random_transform = self.transform.split()
+            if self.cached_transform is not None and not getattr(self.cached_transform, 'components', True):
+                self.cached_transform = None
+        elif getattr(self.transform, 'deterministic', False):
+            self.cached_transform, self.random_transform = self.transform, None
+
+        try:
+            namespace = signature(self.load_func) + signature(self.cached_transform)
+        except UnstableSignatureError as e:
+            # Entries of other configurations would be served under the same keys
+            logger.warning(f'Feature cache is disabled. {e}')
+            self.cached_transform, self.random_transform = None, self.transform
+            return
+        self.cache = make_cache(cfg, namespace)
+
+    def get_row(self, idx):
+        return self.manifest.row(idx)
+
+    def _load(self, idx):
+        row = self.manifest.row(idx)
+        if not self.cache:
+            return self.load_func(row)
+
+        key = self.cache.key(row)
+        x = self.cache.get(key)
+        if x is None:
+            x = self.load_func(row)
+            if self.cached_transform:
+                x = self.cached_transform(x)
+            self.cache.put(key, x)
+
+        return x
 
     def __getitem__(self, idx):
-        x = self.load_func(self.path_df.iloc[idx, :])
+        x = self._load(idx)
         label = self.labels[idx]
 
-        if self.transform:
-            return self.transform(x), label
+        if self.random_transform:
+            return self.random_transform(x), label
 
         return x, label
 
     def __len__(self):
-        return self.path_df.shape[0]
+        return len(self.manifest)
 
     def _set_labels(self, labels=None):
-        if self.label_func:
-            return self.path_df.apply(self.label_func, axis=1)
-        else:
+        if not self.label_func:
             return labels
 
+        return self.manifest.labels(self.label_func)
+
     def get_feature_size(self):
-        x = self.load_func(self.path_df.iloc[0, :])
-        if self.transform:
-            x = self.transform(x)
-        return x.size()
+        return self[0][0].size()
 
     def get_labels(self):
         return self.labels
@@ -165,11 +308,174 @@ class ManifestDataSet(BaseDataSet):
 
 
 class ManifestWaveDataSet(ManifestDataSet):
-    def __init__(self, manifest_path, cfg, load_func=None, transform=None, label_func=None, phase='train'):
-        super(ManifestWaveDataSet, self).__init__(manifest_path, cfg, load_func, transform, label_func, phase)
+    def __init__(self, manifest_path, cfg, phase='train', load_func=None, transform=None, label_func=None):
+        super(ManifestWaveDataSet, self).__init__(manifest_path, cfg, phase, load_func, transform, label_func)
+        self.manifest_path = manifest_path
+        self.length_column = cfg.get('length_column', -1)
+        self.lengths = None
+
+    def _measure_lengths(self):
+        # In-memory manifests have no file to cache lengths next to
+        lengths_path = None if isinstance(self.manifest_path, Manifest) else Path(f'{self.manifest_path}.lengths.npy')
+        if lengths_path and lengths_path.exists() \
+                and lengths_path.stat().st_mtime >= Path(self.manifest_path).stat().st_mtime:
+            lengths = np.load(lengths_path)
+            if len(lengths) == len(self):
+                return lengths
+
+        logger.info(f'Measuring lengths of {len(self)} samples for bucketing')
+        lengths = np.array([np.shape(self.load_func(row))[-1] for row in self.manifest.rows()], dtype=np.int64)
+        if lengths_path:
+            np.save(lengths_path, lengths)
+        return lengths
+
+    def get_lengths(self):
+        """
+        Lengths of samples to sort them in bucketing, read from length_column of the manifest or measured on
+        outputs of load_func once and cached next to the manifest.
+        """
+        if self.lengths is None:
+            if self.length_column >= 0:
+                self.lengths = np.asarray(self.manifest.data[self.length_column], dtype=np.int64)
+            else:
+                self.lengths = self._measure_lengths()
+        return self.lengths
 
     def get_seq_len(self):
-        x = self.load_func(self.path_df.iloc[0, :])
+        return self[0][0].size(1)
+
+
+class IterableManifestWaveDataSet(IterableDataset, BaseDataSet):
+    def __init__(self, manifest_path, cfg, phase='train', load_func=None, transform=None, label_func=None):
+        """
+        Streams the manifest in chunks of cfg.stream_chunk_size rows instead of reading it up front.
+        Rows are striped over DataLoader workers and distributed processes. On training, cfg.epoch_rate of rows
+        are subsampled and shuffled within a buffer of cfg.shuffle_buffer samples.
+        In distributed training, every shard yields the same number of rows, truncated on training and padded
+        with its first rows otherwise, so that all processes run the same number of steps and collectives.
+
+        """
+        super(IterableManifestWaveDataSet, self).__init__()
+        self.manifest_path = manifest_path
+        self.load_func = load_func
+        self.transform = transform
+        self.label_func = label_func
+        self.phase = phase
+        self.chunk_size = cfg.get('stream_chunk_size', 10000)
+        self.shuffle_buffer = cfg.get('shuffle_buffer', 0) if phase == 'train' else 0
+        self.epoch_rate = cfg.get('epoch_rate', 1.0) if phase == 'train' else 1.0
+        self.n_repeats = cfg.tta if phase == 'test' and cfg.get('tta', 0) else 1
+        self.n_rows = self._count_rows()
+        self.epoch = 0
+
+    def _count_rows(self):
+        n_rows, last = 0, b'\n'
+        with open(self.manifest_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 ** 2), b''):
+                n_rows += block.count(b'\n')
+                last = block[-1:]
+        return n_rows + (last != b'\n')
+
+    @staticmethod
+    def _shard():
+        """Index and number of the shard read by this DataLoader worker of this process"""
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return rank, world_size
+        return rank * worker_info.num_workers + worker_info.id, world_size * worker_info.num_workers
+
+    def _labels(self, chunk):
+        if self.phase == 'infer' or not self.label_func:
+            return [-100] * len(chunk)
+        if getattr(self.label_func, 'vectorized', False):
+            return np.asarray(self.label_func(tuple(chunk[column].values for column in chunk.columns))).tolist()
+        return [self.label_func(row) for row in chunk.itertuples(index=False, name=None)]
+
+    def _n_shard_rows(self, shard, n_shards):
+        """Number of rows of the shard read in each repeat"""
+        n_rows = len(range(shard, self.n_rows, n_shards))
+        if dist.is_available() and dist.is_initialized():
+            n_rows = self.n_rows // n_shards if self.phase == 'train' else -(-self.n_rows // n_shards)
+        return n_rows
+
+    def _rows(self, rng):
+        shard, n_shards = self._shard()
+        n_shard_rows = self._n_shard_rows(shard, n_shards)
+        for _ in range(self.n_repeats):
+            n_left, n_select = n_shard_rows, int(n_shard_rows * self.epoch_rate)
+            head = None
+            offset = 0
+            for chunk in pd.read_csv(self.manifest_path, header=None, chunksize=self.chunk_size):
+                # Global row numbers keep striping consistent across chunk boundaries
+                chunk = chunk[(np.arange(offset, offset + len(chunk)) % n_shards) == shard][:n_left]
+                offset += self.chunk_size
+                head = chunk if head is None or head.empty else head
+                if self.epoch_rate < 1.0:
+                    # Exactly n_select rows of the shard are sampled over chunks
+                    n_taken = rng.hypergeometric(len(chunk), n_left - len(chunk), n_select) if n_select else 0
+                    n_left, n_select = n_left - len(chunk), n_select - n_taken
+                    chunk = chunk.iloc[np.sort(rng.choice(len(chunk), n_taken, replace=False))]
+                else:
+                    n_left -= len(chunk)
+                yield from zip(chunk.itertuples(index=False, name=None), self._labels(chunk))
+
+            if n_left > 0 and head is not None:
+                # Shards short of rows are padded with their first rows, as DistributedSampler does
+                head = head[:n_left]
+                yield from zip(head.itertuples(index=False, name=None), self._labels(head))
+
+    def _sample(self, row, label):
+        x = self.load_func(row)
         if self.transform:
             x = self.transform(x)
-        return x.size(1)
+        return x, label
+
+    def __iter__(self):
+        # initial_seed differs among workers and epochs, and epoch changes the order without workers
+        rng = np.random.default_rng([torch.initial_seed() % 2 ** 32, self.epoch])
+        self.epoch += 1
+
+        buffer = []
+        for row, label in self._rows(rng):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append((row, label))
+                continue
+            if self.shuffle_buffer:
+                i = rng.integers(self.shuffle_buffer)
+                buffer[i], (row, label) = (row, label), buffer[i]
+            yield self._sample(row, label)
+
+        rng.shuffle(buffer)
+        for row, label in buffer:
+            yield self._sample(row, label)
+
+    def __len__(self):
+        """Expected number of samples yielded by all workers of this process"""
+        world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        return int(self.n_rows * self.n_repeats * self.epoch_rate / world_size)
+
+    def _first_sample(self):
+        chunk = pd.read_csv(self.manifest_path, header=None, nrows=1)
+        return self._sample(next(chunk.itertuples(index=False, name=None)), None)[0]
+
+    def get_feature_size(self):
+        return self._first_sample().size()
+
+    def get_labels(self):
+        labels = []
+        for chunk in pd.read_csv(self.manifest_path, header=None, chunksize=self.chunk_size):
+            labels.extend(self._labels(chunk))
+        return np.array(labels * self.n_repeats)
+
+    def get_image_size(self):
+        return self.get_feature_size()[1:]
+
+    def get_n_channels(self):
+        return self.get_feature_size()[0]
+
+    def get_seq_len(self):
+        return self._first_sample().size(1)
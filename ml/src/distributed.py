@@ -0,0 +1,71 @@
+import logging
+import os
+from datetime import timedelta
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(backend=None, timeout_minutes=30) -> bool:
+    """
+    Joins the process group of processes launched by torchrun, which sets WORLD_SIZE, RANK and LOCAL_RANK.
+    The backend is nccl on GPU and gloo on CPU if not given. Does nothing in a single process or if already joined.
+    Returns whether this process is one of distributed processes.
+    """
+    if is_distributed():
+        return True
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 or not dist.is_available():
+        return False
+
+    backend = backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+    if backend == 'nccl':
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend, timeout=timedelta(minutes=timeout_minutes))
+    logger.info(f'Process {get_rank()} of {get_world_size()} joined with {backend}')
+    return True
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier() -> None:
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(values) -> np.ndarray:
+    """Sums of values over processes"""
+    tensor = torch.tensor(values, dtype=torch.float64)
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor)
+    return tensor.cpu().numpy()
+
+
+def all_gather_cat(x):
+    """Arrays or tensors of all processes concatenated along the first axis in the order of ranks"""
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, x)
+    if torch.is_tensor(x):
+        return torch.cat([torch.as_tensor(part) for part in gathered])
+    return np.concatenate(gathered)
@@ -153,7 +153,7 @@ def gradcam_main(cfg, dataloader, load_func):
     print(f'Ans\t\tPred')
     for i in range(10):
         # i = len(dataloader.dataset) - i - 1
-        wave = load_func(dataloader.dataset.path_df.iloc[i, :]).reshape((-1,))
+        wave = load_func(dataloader.dataset.get_row(i)).reshape((-1,))
         input_, label = dataloader.dataset[i]
         print(label, end='\t\t')
 
@@ -0,0 +1,112 @@
+from typing import Callable, Iterator, List, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+
+def vectorized(func: Callable) -> Callable:
+    """
+    Marks a label_func that also works on whole columns, e.g. lambda row: row[1].
+    ManifestDataSet then calls it once with the tuple of columns instead of once per row.
+    """
+    func.vectorized = True
+    return func
+
+
+class StringArray:
+    """
+    Strings packed into one contiguous utf-8 buffer with offsets.
+    Unlike object arrays, reading an element does not touch a per-element Python object, so pages of the buffer
+    stay shared with forked DataLoader workers instead of being copied on refcount updates.
+    """
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: Sequence) -> 'StringArray':
+        encoded = [str(string).encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8).copy(), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode()
+
+    def __iter__(self):
+        buffer, offsets = self.buffer.tobytes(), self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield buffer[start:end].decode()
+
+    def take(self, indices: np.ndarray) -> 'StringArray':
+        starts, lengths = self.offsets[indices], np.diff(self.offsets)[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return StringArray(self.buffer[positions], offsets)
+
+    def to_numpy(self) -> np.ndarray:
+        return np.array(list(self), dtype=object)
+
+
+class Manifest:
+    """
+    Columns of a manifest in refcount-free storage: numeric columns as numpy arrays and the others as StringArray.
+    Missing values in string columns are stored as 'nan'.
+    """
+    def __init__(self, columns: List, data: List[Union[np.ndarray, StringArray]]):
+        self.columns = columns
+        self.data = data
+        self._labels = {}
+
+    def __getstate__(self):
+        # Datasets hold their labels, and label_funcs as keys may not be picklable for workers
+        return {**self.__dict__, '_labels': {}}
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'Manifest':
+        data = []
+        for column in df.columns:
+            # Strings may be in object or in the string dtype of pandas
+            if pd.api.types.is_numeric_dtype(df[column]):
+                values = df[column].to_numpy()
+                if values.dtype == object:  # Nullable integers with missing values
+                    values = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+                data.append(np.ascontiguousarray(values))
+            else:
+                data.append(StringArray.from_strings(df[column].to_numpy(dtype=object)))
+        return cls(list(df.columns), data)
+
+    @classmethod
+    def from_csv(cls, path, header=None) -> 'Manifest':
+        return cls.from_frame(pd.read_csv(path, header=header))
+
+    def __len__(self):
+        return len(self.data[0]) if self.data else 0
+
+    def row(self, idx: int) -> tuple:
+        """Plain tuple of Python values, indexed by column position like row[0]"""
+        return tuple(column[idx] if isinstance(column, StringArray) else column[idx].item() for column in self.data)
+
+    def rows(self) -> Iterator[tuple]:
+        return zip(*[column if isinstance(column, StringArray) else column.tolist() for column in self.data])
+
+    def labels(self, label_func: Callable) -> np.ndarray:
+        """Labels of all rows, computed once per label_func and shared by all datasets made from this manifest"""
+        if label_func not in self._labels:
+            if getattr(label_func, 'vectorized', False):
+                self._labels[label_func] = np.asarray(label_func(tuple(self.data)))
+            else:
+                self._labels[label_func] = np.array([label_func(row) for row in self.rows()])
+        return self._labels[label_func]
+
+    def take(self, indices: Sequence[int]) -> 'Manifest':
+        indices = np.asarray(indices, dtype=np.int64)
+        return Manifest(self.columns, [column.take(indices) for column in self.data])
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({column: values.to_numpy() if isinstance(values, StringArray) else values
+                             for column, values in zip(self.columns, self.data)}, columns=self.columns)
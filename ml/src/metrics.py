@@ -3,6 +3,8 @@ import pandas as pd
 import torch
 from sklearn.metrics import recall_score, accuracy_score, f1_score, precision_score, balanced_accuracy_score, confusion_matrix
 
+from ml.src.distributed import all_gather_cat, all_reduce_sum, is_distributed
+
 
 ALLOWED_METRICS = ['loss', 'far', 'accuracy', 'f1', 'precision', 'uar', 'specificity']
 
@@ -75,13 +77,25 @@ class Metric:
     def add_average_meter(self, phase_name):
         self.average_meter[phase_name] = AverageMeter(self.direction)
 
+    def update_loss(self, loss_value, n_samples):
+        """Updates loss by loss_value summed over batches of n_samples samples in total"""
+        if is_distributed():
+            loss_value, n_samples = all_reduce_sum([loss_value, n_samples])
+        self.average_meter.update(loss_value / n_samples, int(n_samples))
+
     def update(self, loss_value, preds, labels):
+        """In distributed training, values are computed over batches of all processes"""
         if len(preds.shape) > 1:
             preds = np.argmax(preds, axis=1)
 
         if self.name == 'loss':
-            self.average_meter.update(loss_value / len(labels), len(labels))
-        elif 'recall' in self.name:
+            self.update_loss(loss_value, len(labels))
+            return
+
+        if is_distributed():
+            preds, labels = all_gather_cat(preds), all_gather_cat(labels)
+
+        if 'recall' in self.name:
             recall_label = int(self.name[-1])
             self.average_meter.update(recall(labels.copy(), preds.copy(), recall_label, self.numpy_))
         elif self.name == 'far':
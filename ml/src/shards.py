@@ -0,0 +1,85 @@
+import argparse
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+
+
+def shard_args(parser):
+    parser.add_argument('csv_path', help='CSV of features, with labels in the last column by default')
+    parser.add_argument('out_dir', help='Directory to write shards and index to')
+    parser.add_argument('--label-column', default=None, help='Column name of labels. The last column if not given')
+    parser.add_argument('--no-label', dest='has_label', action='store_false', help='CSV has no label column')
+    parser.add_argument('--no-header', dest='header', action='store_const', const=None, default='infer')
+    parser.add_argument('--shard-size', default=1000000, type=int, help='Number of rows per shard')
+    parser.add_argument('--chunk-size', default=100000, type=int, help='Number of rows read from CSV at once')
+    parser.add_argument('--dtype', default='float32', help='dtype of features')
+    return parser
+
+
+def _save_shard(out_dir, i_shard, features, labels):
+    shard = {'features': f'features_{i_shard:05d}.npy', 'n_rows': len(features)}
+    np.save(out_dir / shard['features'], features)
+    if labels is not None:
+        shard['labels'] = f'labels_{i_shard:05d}.npy'
+        np.save(out_dir / shard['labels'], labels)
+    return shard
+
+
+def convert_csv(csv_path, out_dir, label_column=None, has_label=True, header='infer', shard_size=1000000,
+                chunk_size=100000, dtype='float32'):
+    """
+    Converts a feature CSV to fixed-dtype .npy shards and an index.json describing them.
+    The CSV is read in chunks, so at most one shard is held in memory.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    shards, columns = [], None
+    features, labels, n_buffered = [], [], 0
+    for df in pd.read_csv(csv_path, header=header, chunksize=chunk_size):
+        if has_label:
+            label_column = df.columns[-1] if label_column is None else label_column
+            if not np.issubdtype(df[label_column].dtype, np.number):
+                raise ValueError(f'Labels must be numeric to be memory-mapped, but got {df[label_column].dtype}')
+            labels.append(df[label_column].values)
+            df = df.drop(columns=label_column)
+        columns = [str(column) for column in df.columns]
+        features.append(df.values.astype(dtype))
+        n_buffered += len(df)
+
+        while n_buffered >= shard_size:
+            feature_array, label_array = np.concatenate(features), np.concatenate(labels) if has_label else None
+            shards.append(_save_shard(out_dir, len(shards), feature_array[:shard_size],
+                                      label_array[:shard_size] if has_label else None))
+            features = [feature_array[shard_size:]]
+            labels = [label_array[shard_size:]] if has_label else []
+            n_buffered -= shard_size
+
+    if n_buffered:
+        shards.append(_save_shard(out_dir, len(shards), np.concatenate(features),
+                                  np.concatenate(labels) if has_label else None))
+
+    index = {'dtype': np.dtype(dtype).str, 'n_features': len(columns), 'columns': columns, 'shards': shards}
+    with open(out_dir / INDEX_FILE, 'w') as f:
+        json.dump(index, f, indent=4)
+
+    logger.info(f'Converted {sum(shard["n_rows"] for shard in shards)} rows into {len(shards)} shards in {out_dir}')
+    return index
+
+
+def load_index(shard_dir):
+    with open(Path(shard_dir) / INDEX_FILE) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert feature CSV to memory-mapped shards')
+    shard_conf = vars(shard_args(parser).parse_args())
+    convert_csv(**shard_conf)
@@ -1,13 +1,20 @@
 import logging
+import multiprocessing
 import tempfile
 from abc import ABCMeta
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
 from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
 from typing import Tuple, Dict, List
 
 import mlflow
 import numpy as np
 import pandas as pd
+import torch
+from torch.utils.data import IterableDataset
 
 from ml.models.train_managers.base_train_manager import TrainConfig
 from ml.models.train_managers.ml_train_manager import MLTrainManager
@@ -17,10 +24,13 @@ from ml.preprocess.parallel_transforms import ParallelTransform
 from ml.src.cv_manager import KFoldManager
 from ml.src.cv_manager import SupportedCV
 from ml.src.dataloader import DataConfig
-from ml.src.dataloader import set_dataloader, set_ml_dataloader
+from ml.src.dataloader import WrapperDataLoader, set_dataloader, set_ml_dataloader, set_subset_indices
+from ml.src.dataset import ManifestDataSet
+from ml.src.distributed import init_distributed, is_distributed
+from ml.src.manifest import Manifest
 from ml.src.metrics import get_metric_list
 from ml.utils.enums import TrainManagerType, DataLoaderType
-from ml.utils.utils import Metrics
+from ml.utils.utils import Metrics, init_seed
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +45,8 @@ class BaseExptConfig:
     n_seed_average: int = 0         # Seed averaging
     cv_name: SupportedCV = SupportedCV.none     # CV options
     n_splits: int = 0               # Number of splits on cv
+    n_parallel_folds: int = 1       # Number of cv folds run at once in separate processes
+    dist_backend: str = ''          # Backend of processes launched by torchrun. nccl on GPU and gloo on CPU if ''
     infer: bool = False             # Whether training with train+devel dataset after hyperparameter tuning
     test: bool = False  # Whether training with train+devel dataset after hyperparameter tuning
     data_loader: DataLoaderType = DataLoaderType.normal
@@ -60,7 +72,13 @@ def get_metrics(phases, task_type, train_manager='normal'):
 
 
 class BaseExperimentor(metaclass=ABCMeta):
-    def __init__(self, cfg, load_func, label_func, process_func=None, dataset_cls=None):
+    def __init__(self, cfg, load_func, label_func, process_func=None, dataset_cls=None, worker_init_fn=None,
+                 epoch_callbacks=None):
+        """
+        worker_init_fn: Called with the worker id in each DataLoader worker process on start
+        epoch_callbacks: Callbacks of train managers called with (epoch, {metric name: value}) of validation,
+            see ml.models.train_managers.callbacks
+        """
         self.cfg = cfg
         self.load_func = load_func
         self.label_func = label_func
@@ -69,23 +87,49 @@ class BaseExperimentor(metaclass=ABCMeta):
         self.train_manager_cls = TRAINMANAGERS[cfg.train_manager.value]
         self.train_manager = None
         self.process_func = process_func
+        self.worker_init_fn = worker_init_fn
+        self.epoch_callbacks = epoch_callbacks
         self.test = cfg.test
         self.infer = cfg.infer
-        
-    def _experiment(self, metrics, phases) -> Tuple[Metrics, Dict[str, np.array]]:
-        pred_list = {}
-
+        # Processes launched by torchrun join the process group, to train on samples split among them
+        init_distributed(cfg.get('dist_backend') or None)
+
+    def _set_dataset(self, manifest_path, phase):
+        process_func = self.process_func
+        if isinstance(process_func, list):
+            process_func = ParallelTransform(self.cfg.transformers, phase, process_func,
+                                             batched=self.cfg.data.batch_transform)
+
+        if self.cfg.data.batch_transform:
+            # Datasets yield raw inputs and the train manager transforms each collated batch
+            dataset = self.dataset_cls(manifest_path, self.cfg.data, phase, self.load_func, None, self.label_func)
+            return dataset, process_func
+
+        return self.dataset_cls(manifest_path, self.cfg.data, phase, self.load_func, process_func,
+                                self.label_func), None
+
+    def _set_dataloader(self, dataset, phase, batch_transform=None, indices=None):
+        kwargs = {'worker_init_fn': self.worker_init_fn}
+        if batch_transform:
+            kwargs['batch_transform'] = batch_transform
+        if indices is not None:
+            kwargs['indices'] = indices
+        return self.data_loader_cls(dataset, phase, self.cfg.data, **kwargs)
+
+    def _set_dataloaders(self, phases) -> Dict[str, WrapperDataLoader]:
         dataloaders = {}
         for phase in phases:
-            if isinstance(self.process_func, list):
-                self.process_func = ParallelTransform(self.cfg.transformers, phase, self.process_func)
+            dataset, batch_transform = self._set_dataset(self.cfg.train[f'{phase}_path'], phase)
+            dataloaders[phase] = self._set_dataloader(dataset, phase, batch_transform)
+        return dataloaders
 
-            dataset = self.dataset_cls(self.cfg.train[f'{phase}_path'], self.cfg.data, phase, self.load_func,
-                                       self.process_func, self.label_func)
-            dataloaders[phase] = self.data_loader_cls(dataset, phase, self.cfg.data)
+    def _experiment(self, metrics, phases) -> Tuple[Metrics, Dict[str, np.array]]:
+        pred_list = {}
+
+        dataloaders = self._set_dataloaders(phases)
 
         self.train_manager = self.train_manager_cls(self.cfg.train['class_names'], self.cfg.train, dataloaders,
-                                                    deepcopy(metrics))
+                                                    deepcopy(metrics), epoch_callbacks=self.epoch_callbacks)
         
         if 'val' in phases:
             metrics, pred_list['val'] = self.train_manager.train()
@@ -139,15 +183,33 @@ class BaseExperimentor(metaclass=ABCMeta):
             return metrics, np.array(pred_list).T.mean(axis=1)
 
 
+_fold_runner = None
+
+
+def fold_model_path(model_path: str, i: int) -> str:
+    path = Path(model_path)
+    return str(path.with_name(f'{path.stem}_fold{i}{path.suffix}'))
+
+
+def _run_fold_process(i):
+    return _fold_runner(i)
+
+
 class CrossValidator(BaseExperimentor):
     def __init__(self, cfg: Dict, load_func, label_func, process_func, dataset_cls, cv_name: str, n_splits: int,
-                 groups: str = None):
-        super().__init__(cfg, load_func, label_func, process_func, dataset_cls)
+                 groups: str = None, worker_init_fn=None, epoch_callbacks=None):
+        super().__init__(cfg, load_func, label_func, process_func, dataset_cls, worker_init_fn, epoch_callbacks)
         self.orig_cfg = deepcopy(self.cfg)
         self.cv_name = cv_name
         self.n_splits = n_splits
         self.groups = groups
         self.pred_list = []
+        self.manifest = None    # Manifest of all folds, parsed or saved as a file
+        self.fold_indices = {}
+        self._datasets = {}
+        self._dataloaders = {}
+        self._df_x = None
+        self._temp_dir = None
 
     def _save_path(self, df_x, train_idx, val_idx, temp_dir):
         df_x.iloc[train_idx, :].to_csv(f'{temp_dir}/train_manifest.csv', header=None, index=False)
@@ -155,6 +217,104 @@ class CrossValidator(BaseExperimentor):
         self.cfg.train[f'train_path'] = f'{temp_dir}/train_manifest.csv'
         self.cfg.train[f'val_path'] = f'{temp_dir}/val_manifest.csv'
 
+    def _set_dataloaders(self, phases) -> Dict[str, WrapperDataLoader]:
+        """
+        Dataloaders of the current fold. Datasets and dataloaders made for the previous folds are reused and only
+        the indices of train and val are swapped, so that persistent workers are not respawned for each fold.
+        """
+        if not self.fold_indices:   # Streamed datasets
+            return super()._set_dataloaders(phases)
+
+        for phase in phases:
+            indices = self.fold_indices.get(phase)
+            if phase in self._dataloaders and indices is not None and self.data_loader_cls is set_dataloader:
+                set_subset_indices(self._dataloaders[phase], phase, self.cfg.data, indices)
+            elif phase not in self._dataloaders or indices is not None:
+                if phase not in self._datasets:
+                    manifest = self.cfg.train[f'{phase}_path'] if indices is None else self.manifest
+                    self._datasets[phase] = self._set_dataset(manifest, phase)
+                dataset, batch_transform = self._datasets[phase]
+                self._dataloaders[phase] = self._set_dataloader(dataset, phase, batch_transform, indices)
+        return {phase: self._dataloaders[phase] for phase in phases}
+
+    @contextmanager
+    def _split(self):
+        """Sets up the manifest of all folds for the datasets and yields (train indices, val indices) of each fold"""
+        df_x = pd.concat([pd.read_csv(self.orig_cfg.train.train_path, header=None),
+                          pd.read_csv(self.orig_cfg.train.val_path, header=None)], ignore_index=True)
+        manifest = Manifest.from_frame(df_x)
+        # Computed once and shared with the datasets made from the manifest
+        y = manifest.labels(self.label_func)
+        logger.info(pd.Series(y).value_counts())
+
+        k_fold = KFoldManager(self.cv_name.value, self.n_splits)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._temp_dir = temp_dir
+            if issubclass(self.dataset_cls, IterableDataset):
+                self._df_x = df_x   # Streamed datasets are made from manifests of each fold
+            elif issubclass(self.dataset_cls, ManifestDataSet):
+                # Folds are indices of the parsed manifest, without writing and parsing manifests of each fold
+                self.manifest = manifest
+            else:
+                self.manifest = f'{temp_dir}/manifest.csv'
+                df_x.to_csv(self.manifest, header=None, index=False)
+
+            try:
+                yield list(k_fold.split(X=np.zeros(len(y)), y=y, groups=self.groups))
+            finally:
+                self.manifest, self.fold_indices, self._datasets, self._dataloaders = None, {}, {}, {}
+                self._df_x, self._temp_dir = None, None
+                self.cfg.train.train_path = self.orig_cfg.train.train_path
+                self.cfg.train.val_path = self.orig_cfg.train.val_path
+
+    def _run_fold(self, i, train_idx, val_idx, experiment, metrics):
+        logger.info(f'Fold {i + 1} started.')
+        # Seeded by fold, so that results do not depend on which process runs the fold
+        init_seed(self.cfg.train.model.get('seed', 0) + i)
+        if self._df_x is not None:
+            fold_dir = Path(self._temp_dir) / f'fold_{i}'
+            fold_dir.mkdir()
+            self._save_path(self._df_x, train_idx, val_idx, fold_dir)
+        else:
+            self.fold_indices = {'train': train_idx, 'val': val_idx}
+        return experiment(metrics)
+
+    def _run_folds(self, experiment, metrics) -> List[Tuple[np.array, Dict[str, np.array]]]:
+        """
+        Results of experiment(metrics) on each fold. With n_parallel_folds, folds are run in forked processes,
+        each of which reuses its own datasets and dataloaders for the folds it runs.
+        """
+        global _fold_runner
+        n_parallel = min(self.cfg.get('n_parallel_folds', 1), self.n_splits)
+        if n_parallel > 1 and is_distributed():
+            raise ValueError('n_parallel_folds cannot be used in distributed training')
+        if n_parallel > 1 and self.cfg.train.cuda and torch.cuda.is_initialized():
+            # Forked processes cannot use CUDA once this process has initialized it
+            raise ValueError('n_parallel_folds cannot be used after CUDA is initialized in this process, '
+                             'e.g. by previous experiments. Run them in another process or set n_parallel_folds 1')
+
+        with self._split() as splits:
+            if n_parallel <= 1:
+                return [self._run_fold(i, *split, experiment, metrics) for i, split in enumerate(splits)]
+
+            def run(i):
+                if self.cfg.train.cuda and torch.cuda.device_count() > 1:
+                    torch.cuda.set_device(i % torch.cuda.device_count())
+                # Folds running at once must not overwrite checkpoints of each other
+                self.cfg.train.model.model_path = fold_model_path(self.orig_cfg.train.model.model_path, i)
+                return self._run_fold(i, *splits[i], experiment, metrics)
+
+            # Forked processes inherit the runner, so experimentors, e.g. with lambda functions, are not pickled
+            _fold_runner = run
+            n_threads = max(1, torch.get_num_threads() // n_parallel)
+            try:
+                with ProcessPoolExecutor(n_parallel, mp_context=multiprocessing.get_context('fork'),
+                                         initializer=torch.set_num_threads, initargs=(n_threads,)) as executor:
+                    return list(executor.map(_run_fold_process, range(len(splits))))
+            finally:
+                _fold_runner = None
+
     def _set_metrics_df(self, metrics_df, result_list: List[float]):
         metrics_df = pd.concat([metrics_df.T, pd.Series(result_list)], axis=1).T
         assert metrics_df.shape[1] == len(result_list), metrics_df
@@ -162,28 +322,14 @@ class CrossValidator(BaseExperimentor):
 
     def train_with_validation(self, metrics: Metrics) -> Tuple[np.array, List[Dict[str, np.array]]]:
         pred_list = []
-        metric_df = pd.DataFrame()
-
-        df_x = pd.concat([pd.read_csv(self.orig_cfg.train.train_path, header=None),
-                          pd.read_csv(self.orig_cfg.train.val_path, header=None)])
-        y = df_x.apply(lambda x: self.label_func(x), axis=1)
-        logger.info(y.value_counts())
-        
-        k_fold = KFoldManager(self.cv_name.value, self.n_splits)
-
-        for i, (train_idx, val_idx) in enumerate(k_fold.split(X=df_x.values, y=y.values, groups=self.groups)):
-            logger.info(f'Fold {i + 1} started.')
-            with tempfile.TemporaryDirectory() as temp_dir:
-                self._save_path(df_x, train_idx, val_idx, temp_dir)
+        metrics_df = pd.DataFrame()
 
-                result_series, fold_pred_list = super().train_with_validation(metrics)
-                pred_list.append(fold_pred_list)
-                metrics_df = self._set_metrics_df(metric_df, result_series)
+        for result_series, fold_pred_list in self._run_folds(super().train_with_validation, metrics):
+            pred_list.append(fold_pred_list)
+            metrics_df = self._set_metrics_df(metrics_df, result_series)
 
         metrics_df.columns = [m.name for m in metrics['val']]
         logger.debug(f'Cross validation metrics:\n{metrics_df}')
-        self.cfg.train.train_path = self.orig_cfg.train.train_path
-        self.cfg.train.val_path = self.orig_cfg.train.val_path
 
         return metrics_df.mean(axis=0).values, pred_list
 
@@ -191,27 +337,13 @@ class CrossValidator(BaseExperimentor):
         pred_list = []
         metrics_df = pd.DataFrame()
 
-        df_x = pd.concat([pd.read_csv(self.orig_cfg.train.train_path, header=None),
-                          pd.read_csv(self.orig_cfg.train.val_path, header=None)])
-        y = df_x.apply(lambda x: self.label_func(x), axis=1)
-
-        logger.info(y.value_counts())
-
-        k_fold = KFoldManager(self.cv_name.value, self.n_splits)
-
-        for i, (train_idx, val_idx) in enumerate(k_fold.split(X=df_x.values, y=y.values, groups=self.groups)):
-            logger.info(f'Fold {i + 1} started.')
-            with tempfile.TemporaryDirectory() as temp_dir:
-                self._save_path(df_x, train_idx, val_idx, temp_dir)
-
-                result_series, fold_pred_list = super().experiment_with_validation(metrics, infer=infer)
-                pred_list.append(fold_pred_list)
-                metrics_df = self._set_metrics_df(metrics_df, result_series)
+        experiment = partial(super().experiment_with_validation, infer=infer)
+        for result_series, fold_pred_list in self._run_folds(experiment, metrics):
+            pred_list.append(fold_pred_list)
+            metrics_df = self._set_metrics_df(metrics_df, result_series)
 
         metrics_df.columns = [m.name for m in metrics['val' if self.infer else 'test']]
         logger.debug(f'Cross validation metrics:\n{metrics_df}')
-        self.cfg.train.train_path = self.orig_cfg.train.train_path
-        self.cfg.train.val_path = self.orig_cfg.train.val_path
 
         return metrics_df.mean(axis=0).values, pred_list
 
@@ -219,12 +351,14 @@ class CrossValidator(BaseExperimentor):
         raise NotImplementedError
 
 
-def typical_train(expt_conf, load_func, label_func, process_func, dataset_cls, groups, metrics_names=None):
+def typical_train(expt_conf, load_func, label_func, process_func, dataset_cls, groups, metrics_names=None,
+                  epoch_callbacks=None):
     if expt_conf['cv_name'] and expt_conf['cv_name'].value:
         experimentor = CrossValidator(expt_conf, load_func, label_func, process_func, dataset_cls, expt_conf['cv_name'],
-                                      expt_conf['n_splits'], groups)
+                                      expt_conf['n_splits'], groups, epoch_callbacks=epoch_callbacks)
     else:
-        experimentor = BaseExperimentor(expt_conf, load_func, label_func, process_func, dataset_cls)
+        experimentor = BaseExperimentor(expt_conf, load_func, label_func, process_func, dataset_cls,
+                                        epoch_callbacks=epoch_callbacks)
 
     phases = ['train', 'val']
 
@@ -240,13 +374,15 @@ def typical_train(expt_conf, load_func, label_func, process_func, dataset_cls, g
     return result_series, val_pred, experimentor
 
 
-def typical_experiment(expt_conf, load_func, label_func, process_func, dataset_cls, groups, metrics_names=None):
+def typical_experiment(expt_conf, load_func, label_func, process_func, dataset_cls, groups, metrics_names=None,
+                       epoch_callbacks=None):
     infer = 'infer_path' in expt_conf.keys()
     if expt_conf['cv_name'].value:
         experimentor = CrossValidator(expt_conf, load_func, label_func, process_func, dataset_cls, expt_conf['cv_name'],
-                                      expt_conf['n_splits'], groups)
+                                      expt_conf['n_splits'], groups, epoch_callbacks=epoch_callbacks)
     else:
-        experimentor = BaseExperimentor(expt_conf, load_func, label_func, process_func, dataset_cls)
+        experimentor = BaseExperimentor(expt_conf, load_func, label_func, process_func, dataset_cls,
+                                        epoch_callbacks=epoch_callbacks)
 
     phases = ['train', 'val', 'infer'] if infer else ['train', 'val', 'test']
 
@@ -0,0 +1,252 @@
+import itertools
+import logging
+import multiprocessing
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from copy import deepcopy
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import mlflow
+import numpy as np
+import optuna
+import pandas as pd
+import torch
+from optuna.distributions import CategoricalDistribution
+from optuna.storages.journal import JournalFileBackend, JournalStorage
+from optuna.trial import TrialState
+
+from ml.models.train_managers.callbacks import Callback
+from ml.src.distributed import is_distributed
+from ml.src.metrics import get_metric_list
+from ml.tasks.base_experiment import get_metrics, typical_train
+from ml.utils.enums import SearchType, PrunerType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SearchConfig:
+    search_type: SearchType = SearchType.grid   # Search all patterns, or sample them randomly or by TPE
+    n_trials: int = 0           # Number of trials of random and tpe search. The number of all patterns if 0
+    pruner: PrunerType = PrunerType.none    # Stop trials worse than others by validation metrics of each epoch
+    n_warmup_epochs: int = 5    # Number of epochs trials run before being pruned
+    n_parallel: int = 1         # Number of trials run at once in forked processes
+    seed: int = 0               # Seed of random and tpe samplers
+
+
+def set_hyperparameter(expt_conf, param, param_value):
+    if len(param.split('.')) == 1:
+        expt_conf[param] = param_value
+    else:
+        tmp = expt_conf
+        for attr in param.split('.')[:-1]:
+            tmp = getattr(tmp, str(attr))
+        setattr(tmp, param.split('.')[-1], param_value)
+
+    return expt_conf
+
+
+def _choices(values):
+    # optuna suggests only primitive values, so others, e.g. lists, are suggested by their indices
+    if all(value is None or isinstance(value, (bool, int, float, str)) for value in values):
+        return list(values)
+    return list(range(len(values)))
+
+
+def _to_pattern(params, hyperparameters) -> Dict:
+    """Hyperparameter values of params suggested by optuna"""
+    return {param: params[param] if _choices(values) == list(values) else values[params[param]]
+            for param, values in hyperparameters.items()}
+
+
+def _suggest(trial, hyperparameters) -> Dict:
+    params = {param: trial.suggest_categorical(param, _choices(values)) for param, values in hyperparameters.items()}
+    return _to_pattern(params, hyperparameters)
+
+
+def _pattern_name(pattern):
+    return '_'.join([str(value).replace('/', '-') for value in pattern.values()])
+
+
+def _make_sampler(cfg, hyperparameters):
+    if cfg.search_type == SearchType.grid and cfg.n_parallel > 1:
+        # Grid points are enqueued by _enqueue_grid, since GridSampler stops studies only inside study.optimize
+        return optuna.samplers.RandomSampler(seed=cfg.seed)
+    elif cfg.search_type == SearchType.grid:
+        search_space = {param: _choices(values) for param, values in hyperparameters.items()}
+        return optuna.samplers.GridSampler(search_space, seed=cfg.seed)
+    elif cfg.search_type == SearchType.random:
+        return optuna.samplers.RandomSampler(seed=cfg.seed)
+    elif cfg.search_type == SearchType.tpe:
+        return optuna.samplers.TPESampler(seed=cfg.seed)
+    raise NotImplementedError(f'{cfg.search_type} search is not supported')
+
+
+def _enqueue_grid(study, hyperparameters, seed):
+    """Enqueues all patterns of hyperparameters to study in a random order, as GridSampler runs them"""
+    grid = list(itertools.product(*[_choices(values) for values in hyperparameters.values()]))
+    for i in np.random.RandomState(seed).permutation(len(grid)):
+        study.enqueue_trial(dict(zip(hyperparameters.keys(), grid[i])))
+
+
+def _make_pruner(cfg):
+    if cfg.pruner == PrunerType.median:
+        return optuna.pruners.MedianPruner(n_warmup_steps=cfg.n_warmup_epochs)
+    elif cfg.pruner == PrunerType.asha:
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=cfg.n_warmup_epochs)
+    return optuna.pruners.NopPruner()
+
+
+class PruningCallback(Callback):
+    """
+    Epoch callback of train managers, which reports a validation metric of each epoch to an optuna trial and
+    aborts the trial if the pruner judges it worse than others. Epochs of cross validation folds are reported in order.
+    """
+    def __init__(self, trial, metric_name):
+        self.trial = trial
+        self.metric_name = metric_name
+        self.step = 0
+
+    def on_epoch_end(self, epoch, values):
+        self.trial.report(values[self.metric_name], self.step)
+        self.step += 1
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f'Trial {self.trial.number} pruned at epoch {epoch + 1}')
+        return False
+
+
+_trial_runner = None
+
+
+def _run_trial_process(trial_id):
+    return _trial_runner(trial_id)
+
+
+def _optimize_in_processes(study, run_trial: Callable, distributions: Dict, n_trials: int, n_parallel: int,
+                           score: Callable, cuda: bool) -> Dict:
+    """
+    Runs run_trial of n_trials trials, n_parallel at once in forked processes, each with its own random states,
+    CUDA device and mlflow runs. Trials are asked and told in this process, so that samplers see trials in order
+    and grid points are not run twice, and the processes report to pruners through the storage of study.
+    Returns outputs of run_trial of trials not pruned by their numbers.
+    """
+    global _trial_runner
+    if is_distributed():
+        raise ValueError('search.n_parallel cannot be used in distributed training')
+    if cuda and torch.cuda.is_initialized():
+        # Forked processes cannot use CUDA once this process has initialized it
+        raise ValueError('search.n_parallel cannot be used after CUDA is initialized in this process')
+
+    def run(trial_id):
+        if cuda and torch.cuda.device_count() > 1:
+            torch.cuda.set_device(trial_id % torch.cuda.device_count())
+        return run_trial(optuna.trial.Trial(study, trial_id))
+
+    # Forked processes inherit the runner, so load_func and others, e.g. lambda functions, are not pickled
+    _trial_runner = run
+    results, running = {}, {}
+    n_asked = 0
+    try:
+        with ProcessPoolExecutor(n_parallel, mp_context=multiprocessing.get_context('fork')) as executor:
+            while running or n_asked < n_trials:
+                while n_asked < n_trials and len(running) < n_parallel:
+                    trial = study.ask(distributions)
+                    running[executor.submit(_run_trial_process, trial._trial_id)] = trial
+                    n_asked += 1
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial = running.pop(future)
+                    try:
+                        results[trial.number] = future.result()
+                    except optuna.TrialPruned:
+                        study.tell(trial, state=TrialState.PRUNED)
+                        continue
+                    except Exception:
+                        study.tell(trial, state=TrialState.FAIL)
+                        raise
+                    study.tell(trial, score(results[trial.number]))
+    finally:
+        _trial_runner = None
+    return results
+
+
+def search(cfg, hyperparameters: Dict[str, List], load_func, label_func, process_func, dataset_cls, groups=None,
+           metrics_names=None, expt_dir=None) -> Tuple[pd.DataFrame, List[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Searches hyperparameters by typical_train as configured by cfg.search.
+
+    hyperparameters: Candidate values of config keys, e.g. {'train.model.optim.lr': [1e-3, 1e-4]}
+    expt_dir: Directory to save models of trials into, named after their hyperparameters
+    Returns validation metrics of trials with their hyperparameters, NaN for pruned ones, and (metrics, predictions)
+    returned by typical_train of each trial, None for pruned ones.
+    """
+    if metrics_names:
+        val_metrics = get_metric_list(metrics_names['val'])
+    else:
+        val_metrics = get_metrics(['val'], cfg.train.task_type.value, cfg['train_manager'])['val']
+    # Trials are compared by the metric models are saved by, or the first one
+    target = next((metric for metric in val_metrics if metric.save_model), val_metrics[0])
+
+    n_patterns = int(np.prod([len(values) for values in hyperparameters.values()]))
+    n_trials = cfg.search.n_trials or n_patterns
+    if cfg.search.search_type == SearchType.grid:
+        n_trials = min(n_trials, n_patterns)
+
+    def run_trial(trial) -> Tuple[Dict, np.ndarray, np.ndarray]:
+        pattern = _suggest(trial, hyperparameters)
+        trial_cfg = deepcopy(cfg)
+        for param, value in pattern.items():
+            trial_cfg = set_hyperparameter(trial_cfg, param, value)
+        if expt_dir:
+            trial_cfg.train.model.model_path = str(Path(expt_dir) / f'{_pattern_name(pattern)}.pth')
+            trial_cfg.train.log_id = _pattern_name(pattern)
+
+        callbacks = [PruningCallback(trial, target.name)] if cfg.search.pruner != PrunerType.none else None
+        with mlflow.start_run(nested=mlflow.active_run() is not None):
+            mlflow.log_params({param: str(value) for param, value in pattern.items()})
+            result_series, val_pred, _ = typical_train(trial_cfg, load_func, label_func, process_func, dataset_cls,
+                                                       groups, metrics_names, epoch_callbacks=callbacks)
+        return pattern, result_series, val_pred
+
+    def score(result):
+        return result[1][[metric.name for metric in val_metrics].index(target.name)]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Processes of parallel trials share the study through a journal file
+        storage = JournalStorage(JournalFileBackend(f'{temp_dir}/journal.log')) if cfg.search.n_parallel > 1 else None
+        study = optuna.create_study(direction=target.direction, storage=storage,
+                                    sampler=_make_sampler(cfg.search, hyperparameters), pruner=_make_pruner(cfg.search))
+        if cfg.search.n_parallel > 1:
+            if cfg.search.search_type == SearchType.grid:
+                _enqueue_grid(study, hyperparameters, cfg.search.seed)
+            distributions = {param: CategoricalDistribution(_choices(values))
+                             for param, values in hyperparameters.items()}
+            results = _optimize_in_processes(study, run_trial, distributions, n_trials, cfg.search.n_parallel, score,
+                                             cfg.train.cuda)
+        else:
+            results = {}
+
+            def objective(trial):
+                results[trial.number] = run_trial(trial)
+                return score(results[trial.number])
+
+            study.optimize(objective, n_trials=n_trials)
+        trials = study.trials
+
+    rows, result_pred_list = [], []
+    for trial in trials:
+        if trial.number in results:
+            pattern, result_series, val_pred = results[trial.number]
+            rows.append([*pattern.values(), *result_series])
+            result_pred_list.append((result_series, val_pred))
+        else:
+            logger.info(f'Trial {trial.number} {trial.state.name.lower()}')
+            pattern = _to_pattern(trial.params, hyperparameters)
+            rows.append([*pattern.values(), *[np.nan] * len(val_metrics)])
+            result_pred_list.append(None)
+
+    val_results = pd.DataFrame(rows, columns=list(hyperparameters.keys()) + [metric.name for metric in val_metrics])
+    return val_results, result_pred_list
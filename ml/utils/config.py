@@ -12,6 +12,7 @@ from ml.models.nn_models.panns_cnn14 import PANNsConfig
 from ml.models.nn_models.pretrained_models import PretrainedConfig
 from ml.models.nn_models.rnn import RNNConfig
 from ml.tasks.base_experiment import BaseExptConfig
+from ml.tasks.search import SearchConfig
 from ml.utils.nn_config import SGDConfig, AdamConfig
 
 nn_model_list = [('nn', NNConfig), ('cnn', CNNConfig), ('rnn', RNNConfig), ('cnn_rnn', CNNRNNConfig)]
@@ -34,6 +35,7 @@ defaults = [
 @dataclass
 class ExptConfig(BaseExptConfig):
     defaults: List[Any] = field(default_factory=lambda: defaults)
+    search: SearchConfig = field(default_factory=SearchConfig)
 
 
 def before_hydra(config_class):
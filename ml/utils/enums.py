@@ -100,6 +100,25 @@ class RNNType(Enum):
     gru = 'gru'
 
 
+class PoolingType(Enum):
+    none = ''
+    mean = 'mean'
+    max = 'max'
+    attention = 'attention'
+
+
+class SearchType(Enum):
+    grid = 'grid'
+    random = 'random'
+    tpe = 'tpe'
+
+
+class PrunerType(Enum):
+    none = ''
+    median = 'median'
+    asha = 'asha'
+
+
 class LossType(Enum):
     mse = 'mse'
     ce = 'ce'
@@ -120,3 +139,9 @@ class TrainManagerType(Enum):
 class DataLoaderType(Enum):
     normal = 'normal'
     ml = 'ml'
+
+
+class CacheType(Enum):
+    none = ''
+    memory = 'memory'
+    disk = 'disk'
@@ -37,9 +37,12 @@ class NNModelConfig(ModelConfig, StackedModelConfig):
     in_channels: int = 0
     attention: bool = False
     grad_clip: List[float] = field(default_factory=lambda: [])
+    grad_accum_steps: int = 1  # Number of batches whose gradients are accumulated into one update
+    checkpoint_segments: int = 0  # Recompute activations of backbones in this many segments in backward. 0 to keep
     loss_config: LossConfig = LossConfig()
     checkpoint_path: str = ''  # Model weight file to load model
-    amp: bool = False  # Mixed precision training
+    amp: bool = False  # Mixed precision training, in bfloat16 on CPU and float16 on GPU
+    apex: bool = False  # Mixed precision by apex amp instead of torch.autocast, if amp. Requires apex
 
     cuda: bool = True  # Use cuda to train a model
     optim: Any = MISSING
@@ -0,0 +1,158 @@
+import tempfile
+import unittest
+
+import torch
+from omegaconf import OmegaConf
+
+from ml.models.nn_models.cnn_rnn import CNNRNNConfig
+from ml.models.train_managers.base_train_manager import TrainConfig
+from ml.models.train_managers.callbacks import Callback, EarlyStopping, ExternalStopping, PlateauStopping
+from ml.models.train_managers.nn_train_manager import NNTrainManager
+from ml.src.dataloader import DataConfig, set_dataloader
+from ml.src.dataset import BaseDataSet
+from ml.src.metrics import get_metric_list
+from ml.utils.nn_config import AdamConfig
+
+
+class ImageDataSet(BaseDataSet):
+    def __init__(self, n=32):
+        super(ImageDataSet, self).__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.x = torch.randn(n, 1, 16, 16, generator=generator)
+        self.y = (self.x.mean(dim=(1, 2, 3)) > 0).long()
+
+    def __getitem__(self, idx):
+        return self.x[idx], self.y[idx]
+
+    def __len__(self):
+        return len(self.x)
+
+    def get_feature_size(self):
+        return self.x.shape[1:]
+
+    def get_labels(self):
+        return self.y.numpy()
+
+    def get_image_size(self):
+        return self.x.shape[2:]
+
+    def get_n_channels(self):
+        return 1
+
+
+class WeightRecorder(Callback):
+    """Records weights of the model after each epoch"""
+    def __init__(self, model_manager):
+        self.model_manager = model_manager
+        self.weights = []
+
+    def on_train_begin(self):
+        self.weights = []
+
+    def on_epoch_end(self, epoch, values):
+        self.weights.append({key: value.clone() for key, value in self.model_manager.model.state_dict().items()})
+        return False
+
+
+def stopped_epoch(callback, values, metric_name='loss'):
+    callback.on_train_begin()
+    for epoch, value in enumerate(values):
+        if callback.on_epoch_end(epoch, {metric_name: value}):
+            return epoch
+    return None
+
+
+class TestCallbacks(unittest.TestCase):
+
+    def test_early_stopping(self):
+        test_pattern = [
+            {'description': 'Improving', 'direction': 'minimize', 'values': [5, 4, 3, 2, 1], 'expected': None},
+            {'description': 'No improvement for patience', 'direction': 'minimize', 'values': [5, 4, 4.5, 4, 6],
+             'expected': 4},
+            {'description': 'Improvement within min_delta', 'direction': 'minimize', 'values': [5, 4.95, 4.92, 4.91],
+             'expected': 3, 'min_delta': 0.1},
+            {'description': 'Maximize', 'direction': 'maximize', 'values': [0.5, 0.6, 0.4, 0.5, 0.6], 'expected': 4},
+            {'description': 'Diverged', 'direction': 'minimize', 'values': [5, float('nan')], 'expected': 1},
+        ]
+        for test_case in test_pattern:
+            callback = EarlyStopping('loss', test_case['direction'], patience=3,
+                                     min_delta=test_case.get('min_delta', 0.0))
+            with self.subTest(test_case['description']):
+                self.assertEqual(stopped_epoch(callback, test_case['values']), test_case['expected'])
+
+    def test_reset_on_train_begin(self):
+        callback = EarlyStopping('loss', 'minimize', patience=2)
+        self.assertEqual(stopped_epoch(callback, [1, 2, 3]), 2)
+        # State of the previous training, e.g. a cross validation fold, does not carry over
+        self.assertEqual(stopped_epoch(callback, [3, 2, 1]), None)
+
+    def test_plateau_stopping(self):
+        test_pattern = [
+            {'description': 'Plateau', 'values': [1.0, 0.5, 0.5, 0.5001, 0.5], 'expected': 4},
+            {'description': 'Still changing', 'values': [1.0, 0.9, 0.8, 0.7, 0.6], 'expected': None},
+        ]
+        for test_case in test_pattern:
+            callback = PlateauStopping('loss', patience=3, threshold=1e-3)
+            with self.subTest(test_case['description']):
+                self.assertEqual(stopped_epoch(callback, test_case['values']), test_case['expected'])
+
+    def test_external_stopping(self):
+        callback = ExternalStopping(lambda epoch, values: epoch == 2)
+        self.assertEqual(stopped_epoch(callback, [1, 1, 1, 1]), 2)
+
+
+class TestNNTrainManagerStopping(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        cfg = OmegaConf.structured(TrainConfig)
+        cfg.cuda, cfg.epochs, cfg.patience = False, 10, 1
+        cfg.model = OmegaConf.structured(CNNRNNConfig)
+        cfg.model.optim = OmegaConf.structured(AdamConfig)
+        cfg.model.cuda, cfg.model.early_stopping = False, True
+        cfg.model.model_path = f'{self.temp_dir.name}/model.pth'
+        cfg.model.channel_list, cfg.model.kernel_sizes = [4], [[4, 4]]
+        cfg.model.stride_sizes, cfg.model.padding_sizes = [[2, 2]], [[1, 1]]
+        cfg.model.rnn_hidden_size = 8
+        OmegaConf.set_struct(cfg.model, False)
+        cfg.model.mixup_alpha = 0.0
+        data_cfg = OmegaConf.structured(DataConfig)
+        data_cfg.n_jobs, data_cfg.batch_size = 0, 8
+        dataloaders = {phase: set_dataloader(ImageDataSet(), phase, data_cfg) for phase in ['train', 'val']}
+        metrics = {phase: get_metric_list(['loss'], target_metric='loss') for phase in ['train', 'val']}
+
+        torch.manual_seed(0)
+        self.train_manager = NNTrainManager([0, 1], cfg, dataloaders, metrics)
+        self.recorder = WeightRecorder(self.train_manager.model_manager)
+        self.train_manager.epoch_callbacks = [self.recorder]
+
+        # Validation losses of epochs are scripted, while training updates the model as usual
+        self.val_losses = [3.0, 2.0, 4.0, 1.0]
+        fit = self.train_manager.model_manager.fit
+
+        def scripted_fit(inputs, labels, phase, *lengths):
+            loss, preds = fit(inputs, labels, phase, *lengths)
+            if phase == 'val':
+                loss = torch.tensor(self.val_losses[len(self.recorder.weights)])
+            return loss, preds
+        self.train_manager.model_manager.fit = scripted_fit
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_restore_best(self):
+        # Each run stands for a cross validation fold, which starts without the state of the previous one
+        for fold in range(2):
+            self.train_manager.train()
+            weights = self.train_manager.model_manager.model.state_dict()
+            with self.subTest(fold=fold):
+                # Stopped after the epoch worse than the best one with patience 1
+                self.assertEqual(len(self.recorder.weights), 3)
+                for key, value in weights.items():
+                    torch.testing.assert_close(value, self.recorder.weights[1][key])
+                self.assertFalse(all(torch.equal(value, self.recorder.weights[2][key])
+                                     for key, value in weights.items()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import torch
+
+from ml.models.nn_models.cnn import CNNMaker
+from ml.models.nn_models.logmel_cnn import Cnn14
+from tests.models.utils import SavedTensorTracker
+
+
+def make_cnn(checkpoint_segments):
+    torch.manual_seed(0)
+    layer_info = [(8, (3, 3), (1, 1), (1, 1)), (8, (3, 3), (1, 1), (1, 1)), ('M', (2, 2), (2, 2), (0, 0)),
+                  (16, (3, 3), (1, 1), (1, 1)), (16, (3, 3), (1, 1), (1, 1))]
+    return CNNMaker(in_channels=1, image_size=[32, 32], cfg=layer_info, n_classes=2, n_dim=2,
+                    checkpoint_segments=checkpoint_segments).make_layers()
+
+
+def make_cnn14(checkpoint_segments):
+    torch.manual_seed(0)
+    return Cnn14(in_channels=1, sample_rate=16000, window_size=512, hop_size=160, mel_bins=32, fmin=0, fmax=8000,
+                 classes_num=2, checkpoint_segments=checkpoint_segments)
+
+
+def train_step(model, inputs):
+    torch.manual_seed(1)
+    tracker = SavedTensorTracker()
+    with torch.autograd.graph.saved_tensors_hooks(tracker.pack, tracker.unpack):
+        outputs = model(inputs)
+    saved_bytes = tracker.n_bytes
+    outputs.pow(2).sum().backward()
+    grads = [param.grad.clone() for param in model.parameters()]
+    return outputs.detach(), grads, saved_bytes
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_same_as_plain(self):
+        test_pattern = [
+            {'description': 'CNN', 'make_model': make_cnn, 'input_size': (4, 1, 32, 32)},
+            {'description': 'Cnn14', 'make_model': make_cnn14, 'input_size': (4, 1, 64, 32)},
+        ]
+        for test_case in test_pattern:
+            inputs = torch.randn(*test_case['input_size'])
+            plain, checkpointed = test_case['make_model'](0), test_case['make_model'](2)
+            expected, expected_grads, _ = train_step(plain, inputs)
+            outputs, grads, _ = train_step(checkpointed, inputs)
+            with self.subTest(test_case['description']):
+                # Dropout is replayed with the same random state in recomputation
+                torch.testing.assert_close(outputs, expected)
+                for grad, expected_grad in zip(grads, expected_grads):
+                    torch.testing.assert_close(grad, expected_grad)
+                # Batch norm statistics are updated once, and parameters are saved under the same keys
+                self.assertEqual(checkpointed.state_dict().keys(), plain.state_dict().keys())
+                for key, value in checkpointed.state_dict().items():
+                    torch.testing.assert_close(value, plain.state_dict()[key])
+
+    def test_not_checkpointed_in_eval(self):
+        model = make_cnn(2).eval()
+        with torch.no_grad():
+            torch.testing.assert_close(model(torch.ones(2, 1, 32, 32)), make_cnn(0).eval()(torch.ones(2, 1, 32, 32)))
+
+    def test_benchmark(self):
+        inputs = torch.randn(4, 1, 128, 64)
+        saved_bytes = {}
+        for n_segments in [0, 1, 2]:
+            _, _, saved_bytes[n_segments] = train_step(make_cnn14(n_segments), inputs)
+
+        # Only inputs of segments and layers after them are kept
+        self.assertLess(saved_bytes[1], saved_bytes[0] / 10)
+        self.assertLess(saved_bytes[2], saved_bytes[0] / 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import torch
+
+from ml.models.model_managers import mixed_precision
+from ml.models.model_managers.mixed_precision import MixedPrecision
+
+
+class TestMixedPrecision(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = torch.nn.Linear(8, 2)
+        self.optimizer = torch.optim.SGD(self.model.parameters(), lr=0.1)
+
+    def _train_step(self, amp, grad_clip=None):
+        precision = MixedPrecision(amp, 'cpu')
+        with precision.autocast():
+            outputs = self.model(torch.randn(4, 8))
+        loss = outputs.float().pow(2).mean() * 100
+        self.optimizer.zero_grad()
+        precision.backward(loss, self.optimizer)
+        precision.step(self.optimizer, self.model.parameters(), grad_clip)
+        return outputs
+
+    def test_autocast(self):
+        test_pattern = [
+            {'description': 'bfloat16 on CPU', 'amp': True, 'dtype': torch.bfloat16},
+            {'description': 'Disabled', 'amp': False, 'dtype': torch.float32},
+        ]
+        for test_case in test_pattern:
+            with self.subTest(test_case['description']):
+                self.assertEqual(self._train_step(test_case['amp']).dtype, test_case['dtype'])
+
+    def test_grad_clip(self):
+        weight = self.model.weight.detach().clone()
+        self._train_step(True, grad_clip=[0.01])
+        # Updates are bounded by lr * max_norm
+        self.assertLessEqual((self.model.weight.detach() - weight).norm().item(), 0.1 * 0.01 + 1e-6)
+
+    @unittest.skipIf(mixed_precision.apex_amp is not None, 'apex is installed')
+    def test_apex_not_installed(self):
+        with self.assertRaises(ImportError):
+            MixedPrecision(True, 'cpu', use_apex=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
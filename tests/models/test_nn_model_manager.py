@@ -0,0 +1,156 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+
+from ml.models.model_managers.multitask_nn_model_manager import MultitaskNNModelManager
+from ml.models.model_managers.nn_model_manager import NNModelManager
+from ml.models.nn_models.cnn_rnn import CNNRNNConfig
+from ml.utils.nn_config import SGDConfig
+from tests.models.utils import SavedTensorTracker
+
+
+def legacy_step(model_manager, inputs, labels):
+    """Reference of the previous step, which retained the graph and read the loss and predictions every step"""
+    model_manager.model.train()
+    model_manager.optimizer.zero_grad()
+    outputs = model_manager.model(inputs)
+    loss = model_manager.criterion(outputs, F.one_hot(labels, 2).float().to(outputs.device))
+    loss.backward(retain_graph=True)
+    model_manager.optimizer.step()
+    return loss.item(), torch.max(outputs, 1)[1].cpu().numpy()
+
+
+class TwoHeads(torch.nn.Module):
+    def __init__(self):
+        super(TwoHeads, self).__init__()
+        self.heads = torch.nn.ModuleList([torch.nn.Linear(8, 2), torch.nn.Linear(8, 3)])
+
+    def forward(self, x):
+        return [head(x) for head in self.heads]
+
+
+def make_model_manager(model=None, manager_cls=NNModelManager, **kwargs):
+    cfg = OmegaConf.structured(CNNRNNConfig)
+    cfg.optim = OmegaConf.structured(SGDConfig)
+    cfg.cuda = False
+    cfg.input_size, cfg.image_size, cfg.in_channels = [1, 16, 16], [16, 16], 1
+    cfg.channel_list, cfg.kernel_sizes, cfg.stride_sizes, cfg.padding_sizes = [4], [[4, 4]], [[2, 2]], [[1, 1]]
+    OmegaConf.set_struct(cfg, False)
+    cfg.mixup_alpha = 0.0
+    for key, value in kwargs.items():
+        cfg[key] = value
+    with mock.patch.object(manager_cls, '_instantiate_model', return_value=torch.nn.Linear(8, 2)):
+        model_manager = manager_cls([0, 1], cfg)
+
+    # A linear model whose updates are easy to compare
+    torch.manual_seed(0)
+    model_manager.model = model or torch.nn.Linear(8, 2)
+    model_manager.optimizer = torch.optim.SGD(model_manager.model.parameters(), lr=0.1, momentum=0.9)
+    return model_manager
+
+
+class TestNNModelManager(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1)
+        self.inputs = torch.randn(12, 8)
+        self.labels = torch.randint(0, 2, (12,))
+
+    def _fit(self, model_manager, batches):
+        for batch in batches:
+            model_manager.fit(self.inputs[batch], self.labels[batch], 'train')
+        model_manager.step_optimizer()
+        return model_manager.model.weight.detach()
+
+    def test_grad_accum_steps(self):
+        test_pattern = [
+            {'description': 'Accumulated batches', 'grad_clip': []},
+            {'description': 'Clipped at accumulation boundaries', 'grad_clip': [0.05]},
+        ]
+        for test_case in test_pattern:
+            # The last batch is fewer than grad_accum_steps, and is updated alone by step_optimizer
+            accumulated = self._fit(make_model_manager(grad_accum_steps=2, grad_clip=test_case['grad_clip']),
+                                    [slice(0, 4), slice(4, 8), slice(8, 12)])
+            expected = self._fit(make_model_manager(grad_clip=test_case['grad_clip']), [slice(0, 8), slice(8, 12)])
+            with self.subTest(test_case['description']):
+                torch.testing.assert_close(accumulated, expected)
+
+    def test_multitask_grad_accum_steps(self):
+        labels = [self.labels, torch.randint(0, 3, (12,))]
+        weights = {}
+        # The last batch is fewer than grad_accum_steps, and is updated alone by step_optimizer
+        for grad_accum_steps, batches in [(2, [slice(0, 4), slice(4, 8), slice(8, 12)]),
+                                          (1, [slice(0, 8), slice(8, 12)])]:
+            torch.manual_seed(0)
+            model_manager = make_model_manager(TwoHeads(), MultitaskNNModelManager, grad_accum_steps=grad_accum_steps,
+                                               n_labels_in_each_task=[2, 3])
+            for batch in batches:
+                model_manager.fit(self.inputs[batch], [task_labels[batch] for task_labels in labels], 'train')
+            model_manager.step_optimizer()
+            weights[grad_accum_steps] = [head.weight.detach() for head in model_manager.model.heads]
+
+        for accumulated, expected in zip(weights[2], weights[1]):
+            torch.testing.assert_close(accumulated, expected)
+
+    def test_graph_freed_before_step(self):
+        test_pattern = [
+            {'description': 'Legacy', 'step': legacy_step, 'freed': False},
+            {'description': 'Lean', 'step': lambda manager, inputs, labels: manager.fit(inputs, labels, 'train'),
+             'freed': True},
+        ]
+        for test_case in test_pattern:
+            model_manager = make_model_manager(torch.nn.Sequential(torch.nn.Linear(8, 256), torch.nn.ReLU(),
+                                                                   torch.nn.Linear(256, 2)))
+            tracker, saved_at_step = SavedTensorTracker(), []
+            model_manager.optimizer.register_step_pre_hook(lambda *args: saved_at_step.append(tracker.n_bytes))
+            with torch.autograd.graph.saved_tensors_hooks(tracker.pack, tracker.unpack):
+                test_case['step'](model_manager, self.inputs, self.labels)
+            with self.subTest(test_case['description']):
+                # Activations retained by the graph add to the peak memory when optimizers allocate their states
+                self.assertEqual(saved_at_step[0] == 0, test_case['freed'])
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'Requires CUDA')
+    def test_peak_memory_of_step(self):
+        inputs, labels = torch.randn(1024, 512).cuda(), torch.randint(0, 2, (1024,)).cuda()
+        peaks = {}
+        for name, step in [('legacy', legacy_step),
+                           ('lean', lambda manager, inputs, labels: manager.fit(inputs, labels, 'train'))]:
+            model = torch.nn.Sequential(torch.nn.Linear(512, 4096), torch.nn.ReLU(), torch.nn.Linear(4096, 2)).cuda()
+            model_manager = make_model_manager(model, cuda=True)
+            step(model_manager, inputs, labels)     # Optimizer states are allocated in the first step
+            model_manager.optimizer.register_step_pre_hook(lambda *args: torch.cuda.reset_peak_memory_stats())
+            model_manager.optimizer.register_step_post_hook(
+                lambda *args, name=name: peaks.__setitem__(name, torch.cuda.max_memory_allocated()))
+            step(model_manager, inputs, labels)
+            torch.cuda.synchronize()
+            del model_manager, model
+
+        # Activations of the retained graph are alive when the optimizer updates parameters
+        self.assertLess(peaks['lean'], peaks['legacy'])
+
+    @unittest.skipUnless(os.environ.get('BENCHMARK'), 'Set BENCHMARK=1 to run benchmarks')
+    def test_benchmark(self):
+        inputs, labels = torch.randn(256, 512), torch.randint(0, 2, (256,))
+        steps = {'legacy': legacy_step, 'lean': lambda manager, inputs, labels: manager.fit(inputs, labels, 'train')}
+        model_managers = {name: make_model_manager(torch.nn.Sequential(
+            torch.nn.Linear(512, 1024), torch.nn.ReLU(), torch.nn.Linear(1024, 2))) for name in steps}
+
+        # Rounds alternate between the steps, and the fastest round of each is taken
+        elapsed = {name: [] for name in steps}
+        for _ in range(5):
+            for name, step in steps.items():
+                start = time.perf_counter()
+                for _ in range(10):
+                    step(model_managers[name], inputs, labels)
+                elapsed[name].append((time.perf_counter() - start) / 10)
+        print(f"\nTraining step: legacy {min(elapsed['legacy']) * 1000:.2f}ms, "
+              f"lean {min(elapsed['lean']) * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    unittest.main()
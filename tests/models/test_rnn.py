@@ -0,0 +1,55 @@
+import unittest
+
+import torch
+from torch import nn
+
+from ml.models.nn_models.rnn import RNNClassifier
+
+
+class TestRNNClassifier(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = RNNClassifier(input_size=4, out_time_feature=10, n_classes=3, rnn_type=nn.GRU,
+                                   rnn_hidden_size=8, n_layers=1, bidirectional=True, dropout=0.0).eval()
+
+    def test_packed_sequence(self):
+        x = torch.randn(2, 4, 10)
+        lengths = torch.tensor([10, 6])
+        feature = self.model.extract_feature(x, lengths)
+
+        self.assertEqual(feature.size(), (2, 16, 10))
+        self.assertEqual(feature[1, :, 6:].abs().sum(), 0)
+        # Outputs of the padded sample do not depend on values in padding
+        x[1, :, 6:] = torch.randn(4, 4)
+        torch.testing.assert_close(self.model.extract_feature(x, lengths), feature)
+        # Outputs of the full length sample equal those without packing
+        torch.testing.assert_close(feature[0], self.model.extract_feature(x)[0])
+
+    def test_pooling(self):
+        test_pattern = [
+            {'description': 'Mean', 'pooling': 'mean', 'feature_size': 16},
+            {'description': 'Max', 'pooling': 'max', 'feature_size': 16},
+            {'description': 'Attention', 'pooling': 'attention', 'feature_size': 32},
+        ]
+        for test_case in test_pattern:
+            torch.manual_seed(0)
+            model = RNNClassifier(input_size=4, out_time_feature=10, n_classes=3, rnn_type=nn.GRU, rnn_hidden_size=8,
+                                  n_layers=1, bidirectional=True, dropout=0.0, pooling=test_case['pooling'],
+                                  d_attn=8, n_heads=2).eval()
+            x = torch.randn(2, 4, 13)
+            lengths = torch.tensor([13, 5])
+            feature = model.extract_feature(x, lengths)
+            padded = torch.cat([x, torch.randn(2, 4, 7)], dim=2)
+            padded[1, :, 5:] = torch.randn(4, 15)
+
+            with self.subTest(test_case['description']):
+                self.assertEqual(feature.size(), (2, test_case['feature_size']))
+                # Pooled features depend only on valid steps, whatever the padded length of the batch is
+                torch.testing.assert_close(model.extract_feature(padded, lengths), feature)
+                torch.testing.assert_close(model.extract_feature(x[1:, :, :5])[0], feature[1])
+                self.assertEqual(model(x, lengths).size(), (2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+class SavedTensorTracker:
+    """Bytes of tensors saved for backward by autograd whose graph is still alive"""
+    def __init__(self):
+        self.n_bytes = 0
+
+    def pack(self, tensor):
+        return SavedTensor(tensor, self)
+
+    @staticmethod
+    def unpack(saved):
+        return saved.tensor
+
+
+class SavedTensor:
+    def __init__(self, tensor, tracker):
+        self.tensor = tensor
+        self.tracker = tracker
+        self.tracker.n_bytes += tensor.numel() * tensor.element_size()
+
+    def __del__(self):
+        self.tracker.n_bytes -= self.tensor.numel() * self.tensor.element_size()
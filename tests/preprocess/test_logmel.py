@@ -0,0 +1,84 @@
+import os
+import time
+import unittest
+
+import torch
+
+from ml.preprocess.logmel import LogMel
+
+
+def loop_logmel(logmel, signals):
+    """Reference implementation calling the extractors and bn0 once per sample and channel"""
+    outputs = []
+    for sample in signals:
+        channels = []
+        for channel in sample:
+            x = logmel.spectrogram_extractor(channel[None, :])
+            x = logmel.logmel_extractor(x)
+            channels.append(logmel.bn0(x.transpose(1, 3)).transpose(1, 3))
+        outputs.append(torch.cat(channels, dim=0))
+    return torch.cat(outputs, dim=1).detach().squeeze(dim=0)
+
+
+class TestLogMel(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.logmel = LogMel(500, 0.5, 0.25, 32, 0, 250, 'cpu')
+
+    def test_shape(self):
+        test_pattern = [
+            {'description': 'Monaural sample', 'shape': (1, 1, 5000), 'expected': (1, 41, 32)},
+            {'description': 'Multichannel sample', 'shape': (1, 4, 5000), 'expected': (4, 1, 41, 32)},
+            {'description': 'Channels without batch dimension', 'shape': (4, 5000), 'expected': (4, 1, 41, 32)},
+            {'description': 'Batch of multichannel samples', 'shape': (3, 4, 5000), 'expected': (4, 3, 41, 32)},
+        ]
+        for test_case in test_pattern:
+            with self.subTest(test_case['description']):
+                self.assertEqual(self.logmel(torch.randn(test_case['shape'])).size(), test_case['expected'])
+
+    def test_same_as_loop(self):
+        signals = torch.randn(2, 8, 5000)
+        self.logmel.bn0.eval()
+
+        torch.testing.assert_close(self.logmel(signals), loop_logmel(self.logmel, signals), rtol=1e-4, atol=1e-4)
+
+    def test_batch_statistics_per_sample(self):
+        signals = torch.randn(3, 4, 5000)
+        expected = torch.cat([self.logmel(sample) for sample in signals], dim=1)
+
+        torch.testing.assert_close(self.logmel(signals), expected, rtol=1e-4, atol=1e-4)
+
+    def test_extract_once(self):
+        signals = torch.randn(2, 64, 5000)
+        self.logmel.bn0.eval()
+        n_calls = []
+        self.logmel.spectrogram_extractor.register_forward_hook(lambda *args: n_calls.append(1))
+
+        outputs = self.logmel(signals)
+        n_vectorized_calls = len(n_calls)
+        expected = loop_logmel(self.logmel, signals)
+
+        # All samples and channels go through the extractors in one call, with the same outputs as the loop
+        self.assertEqual(n_vectorized_calls, 1)
+        torch.testing.assert_close(outputs, expected, rtol=1e-4, atol=1e-4)
+
+    @unittest.skipUnless(os.environ.get('BENCHMARK'), 'Set BENCHMARK=1 to run benchmarks')
+    def test_benchmark(self):
+        signals = torch.randn(1, 64, 5000)
+        self.logmel.bn0.eval()
+        funcs = {'loop': lambda: loop_logmel(self.logmel, signals), 'vectorized': lambda: self.logmel(signals)}
+
+        # Rounds alternate between the implementations, and the fastest round of each is taken
+        elapsed = {name: [] for name in funcs}
+        for _ in range(5):
+            for name, func in funcs.items():
+                start = time.perf_counter()
+                func()
+                elapsed[name].append(time.perf_counter() - start)
+        print(f"\nLogMel on 64 channels: loop {min(elapsed['loop']) * 1000:.1f}ms, "
+              f"vectorized {min(elapsed['vectorized']) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+import librosa
+import numpy as np
+import torch
+from scipy import signal
+
+from ml.preprocess.signal_processor import (FilterBank, cwt, design_sos, logmel, power_noise_filter, remove_power_noise,
+                                            to_spect, windows)
+from ml.utils.enums import SpectrogramWindow
+
+
+def stft_magnitude(y, n_fft, hop_length, window):
+    """librosa.stft(center=True, pad_mode='reflect') with the whole signal padded before framing"""
+    y = np.pad(y, n_fft // 2, mode='reflect')
+    frames = np.stack([y[start:start + n_fft] for start in range(0, len(y) - n_fft + 1, hop_length)], axis=1)
+    return np.abs(np.fft.rfft(frames * window[:, None], axis=0))
+
+
+class TestSignalProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.sr = 500
+        self.wave = np.random.RandomState(0).randn(4, 5000)
+
+    def test_to_spect(self):
+        expected = []
+        for y in self.wave:
+            spect = stft_magnitude(y, 250, 125, windows['hamming'](250))
+            expected.append(librosa.power_to_db(spect, ref=np.max).T)
+
+        test_pattern = [
+            {'description': 'float64 array', 'wave': self.wave, 'window': 'hamming', 'rtol': 1e-6},
+            {'description': 'float32 tensor', 'wave': torch.from_numpy(self.wave).float(),
+             'window': SpectrogramWindow.hamming, 'rtol': 1e-3},
+        ]
+        for test_case in test_pattern:
+            spect = to_spect(test_case['wave'], self.sr, 0.5, 0.25, test_case['window'])
+            with self.subTest(test_case['description']):
+                self.assertEqual(spect.dtype, torch.float32)
+                np.testing.assert_allclose(spect.numpy(), np.stack(expected), rtol=test_case['rtol'], atol=1e-3)
+
+    def test_logmel(self):
+        expected = []
+        for y in self.wave:
+            spect = stft_magnitude(y, 250, 125, signal.get_window('hann', 250, fftbins=True)) ** 2
+            S = librosa.feature.melspectrogram(S=spect, sr=self.sr, n_fft=250, n_mels=32)
+            expected.append(librosa.power_to_db(S, ref=np.max).T)
+
+        spect = logmel(self.wave, self.sr, 0.5, 0.25, 'hann', n_mels=32)
+        np.testing.assert_allclose(spect.numpy(), np.stack(expected), rtol=1e-5, atol=1e-3)
+
+    def test_cwt(self):
+        widths = np.arange(1, 31)
+        expected = torch.stack([torch.from_numpy(signal.cwt(librosa.resample(y, orig_sr=self.sr, target_sr=400),
+                                                            signal.ricker, widths)).float() for y in self.wave])
+        expected = expected.transpose(1, 2).reshape(1, -1, 4, expected.size(1)).mean(dim=2)
+
+        spect = cwt(self.wave, widths=widths, sr=self.sr)
+        self.assertEqual(spect.size(), expected.size())
+        torch.testing.assert_close(spect, expected, rtol=1e-4, atol=1e-4)
+
+    def test_remove_power_noise(self):
+        expected = self.wave
+        for btype, cutoff, order in [('bandstop', [117, 123], 6), ('bandstop', [57, 63], 6), ('highpass', 1, 4)]:
+            b, a = signal.butter(order, np.asarray(cutoff) / (0.5 * self.sr), btype=btype)
+            expected = signal.lfilter(b, a, expected)
+
+        # Second-order sections are better conditioned than the transfer function, hence the tolerance
+        np.testing.assert_allclose(remove_power_noise(self.wave, self.sr), expected, atol=1e-5)
+
+    def test_filter_bank(self):
+        test_pattern = [
+            {'description': 'Multichannel wave', 'shape': (4, 5000)},
+            {'description': 'Batch of multichannel waves', 'shape': (2, 4, 5000)},
+        ]
+        filter_bank = power_noise_filter(self.sr, freq=50.0, zero_phase=True)
+        for test_case in test_pattern:
+            wave = np.random.randn(*test_case['shape'])
+            expected = np.stack([signal.sosfiltfilt(np.vstack(filter_bank.sections), y) for y in wave.reshape(-1, 5000)])
+            with self.subTest(test_case['description']):
+                np.testing.assert_allclose(filter_bank(wave), expected.reshape(test_case['shape']))
+
+    def test_design_cache(self):
+        design_sos.cache_clear()
+        for _ in range(3):
+            FilterBank(self.sr).add('bandstop', [57, 63], 6)
+        self.assertEqual(design_sos.cache_info().misses, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
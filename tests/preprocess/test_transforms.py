@@ -0,0 +1,80 @@
+import unittest
+
+import torch
+from omegaconf import OmegaConf
+
+from ml.preprocess.parallel_transforms import ParallelTransform
+from ml.preprocess.transforms import Transform, TransConfig
+
+
+class TestTransform(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = OmegaConf.structured(TransConfig)
+        self.wave = torch.randn(1, 5000)
+
+    def test_split(self):
+        test_pattern = [
+            {'description': 'Deterministic on validation', 'phase': 'val',
+             'process_order': ['logmel', 'normalize', 'time_mask'], 'expected': (['logmel', 'normalize'], [])},
+            {'description': 'Random suffix on training', 'phase': 'train',
+             'process_order': ['logmel', 'normalize', 'time_mask'],
+             'expected': (['logmel', 'normalize'], ['time_mask'])},
+            {'description': 'Random process in the middle', 'phase': 'train',
+             'process_order': ['logmel', 'time_mask', 'normalize'], 'expected': (['logmel'], ['time_mask', 'normalize'])},
+            {'description': 'Random first process', 'phase': 'train',
+             'process_order': ['time_mask', 'logmel'], 'expected': ([], ['time_mask', 'logmel'])},
+        ]
+        for test_case in test_pattern:
+            prefix, suffix = Transform(self.cfg, test_case['phase'], test_case['process_order']).split()
+            with self.subTest(test_case['description']):
+                self.assertEqual((prefix.process_order, suffix.process_order), test_case['expected'])
+                self.assertTrue(prefix.deterministic)
+
+    def test_split_same_output(self):
+        transform = Transform(self.cfg, 'val', ['logmel', 'normalize'])
+        prefix, suffix = transform.split()
+
+        torch.testing.assert_close(suffix(prefix(self.wave)), transform(self.wave))
+
+    def test_batched(self):
+        waves = torch.randn(4, 2, 5000)
+        test_pattern = [
+            {'description': 'Transform', 'per_sample': Transform(self.cfg, 'val', ['logmel', 'normalize']),
+             'batched': Transform(self.cfg, 'val', ['logmel', 'normalize'], batched=True)},
+            {'description': 'ParallelTransform',
+             'per_sample': ParallelTransform([self.cfg, self.cfg], 'val', [['logmel'], ['logmel', 'normalize']]),
+             'batched': ParallelTransform([self.cfg, self.cfg], 'val', [['logmel'], ['logmel', 'normalize']],
+                                          batched=True)},
+        ]
+        for test_case in test_pattern:
+            expected = torch.stack([test_case['per_sample'](wave) for wave in waves])
+            with self.subTest(test_case['description']):
+                torch.testing.assert_close(test_case['batched'](waves), expected, rtol=1e-4, atol=1e-4)
+
+    def test_output_length(self):
+        test_pattern = [
+            {'description': 'logmel', 'transform': Transform(self.cfg, 'val', ['logmel', 'normalize'], batched=True)},
+            {'description': 'No frames', 'transform': Transform(self.cfg, 'val', ['normalize'], batched=True)},
+            {'description': 'ParallelTransform',
+             'transform': ParallelTransform([self.cfg, self.cfg], 'val', [['logmel'], ['logmel']], batched=True)},
+        ]
+        for test_case in test_pattern:
+            expected = [test_case['transform'](torch.randn(1, 2, length)).size(-1) for length in [4000, 4399, 4400]]
+            with self.subTest(test_case['description']):
+                self.assertEqual(test_case['transform'].output_length(torch.tensor([4000, 4399, 4400])).tolist(),
+                                 expected)
+
+    def test_parallel_split(self):
+        transform = ParallelTransform([self.cfg, self.cfg], 'train', [['logmel', 'time_mask'], ['logmel', 'normalize']])
+        prefix, suffix = transform.split()
+        expected = transform(self.wave)
+
+        features = prefix(self.wave)
+        self.assertEqual(features.size(0), 2)
+        self.assertEqual(suffix(features).size(), expected.size())
+        torch.testing.assert_close(suffix(features)[1], expected[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+import torch
+
+from ml.src.accumulator import PredictionAccumulator
+
+
+class TestPredictionAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = [(np.arange(4) % 3, torch.LongTensor([0, 1, 2, 0])),
+                        (np.arange(4, 8) % 3, torch.LongTensor([1, 2, 0, 1])),
+                        (np.arange(8, 10) % 3, torch.LongTensor([2, 0]))]
+
+    def test_compute(self):
+        test_pattern = [
+            {'description': 'Preallocated with exact size', 'n_samples': 10},
+            {'description': 'Preallocated smaller than data', 'n_samples': 3},
+            {'description': 'Chunked growth', 'n_samples': 0},
+        ]
+        for test_case in test_pattern:
+            accumulator = PredictionAccumulator(test_case['n_samples'], chunk_size=2)
+            for preds, labels in self.batches:
+                accumulator.update(preds, labels)
+            pred_list, label_list = accumulator.compute()
+
+            with self.subTest(test_case['description']):
+                np.testing.assert_array_equal(pred_list, np.arange(10) % 3)
+                np.testing.assert_array_equal(label_list, np.hstack([labels.numpy() for _, labels in self.batches]))
+                self.assertEqual(label_list.dtype, np.int64)
+
+    def test_compute_probabilities(self):
+        accumulator = PredictionAccumulator(8)
+        probs = [torch.rand(4, 3), torch.rand(3, 3)]
+        for prob in probs:
+            accumulator.update(prob, torch.LongTensor([1] * prob.size(0)))
+        pred_list, label_list = accumulator.compute()
+
+        self.assertEqual(pred_list.shape, (7, 3))
+        np.testing.assert_allclose(pred_list, torch.cat(probs).numpy())
+
+    def test_reset(self):
+        accumulator = PredictionAccumulator()
+        accumulator.update(np.array([1, 2]), torch.LongTensor([1, 2]))
+        pred_list, _ = accumulator.compute()
+        accumulator.reset()
+        accumulator.update(np.array([3, 4]), torch.LongTensor([3, 4]))
+
+        np.testing.assert_array_equal(pred_list, [1, 2])
+        self.assertEqual(len(accumulator), 2)
+
+    def test_empty(self):
+        pred_list, label_list = PredictionAccumulator().compute()
+        self.assertEqual(pred_list.size, 0)
+        self.assertEqual(label_list.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import functools
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from ml.preprocess.transforms import Transform, TransConfig
+from ml.src.cache import FeatureCache, UnstableSignatureError, signature
+from ml.src.dataloader import DataConfig
+from ml.src.dataset import ManifestDataSet
+from ml.utils.enums import CacheType
+
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_put(self):
+        cache = FeatureCache(self.temp_dir.name, namespace='logmel')
+        test_pattern = [
+            {'description': 'numpy array', 'row': ['a.wav', 0], 'value': np.arange(6).reshape(2, 3)},
+            {'description': 'torch tensor', 'row': ['b.wav', 1], 'value': torch.rand(1, 4, 5)},
+        ]
+        for test_case in test_pattern:
+            key = cache.key(test_case['row'])
+            self.assertIsNone(cache.get(key))
+            cache.put(key, test_case['value'])
+            actual = cache.get(key)
+            with self.subTest(test_case['description']):
+                self.assertIsInstance(actual, type(test_case['value']))
+                np.testing.assert_array_equal(np.asarray(actual), np.asarray(test_case['value']))
+
+    def test_get_without_copy(self):
+        cache = FeatureCache(self.temp_dir.name)
+        key = cache.key(['a.wav'])
+        cache.put(key, np.zeros(4))
+        value = cache.get(key)
+        value += 1
+
+        self.assertIsInstance(value, np.memmap)
+        np.testing.assert_array_equal(cache.get(key), np.zeros(4))
+
+    def test_key_namespace(self):
+        row = ['a.wav', 0]
+        self.assertNotEqual(FeatureCache(self.temp_dir.name, 'logmel').key(row),
+                            FeatureCache(self.temp_dir.name, 'spectrogram').key(row))
+
+    def test_evict_least_recently_used(self):
+        value = np.zeros(1000)
+        cache = FeatureCache(self.temp_dir.name, max_bytes=int(value.nbytes * 3.5))
+        keys = [cache.key([i]) for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.put(key, value)
+            path = cache._path(key, '.npy')
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        cache.get(keys[0])   # keys[1] becomes the least recently used
+        cache.put(cache.key([3]), value)
+
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertLessEqual(cache.n_bytes, cache.max_bytes)
+
+
+class Unnamed:
+    pass
+
+
+class Loader:
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+
+    def cache_key(self):
+        return f'Loader({self.sample_rate})'
+
+    def load(self, row):
+        return torch.zeros(1, self.sample_rate)
+
+
+def make_load_func(scale, transform):
+    def load_func(row):
+        return transform(row) * scale
+    return load_func
+
+
+class TestSignature(unittest.TestCase):
+
+    def test_stable(self):
+        test_pattern = [
+            {'description': 'Closure of a function and an array', 'make': lambda: make_load_func(2, np.abs)},
+            {'description': 'Partial', 'make': lambda: functools.partial(make_load_func, transform=np.abs)},
+            {'description': 'Transform', 'make': lambda: Transform(OmegaConf.structured(TransConfig), 'val', ['logmel'])},
+        ]
+        for test_case in test_pattern:
+            with self.subTest(test_case['description']):
+                self.assertEqual(signature(test_case['make']()), signature(test_case['make']()))
+                self.assertNotIn(' at 0x', signature(test_case['make']()))
+
+    def test_configurations(self):
+        test_pattern = [
+            {'description': 'Captured values', 'make': lambda value: make_load_func(value, np.abs)},
+            {'description': 'Instances of bound methods', 'make': lambda value: Loader(value).load},
+        ]
+        for test_case in test_pattern:
+            with self.subTest(test_case['description']):
+                self.assertNotEqual(signature(test_case['make'](8000)), signature(test_case['make'](16000)))
+
+    def test_unstable_repr(self):
+        with self.assertRaises(UnstableSignatureError):
+            signature(make_load_func(2, Unnamed()))
+
+
+class TestManifestDataSetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manifest_path = f'{self.temp_dir.name}/manifest.csv'
+        with open(self.manifest_path, 'w') as f:
+            f.write('\n'.join([f'{i}.wav,{i % 2}' for i in range(4)]))
+        self.cfg = OmegaConf.structured(DataConfig)
+        self.cfg.cache = CacheType.disk
+        self.cfg.cache_dir = f'{self.temp_dir.name}/cache'
+        self.n_loaded = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def load_func(self, row):
+        self.n_loaded += 1
+        return torch.full((1, 8), float(row[0].split('.')[0]))
+
+    def test_load_only_once(self):
+        dataset = ManifestDataSet(self.manifest_path, self.cfg, 'train', self.load_func,
+                                  label_func=lambda row: row[1])
+        for epoch in range(3):
+            for idx in range(len(dataset)):
+                x, label = dataset[idx]
+                self.assertTrue(torch.equal(x, torch.full((1, 8), float(idx))))
+                self.assertEqual(label, idx % 2)
+
+        self.assertEqual(self.n_loaded, len(dataset))
+
+    def test_disabled_by_unstable_signature(self):
+        with self.assertLogs('ml.src.dataset', 'WARNING'):
+            dataset = ManifestDataSet(self.manifest_path, self.cfg, 'train', make_load_func(1, Unnamed()),
+                                      label_func=lambda row: row[1])
+
+        self.assertIsNone(dataset.cache)
+
+    def test_cache_deterministic_prefix(self):
+        self.cfg.cache = CacheType.memory
+        transform = Transform(OmegaConf.structured(TransConfig), 'train', ['logmel', 'time_mask'])
+        dataset = ManifestDataSet(self.manifest_path, self.cfg, 'train', lambda row: torch.randn(1, 4000),
+                                  transform, label_func=lambda row: row[1])
+        n_cached = len(dataset.cache.entries)
+        x = [dataset[0][0] for _ in range(2)]
+
+        self.assertEqual(dataset.cached_transform.process_order, ['logmel'])
+        self.assertEqual(dataset.random_transform.process_order, ['time_mask'])
+        self.assertEqual(len(dataset.cache.entries), max(n_cached, 1))
+        self.assertEqual(x[0].size(), transform(torch.randn(1, 4000)).size())
+
+
+if __name__ == '__main__':
+    unittest.main()
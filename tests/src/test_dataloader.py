@@ -0,0 +1,101 @@
+import unittest
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from torch.utils.data import TensorDataset
+
+from ml.src.dataloader import BucketBatchSampler, DataConfig, DevicePrefetcher, make_weights_for_balanced_classes, \
+    pad_collate, set_dataloader
+
+
+class TestDataLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = np.array([2, 0, 2, 2, 5, 0])
+
+    def test_make_weights_for_balanced_classes(self):
+        test_pattern = [
+            {'description': 'Balanced', 'sample_balance': [1.0, 1.0, 1.0],
+             'expected': [2.0, 3.0, 2.0, 2.0, 6.0, 3.0]},
+            {'description': 'Weighted', 'sample_balance': [1.0, 0.5, 2.0],
+             'expected': [1.0, 3.0, 1.0, 1.0, 12.0, 3.0]},
+            {'description': 'Same', 'sample_balance': ['same'], 'expected': [1.0] * 6},
+        ]
+        for test_case in test_pattern:
+            weights = make_weights_for_balanced_classes(self.labels, test_case['sample_balance'])
+            with self.subTest(test_case['description']):
+                self.assertEqual(weights.dtype, torch.double)
+                np.testing.assert_allclose(weights.numpy(), test_case['expected'])
+
+    def test_class_index(self):
+        class_index = np.unique(self.labels, return_inverse=True)
+        weights = make_weights_for_balanced_classes(None, [1.0, 1.0, 1.0], class_index)
+
+        np.testing.assert_allclose(weights.numpy(), make_weights_for_balanced_classes(self.labels, [1.0] * 3).numpy())
+
+    def test_bucket_batch_sampler(self):
+        lengths = np.random.RandomState(0).randint(1, 1000, 1000)
+        test_pattern = [
+            {'description': 'Shuffled buckets', 'shuffle': True, 'drop_last': False},
+            {'description': 'Shuffled buckets without short batches', 'shuffle': True, 'drop_last': True},
+            {'description': 'In order', 'shuffle': False, 'drop_last': False},
+        ]
+        for test_case in test_pattern:
+            sampler = BucketBatchSampler(lengths, batch_size=8, drop_last=test_case['drop_last'],
+                                         shuffle=test_case['shuffle'], bucket_size=10)
+            batches = list(sampler)
+            indices = np.hstack(batches)
+            with self.subTest(test_case['description']):
+                self.assertEqual(len(batches), len(sampler))
+                self.assertEqual(len(set(indices)), len(indices))
+                if test_case['shuffle']:
+                    # Padding within batches is much less than in random batches
+                    padding = sum(lengths[batch].max() - lengths[batch].min() for batch in batches)
+                    self.assertLess(padding, 0.2 * len(batches) * lengths.mean())
+                else:
+                    np.testing.assert_array_equal(indices, np.arange(len(lengths)))
+
+    def test_pad_collate(self):
+        test_pattern = [
+            {'description': 'Last dimension', 'batch': [(torch.ones(2, 3), 0), (torch.ones(2, 5), 1)], 'dim': -1,
+             'expected_shape': (2, 2, 5)},
+            {'description': 'First dimension', 'batch': [(torch.ones(3, 2), 0), (torch.ones(5, 2), 1)], 'dim': 0,
+             'expected_shape': (2, 5, 2)},
+        ]
+        for test_case in test_pattern:
+            inputs, labels, lengths = pad_collate(test_case['batch'], dim=test_case['dim'])
+            with self.subTest(test_case['description']):
+                self.assertEqual(inputs.size(), test_case['expected_shape'])
+                self.assertEqual(lengths.tolist(), [3, 5])
+                self.assertEqual(labels.tolist(), [0, 1])
+                self.assertEqual(inputs.sum(), 16)
+
+    def test_bucketing_batch_transform(self):
+        dataset = TensorDataset(torch.zeros(4, 1, 10), torch.zeros(4))
+        dataset.get_lengths = lambda: np.arange(4)
+        cfg = OmegaConf.structured(DataConfig)
+        cfg.bucketing = True
+
+        # Lengths of raw inputs are not the lengths of transformed inputs given to models
+        with self.assertRaises(ValueError):
+            set_dataloader(dataset, 'train', cfg, batch_transform=torch.nn.Identity())
+
+    def test_device_prefetcher(self):
+        cfg = OmegaConf.structured(DataConfig)
+        cfg.n_jobs, cfg.batch_size, cfg.device_prefetch = 0, 4, True
+        dataset = TensorDataset(torch.arange(10).float(), torch.arange(10), torch.arange(10))
+        dataloader = set_dataloader(dataset, 'val', cfg)
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        batches = list(DevicePrefetcher(dataloader, device))
+
+        self.assertTrue(dataloader.device_prefetch)
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(torch.cat([labels.cpu() for _, labels, _ in batches]).tolist(), list(range(10)))
+        self.assertEqual(batches[0][0].device.type, device)
+        # Only inputs and labels are copied
+        self.assertEqual(batches[0][2].device.type, 'cpu')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from ml.src.dataloader import DataConfig, set_dataloader
+from ml.src.dataset import IterableManifestWaveDataSet, ManifestWaveDataSet, to_contiguous
+
+
+def load_func(row):
+    return torch.full((1, 4), float(row[0].split('.')[0]))
+
+
+class TestToContiguous(unittest.TestCase):
+
+    def test_dtype(self):
+        test_pattern = [
+            {'description': 'Integer labels', 'values': np.array([0, 2, 1], dtype=object), 'dtype': np.int64},
+            {'description': 'Integral strings', 'values': np.array(['0', '2', '1'], dtype=object), 'dtype': np.int64},
+            {'description': 'Float features', 'values': np.array([[0, 0.5], [1, 1.5]], dtype=object),
+             'dtype': np.float64},
+        ]
+        for test_case in test_pattern:
+            values = to_contiguous(test_case['values'])
+            with self.subTest(test_case['description']):
+                self.assertEqual(values.dtype, test_case['dtype'])
+                np.testing.assert_array_equal(values, test_case['values'].astype(np.float64))
+
+
+class TestIterableManifestWaveDataSet(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manifest_path = f'{self.temp_dir.name}/manifest.csv'
+        with open(self.manifest_path, 'w') as f:
+            f.write('\n'.join(f'{i}.wav,{i % 2}' for i in range(50)))
+        self.cfg = OmegaConf.structured(DataConfig)
+        self.cfg.stream_chunk_size = 7
+        self.cfg.batch_size = 5
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _load_ids(self, phase, n_jobs):
+        self.cfg.n_jobs = n_jobs
+        dataset = IterableManifestWaveDataSet(self.manifest_path, self.cfg, phase, load_func,
+                                              label_func=lambda row: row[1])
+        ids = []
+        for inputs, labels in set_dataloader(dataset, phase, self.cfg):
+            ids.extend(inputs[:, 0, 0].long().tolist())
+            np.testing.assert_array_equal(labels.numpy(), inputs[:, 0, 0].long().numpy() % 2)
+        return dataset, ids
+
+    def test_all_rows_once(self):
+        test_pattern = [
+            {'description': 'Main process', 'n_jobs': 0},
+            {'description': 'Rows striped over workers', 'n_jobs': 2},
+        ]
+        for test_case in test_pattern:
+            dataset, ids = self._load_ids('val', test_case['n_jobs'])
+            with self.subTest(test_case['description']):
+                self.assertEqual(len(dataset), 50)
+                self.assertEqual(sorted(ids), list(range(50)))
+
+    def test_shuffle_buffer(self):
+        self.cfg.shuffle_buffer = 10
+        _, ids = self._load_ids('train', 0)
+
+        self.assertEqual(sorted(ids), list(range(50)))
+        self.assertNotEqual(ids, list(range(50)))
+
+    def test_epoch_rate(self):
+        self.cfg.epoch_rate = 0.5
+        dataset, ids = self._load_ids('train', 0)
+
+        self.assertEqual(len(dataset), 25)
+        self.assertLess(len(ids), 50)
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_distributed_shards(self):
+        ids = []
+        for rank in range(2):
+            with mock.patch('ml.src.dataset.dist.is_initialized', return_value=True), \
+                    mock.patch('ml.src.dataset.dist.get_rank', return_value=rank), \
+                    mock.patch('ml.src.dataset.dist.get_world_size', return_value=2):
+                dataset, rank_ids = self._load_ids('val', 0)
+                self.assertEqual(len(dataset), 25)
+                ids.extend(rank_ids)
+
+        self.assertEqual(sorted(ids), list(range(50)))
+
+
+class TestManifestWaveDataSet(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manifest_path = f'{self.temp_dir.name}/manifest.csv'
+        with open(self.manifest_path, 'w') as f:
+            f.write('\n'.join(f'{i}.wav,{i % 2},{i + 1}' for i in range(10)))
+        self.cfg = OmegaConf.structured(DataConfig)
+        self.n_loaded = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def load_func(self, row):
+        self.n_loaded += 1
+        return torch.zeros(1, row[2])
+
+    def test_get_lengths(self):
+        test_pattern = [
+            {'description': 'Manifest column', 'length_column': 2, 'n_loaded': 0},
+            {'description': 'Measured', 'length_column': -1, 'n_loaded': 10},
+            {'description': 'Cached', 'length_column': -1, 'n_loaded': 10},
+        ]
+        for test_case in test_pattern:
+            self.cfg.length_column = test_case['length_column']
+            dataset = ManifestWaveDataSet(self.manifest_path, self.cfg, 'train', self.load_func,
+                                          label_func=lambda row: row[1])
+            with self.subTest(test_case['description']):
+                np.testing.assert_array_equal(dataset.get_lengths(), np.arange(1, 11))
+                self.assertEqual(self.n_loaded, test_case['n_loaded'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import socket
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf
+
+from ml.src.dataloader import DataConfig, set_dataloader
+from ml.src.dataset import BaseDataSet, IterableManifestWaveDataSet
+from ml.src.distributed import init_distributed
+from ml.src.metrics import get_metric_list
+
+WORLD_SIZE = 2
+
+
+class RangeDataSet(BaseDataSet):
+    def __init__(self, n=20):
+        super().__init__()
+        self.n = n
+
+    def __getitem__(self, idx):
+        return torch.tensor([float(idx)]), idx % 2
+
+    def __len__(self):
+        return self.n
+
+    def get_feature_size(self):
+        return 1
+
+    def get_labels(self):
+        return np.arange(self.n) % 2
+
+
+def load_id(row):
+    return torch.tensor([float(row[0].split('.')[0])])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(rank, port, out_dir):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), WORLD_SIZE=str(WORLD_SIZE), RANK=str(rank),
+                      LOCAL_RANK=str(rank))
+    init_distributed('gloo')
+    cfg = OmegaConf.structured(DataConfig)
+    cfg.n_jobs = 0
+    cfg.batch_size = 4
+
+    ids = {}
+    for phase in ['train', 'val', 'test']:
+        dataloader = set_dataloader(RangeDataSet(), phase, cfg, shuffle=True)
+        ids[phase] = torch.cat([inputs[:, 0] for inputs, _ in dataloader]).long().numpy()
+
+    # Streamed rows not divisible by processes
+    with open(f'{out_dir}/manifest_{rank}.csv', 'w') as f:
+        f.write('\n'.join(f'{i}.wav,{i % 2}' for i in range(21)))
+    cfg.epoch_rate, cfg.stream_chunk_size = 0.5, 4
+    for phase in ['train', 'val']:
+        dataset = IterableManifestWaveDataSet(f'{out_dir}/manifest_{rank}.csv', cfg, phase, load_id,
+                                              label_func=lambda row: row[1])
+        batches = [inputs[:, 0].long() for inputs, _ in set_dataloader(dataset, phase, cfg)]
+        ids[f'streamed_{phase}'] = torch.cat(batches).numpy()
+        ids[f'streamed_{phase}_n_batches'] = np.array(len(batches))
+
+    loss, uar = get_metric_list(['loss', 'uar'])
+    # Rank 0 predicts all labels right, and rank 1 all wrong
+    labels = np.array([0, 1, 0, 1])
+    loss.update(float(rank + 1) * 4, labels, labels)
+    uar.update(0.0, labels if rank == 0 else 1 - labels, labels)
+
+    np.savez(f'{out_dir}/{rank}.npz', loss=loss.average_meter.average, uar=uar.average_meter.average, **ids)
+    dist.destroy_process_group()
+
+
+class TestDistributed(unittest.TestCase):
+
+    def test_gloo(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            mp.spawn(run, args=(free_port(), out_dir), nprocs=WORLD_SIZE)
+            results = [np.load(f'{out_dir}/{rank}.npz') for rank in range(WORLD_SIZE)]
+
+        with self.subTest('Train and val samples split over processes'):
+            # Each process drops the last short batch of its 10 samples on training
+            train_ids = np.concatenate([result['train'] for result in results])
+            self.assertEqual(len(set(train_ids)), 16)
+            self.assertEqual(sorted(np.concatenate([result['val'] for result in results])), list(range(20)))
+        with self.subTest('Test samples loaded whole in each process'):
+            for result in results:
+                np.testing.assert_array_equal(result['test'], np.arange(20))
+        with self.subTest('Streamed batches of the same number in each process'):
+            for phase, n_batches in [('train', 1), ('val', 3)]:
+                self.assertEqual([int(result[f'streamed_{phase}_n_batches']) for result in results], [n_batches] * 2)
+            # 5 of 10 rows of each process are sampled, and the last short batch is dropped
+            self.assertEqual(len(set(np.concatenate([result['streamed_train'] for result in results]))), 8)
+            # The process short of rows pads val with its first one
+            self.assertEqual(set(np.concatenate([result['streamed_val'] for result in results])), set(range(21)))
+        with self.subTest('Metrics over all processes'):
+            for result in results:
+                self.assertAlmostEqual(float(result['loss']), 12 / 8)
+                self.assertAlmostEqual(float(result['uar']), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
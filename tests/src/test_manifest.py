@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import torch
+from omegaconf import OmegaConf
+
+from ml.src.dataloader import DataConfig, set_dataloader
+from ml.src.dataset import ManifestDataSet
+from ml.src.manifest import Manifest, StringArray, vectorized
+
+
+def private_bytes(pid):
+    total = 0
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean', 'Private_Dirty')):
+                total += int(line.split()[1]) * 1024
+    return total
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({0: ['a.wav', 'bb.wav', 'ccc.wav', 'dé.wav'], 1: [0, 1, 0, 1], 2: [0.5, 1.5, 2.5, 3.5]})
+
+    def test_string_array(self):
+        strings = StringArray.from_strings(self.df[0])
+        test_pattern = [
+            {'description': 'All', 'indices': [0, 1, 2, 3]},
+            {'description': 'Reordered subset', 'indices': [3, 1]},
+            {'description': 'Repeated', 'indices': [2, 2, 0]},
+        ]
+        for test_case in test_pattern:
+            taken = strings.take(np.array(test_case['indices']))
+            with self.subTest(test_case['description']):
+                self.assertEqual([taken[i] for i in range(len(taken))], list(self.df[0].iloc[test_case['indices']]))
+
+    def test_manifest(self):
+        manifest = Manifest.from_frame(self.df)
+
+        self.assertEqual(manifest.row(3), ('dé.wav', 1, 3.5))
+        self.assertIsInstance(manifest.data[0], StringArray)
+        pd.testing.assert_frame_equal(manifest.to_frame(), self.df)
+        pd.testing.assert_frame_equal(manifest.take([2, 0]).to_frame(), self.df.iloc[[2, 0]].reset_index(drop=True))
+        self.assertEqual(list(manifest.rows()), list(self.df.itertuples(index=False, name=None)))
+
+    def test_string_dtype(self):
+        df = self.df.astype({0: 'string'})
+        manifest = Manifest.from_frame(df)
+
+        self.assertIsInstance(manifest.data[0], StringArray)
+        self.assertEqual(manifest.row(3), ('dé.wav', 1, 3.5))
+
+
+class TestManifestDataSet(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manifest_path = f'{self.temp_dir.name}/manifest.csv'
+        with open(self.manifest_path, 'w') as f:
+            f.write('\n'.join(f'{i}.wav,{i % 3}' for i in range(10)))
+        self.cfg = OmegaConf.structured(DataConfig)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_labels(self):
+        test_pattern = [
+            {'description': 'Row-wise label_func', 'label_func': lambda row: int(row[0].split('.')[0]) % 3},
+            {'description': 'Vectorized label_func', 'label_func': vectorized(lambda row: row[1])},
+        ]
+        for test_case in test_pattern:
+            dataset = ManifestDataSet(self.manifest_path, self.cfg, 'train', lambda row: torch.zeros(1),
+                                      label_func=test_case['label_func'])
+            with self.subTest(test_case['description']):
+                np.testing.assert_array_equal(dataset.get_labels(), np.arange(10) % 3)
+
+    def test_load_func_row(self):
+        rows = []
+        dataset = ManifestDataSet(self.manifest_path, self.cfg, 'train', lambda row: rows.append(row) or torch.zeros(1),
+                                  label_func=vectorized(lambda row: row[1]))
+        dataset[4]
+
+        self.assertEqual(rows, [('4.wav', 1)])
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/smaps_rollup'), 'Requires smaps_rollup of Linux')
+class TestWorkerMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manifest_path = f'{self.temp_dir.name}/manifest.csv'
+        with open(self.manifest_path, 'w') as f:
+            f.write('\n'.join(f'/data/some/long/directory/sample_{i:08d}.wav,{i % 2}' for i in range(100000)))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_worker_memory_flat(self):
+        cfg = OmegaConf.structured(DataConfig)
+        cfg.n_jobs = 1
+        cfg.batch_size = 1000
+        dataset = ManifestDataSet(self.manifest_path, cfg, 'train', lambda row: torch.zeros(1),
+                                  label_func=lambda row: row[1])
+        loader = set_dataloader(dataset, 'val', cfg)
+
+        iterator = iter(loader)
+        next(iterator)
+        pid = iterator._workers[0].pid
+        start = private_bytes(pid)
+        for i, _ in enumerate(iterator):
+            if i == len(loader) - 3:
+                end = private_bytes(pid)
+
+        # Reading every row of the manifest does not copy pages shared with the parent
+        self.assertLess(end - start, 4 * 1024 ** 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
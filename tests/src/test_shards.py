@@ -0,0 +1,71 @@
+import pickle
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from ml.src.dataset import ShardedArrayDataSet
+from ml.src.shards import convert_csv
+
+
+class TestShardedArrayDataSet(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.csv_path = Path(self.temp_dir.name) / 'features.csv'
+        self.features = np.random.randn(10, 4)
+        self.labels = np.arange(10) % 3
+        df = pd.DataFrame(self.features, columns=[f'f{i}' for i in range(4)])
+        df['label'] = self.labels
+        df.to_csv(self.csv_path, index=False)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_convert(self):
+        test_pattern = [
+            {'description': 'Shards larger than chunks', 'shard_size': 3, 'chunk_size': 2, 'n_shards': 4},
+            {'description': 'Chunks larger than shards', 'shard_size': 2, 'chunk_size': 3, 'n_shards': 5},
+            {'description': 'Single shard', 'shard_size': 100, 'chunk_size': 4, 'n_shards': 1},
+        ]
+        for test_case in test_pattern:
+            shard_dir = Path(self.temp_dir.name) / test_case['description']
+            index = convert_csv(self.csv_path, shard_dir, shard_size=test_case['shard_size'],
+                                chunk_size=test_case['chunk_size'])
+            dataset = ShardedArrayDataSet(shard_dir, phase='train')
+
+            with self.subTest(test_case['description']):
+                self.assertEqual(len(index['shards']), test_case['n_shards'])
+                self.assertEqual(len(dataset), 10)
+                np.testing.assert_allclose(np.stack([dataset[i][0] for i in range(10)]), self.features, rtol=1e-6)
+                np.testing.assert_array_equal(dataset.get_labels(), self.labels)
+                self.assertEqual(dataset[-1][1], self.labels[-1])
+
+    def test_no_label(self):
+        shard_dir = Path(self.temp_dir.name) / 'shards'
+        convert_csv(self.csv_path, shard_dir, has_label=False, shard_size=4)
+        dataset = ShardedArrayDataSet(shard_dir, phase='infer')
+
+        self.assertEqual(dataset.get_feature_size(), 5)
+        self.assertIsNone(dataset.get_labels())
+        self.assertEqual(dataset[0].shape, (5,))
+
+    def test_workers_share_shards(self):
+        shard_dir = Path(self.temp_dir.name) / 'shards'
+        convert_csv(self.csv_path, shard_dir, shard_size=4)
+        dataset = ShardedArrayDataSet(shard_dir, phase='train')
+        dataset[0]
+
+        # Opened shards are not pickled to workers
+        self.assertIsNone(pickle.loads(pickle.dumps(dataset))._shards)
+        loader = DataLoader(dataset, batch_size=5, num_workers=2, multiprocessing_context='spawn')
+        features = torch.cat([inputs for inputs, _ in loader])
+        np.testing.assert_allclose(features.numpy(), self.features, rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
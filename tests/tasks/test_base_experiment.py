@@ -0,0 +1,135 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from ml.src.cv_manager import SupportedCV
+from ml.src.dataset import ManifestDataSet
+from ml.tasks.base_experiment import BaseExptConfig, CrossValidator, fold_model_path, get_metrics
+
+
+def load_func(row):
+    return torch.tensor([int(row[0].split('.')[0]), os.getpid()])
+
+
+class CountingDataSet(ManifestDataSet):
+    n_instances = 0
+
+    def __init__(self, *args, **kwargs):
+        super(CountingDataSet, self).__init__(*args, **kwargs)
+        CountingDataSet.n_instances += 1
+
+
+class RecordingTrainManager:
+    folds = []
+
+    def __init__(self, class_labels, cfg, dataloaders, metrics, epoch_callbacks=None):
+        self.dataloaders = dataloaders
+        self.metrics = metrics
+
+    def train(self):
+        fold = {}
+        for phase, dataloader in self.dataloaders.items():
+            inputs = torch.cat([inputs for inputs, _ in dataloader])
+            fold[phase] = (sorted(inputs[:, 0].tolist()), set(inputs[:, 1].tolist()))
+        RecordingTrainManager.folds.append(fold)
+        # Draws from the random state seeded for the fold, and records the process running the fold
+        return self.metrics, np.array(fold['val'][0] + [np.random.randint(10 ** 6), os.getpid()])
+
+
+class TestCrossValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        for phase, ids in [('train', range(0, 14)), ('val', range(14, 20))]:
+            with open(f'{self.temp_dir.name}/{phase}.csv', 'w') as f:
+                f.write('\n'.join(f'{i}.wav,{i % 2}' for i in ids))
+        self.cfg = OmegaConf.structured(BaseExptConfig)
+        OmegaConf.set_struct(self.cfg, False)
+        self.cfg.train.train_path = f'{self.temp_dir.name}/train.csv'
+        self.cfg.train.val_path = f'{self.temp_dir.name}/val.csv'
+        self.cfg.data.batch_size = 2
+        self.cfg.data.n_jobs = 1
+        self.cfg.data.persistent_workers = True
+        CountingDataSet.n_instances = 0
+        RecordingTrainManager.folds = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_folds_reuse_workers(self):
+        experimentor = CrossValidator(self.cfg, load_func, lambda row: row[1], None, CountingDataSet,
+                                      SupportedCV.k_fold, n_splits=4)
+        experimentor.train_manager_cls = RecordingTrainManager
+        experimentor.train_with_validation(get_metrics(['train', 'val'], 'classify'))
+
+        folds = RecordingTrainManager.folds
+        self.assertEqual(len(folds), 4)
+        self.assertEqual(CountingDataSet.n_instances, 2)
+        self.assertEqual(sorted(sum([fold['val'][0] for fold in folds], [])), list(range(20)))
+        for fold in folds:
+            self.assertEqual(len(fold['train'][0]), 14)
+            self.assertFalse(set(fold['train'][0]) & set(fold['val'][0]))
+            # Samples of all folds are loaded by the same worker processes
+            self.assertEqual(fold['train'][1], folds[0]['train'][1])
+            self.assertEqual(fold['val'][1], folds[0]['val'][1])
+        self.assertEqual(experimentor.cfg.train.train_path, self.cfg.train.train_path)
+
+    def test_labels_once(self):
+        n_calls = []
+        experimentor = CrossValidator(self.cfg, load_func, lambda row: n_calls.append(row) or row[1], None,
+                                      CountingDataSet, SupportedCV.stratified, n_splits=2)
+        experimentor.train_manager_cls = RecordingTrainManager
+        with mock.patch('pandas.DataFrame.to_csv') as to_csv:
+            experimentor.train_with_validation(get_metrics(['train', 'val'], 'classify'))
+
+        # Folds are indices of the manifest parsed once, labeled once and never written to files
+        self.assertEqual(len(n_calls), 20)
+        to_csv.assert_not_called()
+
+    def test_parallel_folds(self):
+        results = {}
+        for n_parallel_folds in [1, 2]:
+            self.cfg.n_parallel_folds = n_parallel_folds
+            experimentor = CrossValidator(self.cfg, load_func, lambda row: row[1], None, CountingDataSet,
+                                          SupportedCV.k_fold, n_splits=4)
+            experimentor.train_manager_cls = RecordingTrainManager
+            results[n_parallel_folds] = experimentor.train_with_validation(get_metrics(['train', 'val'], 'classify'))
+
+        preds = {n: [pred[:-1] for pred in pred_list] for n, (_, pred_list) in results.items()}
+        pids = {n: {pred[-1] for pred in pred_list} for n, (_, pred_list) in results.items()}
+        # Folds run in other processes give the same results in the same order as those run in this process
+        np.testing.assert_array_equal(results[1][0], results[2][0])
+        np.testing.assert_array_equal(np.concatenate(preds[1]), np.concatenate(preds[2]))
+        self.assertEqual(pids[1], {os.getpid()})
+        # Which worker runs each fold is up to scheduling
+        self.assertGreaterEqual(len(pids[2]), 1)
+        self.assertNotIn(os.getpid(), pids[2])
+
+    def test_parallel_folds_after_cuda_initialized(self):
+        self.cfg.n_parallel_folds = 2
+        self.cfg.train.cuda = True
+        experimentor = CrossValidator(self.cfg, load_func, lambda row: row[1], None, CountingDataSet,
+                                      SupportedCV.k_fold, n_splits=4)
+        experimentor.train_manager_cls = RecordingTrainManager
+        with mock.patch('torch.cuda.is_initialized', return_value=True):
+            with self.assertRaises(ValueError):
+                experimentor.train_with_validation(get_metrics(['train', 'val'], 'classify'))
+
+    def test_fold_model_path(self):
+        test_pattern = [
+            {'description': '.pth', 'model_path': '../output/sth.pth', 'expected': '../output/sth_fold1.pth'},
+            {'description': 'Other suffix', 'model_path': 'models/sth.pt', 'expected': 'models/sth_fold1.pt'},
+            {'description': 'No suffix', 'model_path': 'models/sth', 'expected': 'models/sth_fold1'},
+        ]
+        for test_case in test_pattern:
+            with self.subTest(test_case['description']):
+                self.assertEqual(fold_model_path(test_case['model_path'], 1), test_case['expected'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from ml.models.nn_models.cnn import CNNConfig
+from ml.tasks.search import search
+from ml.utils.config import ExptConfig
+from ml.utils.enums import SearchType, PrunerType
+from ml.utils.nn_config import AdamConfig
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = OmegaConf.structured(ExptConfig)
+        self.cfg.train.model = OmegaConf.structured(CNNConfig)
+        self.cfg.train.model.optim = OmegaConf.structured(AdamConfig)
+        self.hyperparameters = {'train.model.optim.lr': [0.1, 0.2, 0.3, 0.4], 'data.sample_balance': [[], [1.0, 1.0]]}
+        self.n_epochs = []
+
+    def typical_train(self, cfg, *args, epoch_callbacks=None):
+        # Loss in each epoch is larger with larger lr
+        loss = cfg.train.model.optim.lr + len(cfg.data.sample_balance)
+        for epoch in range(10):
+            self.n_epochs.append(epoch + 1)
+            for callback in epoch_callbacks or []:
+                callback.on_epoch_end(epoch, {'loss': loss, 'uar': 1 - loss})
+        return np.array([loss, 1 - loss]), np.zeros(2), None
+
+    def _search(self):
+        with mock.patch('ml.tasks.search.typical_train', self.typical_train), mock.patch('ml.tasks.search.mlflow'):
+            return search(self.cfg, self.hyperparameters, None, None, None, None)
+
+    def test_search_type(self):
+        test_pattern = [
+            {'description': 'Grid', 'search_type': SearchType.grid, 'n_trials': 0, 'expected_n_trials': 8},
+            {'description': 'Random', 'search_type': SearchType.random, 'n_trials': 3, 'expected_n_trials': 3},
+            {'description': 'TPE', 'search_type': SearchType.tpe, 'n_trials': 5, 'expected_n_trials': 5},
+        ]
+        for test_case in test_pattern:
+            self.cfg.search.search_type = test_case['search_type']
+            self.cfg.search.n_trials = test_case['n_trials']
+            val_results, result_pred_list = self._search()
+            with self.subTest(test_case['description']):
+                self.assertEqual(len(val_results), test_case['expected_n_trials'])
+                self.assertEqual(list(val_results.columns), list(self.hyperparameters.keys()) + ['loss', 'uar'])
+                np.testing.assert_allclose(val_results['loss'], val_results['train.model.optim.lr']
+                                           + val_results['data.sample_balance'].apply(len))
+
+        # Grid search tries all patterns once
+        self.cfg.search.search_type, self.cfg.search.n_trials = SearchType.grid, 0
+        self.assertEqual(len(set(map(str, self._search()[0].iloc[:, :2].values.tolist()))), 8)
+
+    def test_parallel(self):
+        self.cfg.search.n_parallel = 2
+        self.cfg.train.cuda = False
+        test_pattern = [
+            {'description': 'Grid', 'search_type': SearchType.grid, 'n_trials': 0, 'expected_n_trials': 8},
+            {'description': 'TPE', 'search_type': SearchType.tpe, 'n_trials': 5, 'expected_n_trials': 5},
+        ]
+        for test_case in test_pattern:
+            self.cfg.search.search_type = test_case['search_type']
+            self.cfg.search.n_trials = test_case['n_trials']
+            val_results, result_pred_list = self._search()
+            with self.subTest(test_case['description']):
+                self.assertEqual(len(val_results), test_case['expected_n_trials'])
+                np.testing.assert_allclose(val_results['loss'], val_results['train.model.optim.lr']
+                                           + val_results['data.sample_balance'].apply(len))
+
+        # Grid points are not run twice by trials running at once
+        self.cfg.search.search_type, self.cfg.search.n_trials = SearchType.grid, 0
+        self.assertEqual(len(set(map(str, self._search()[0].iloc[:, :2].values.tolist()))), 8)
+
+    def test_pruner(self):
+        self.cfg.search.pruner = PrunerType.median
+        self.cfg.search.n_warmup_epochs = 2
+        self.hyperparameters = {'train.model.optim.lr': [0.1 * i for i in range(1, 11)]}
+        val_results, result_pred_list = self._search()
+
+        # After startup trials, trials worse than the median of previous ones stop after warmup epochs
+        pruned = [result is None for result in result_pred_list]
+        self.assertEqual(len(val_results), 10)
+        self.assertGreater(sum(pruned), 0)
+        self.assertEqual(len(self.n_epochs), 10 * (10 - sum(pruned)) + 3 * sum(pruned))
+        self.assertTrue(val_results['loss'][pruned].isna().all())
+        self.assertAlmostEqual(val_results['loss'].min(), 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()